@@ -0,0 +1,579 @@
+"""
+Benchmark the handler against a local stand-in for ComfyUI.
+
+The fake server speaks the parts of the ComfyUI API the handler uses (HTTP
+/prompt, /history, /view, /upload/image, /queue, /interrupt, /object_info and
+the /ws websocket with status / execution_start / executing / progress /
+executed / execution_interrupted events). It does no GPU work: every node
+just sleeps for a configurable delay and output nodes return random bytes of
+a configurable size. This measures the handler's own overhead (validation,
+uploads, websocket handling, output encoding) on a CPU-only machine.
+
+Each scenario runs in a fresh Python process so that its peak RSS is
+measured in isolation, while the fake server runs in a process of its own.
+
+Requires aiohttp (listed in requirements.txt) for the fake server.
+
+Usage:
+    python benchmark.py                      # run the default scenario matrix
+    python benchmark.py --images 8 --output-kb 1024 --concurrency 4 --jobs 32
+    python benchmark.py --stream --json      # streaming handler, JSON report
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import multiprocessing
+import os
+import resource
+import socket
+import subprocess
+import sys
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+# Scenarios run when no scenario options are given on the command line
+DEFAULT_SCENARIOS = [
+    {"name": "single image", "images": 1, "output_kb": 256},
+    {"name": "many outputs", "images": 16, "output_kb": 256},
+    {"name": "large output", "images": 1, "output_kb": 8192},
+    {"name": "input images", "images": 1, "output_kb": 256, "input_images": 4},
+    {"name": "concurrent", "images": 2, "output_kb": 512, "concurrency": 4},
+]
+# Defaults for every scenario option
+SCENARIO_DEFAULTS = {
+    "name": "custom",
+    "images": 1,
+    "output_kb": 256,
+    "input_images": 0,
+    "input_kb": 512,
+    "concurrency": 1,
+    "jobs": 16,
+    "steps": 4,
+    "node_delay_ms": 20,
+    "stream": False,
+}
+# Prefix of the line a scenario process reports its measurements on
+RESULT_PREFIX = "BENCHMARK_RESULT "
+
+
+# ---------------------------------------------------------------------------
+# Fake ComfyUI server
+# ---------------------------------------------------------------------------
+
+
+class FakeComfyUI:
+    """
+    Minimal in-memory ComfyUI: executes one prompt at a time, like the real one.
+
+    Node behaviour is driven by the workflow itself:
+      • every node sleeps ``delay_ms`` (default: the server's node delay)
+      • nodes with an integer ``steps`` input emit one progress event per step
+      • SaveImage nodes produce ``batch_size`` outputs of ``size_kb`` KB each
+    """
+
+    def __init__(self, node_delay_ms):
+        self.node_delay_s = node_delay_ms / 1000
+        self.clients = {}
+        self.history = {}
+        self.pending = []
+        self.running = []
+        self.interrupted = set()
+        self.outputs = {}
+        self.inputs = set()
+        self.queue = None
+        self._payloads = {}
+
+    def _payload(self, size):
+        # One random blob per size, shared by every output of that size
+        if size not in self._payloads:
+            self._payloads[size] = os.urandom(size)
+        return self._payloads[size]
+
+    async def send(self, client_id, message):
+        ws = self.clients.get(client_id)
+        if ws is not None and not ws.closed:
+            await ws.send_str(json.dumps(message))
+
+    async def broadcast_status(self):
+        remaining = len(self.pending) + len(self.running)
+        message = {
+            "type": "status",
+            "data": {"status": {"exec_info": {"queue_remaining": remaining}}},
+        }
+        for client_id in list(self.clients):
+            await self.send(client_id, message)
+
+    async def execute(self):
+        while True:
+            prompt_id, prompt, client_id = await self.queue.get()
+            if prompt_id not in self.pending:
+                # Deleted from the queue (POST /queue) before it started.
+                continue
+            self.pending.remove(prompt_id)
+            self.running.append(prompt_id)
+            await self.broadcast_status()
+            await self.send(
+                client_id, {"type": "execution_start", "data": {"prompt_id": prompt_id}}
+            )
+
+            outputs = {}
+            for node_id, node in prompt.items():
+                if prompt_id in self.interrupted:
+                    break
+                inputs = node.get("inputs", {})
+                await self.send(
+                    client_id,
+                    {
+                        "type": "executing",
+                        "data": {"node": node_id, "prompt_id": prompt_id},
+                    },
+                )
+                delay_s = inputs.get("delay_ms", self.node_delay_s * 1000) / 1000
+                steps = inputs.get("steps")
+                if isinstance(steps, int) and steps > 0:
+                    for step in range(steps):
+                        if prompt_id in self.interrupted:
+                            break
+                        await asyncio.sleep(delay_s / steps)
+                        await self.send(
+                            client_id,
+                            {
+                                "type": "progress",
+                                "data": {
+                                    "value": step + 1,
+                                    "max": steps,
+                                    "prompt_id": prompt_id,
+                                    "node": node_id,
+                                },
+                            },
+                        )
+                else:
+                    await asyncio.sleep(delay_s)
+
+                if node.get("class_type") == "SaveImage":
+                    size = int(inputs.get("size_kb", 256) * 1024)
+                    images = []
+                    for index in range(inputs.get("batch_size", 1)):
+                        filename = f"bench_{prompt_id[:8]}_{node_id}_{index:05}.png"
+                        self.outputs[filename] = size
+                        images.append(
+                            {"filename": filename, "subfolder": "", "type": "output"}
+                        )
+                    outputs[node_id] = {"images": images}
+                    await self.send(
+                        client_id,
+                        {
+                            "type": "executed",
+                            "data": {
+                                "node": node_id,
+                                "display_node": node_id,
+                                "output": outputs[node_id],
+                                "prompt_id": prompt_id,
+                            },
+                        },
+                    )
+
+            self.running.remove(prompt_id)
+            interrupted = prompt_id in self.interrupted
+            self.interrupted.discard(prompt_id)
+            self.history[prompt_id] = {
+                "prompt": [0, prompt_id, prompt, {}, list(outputs)],
+                "outputs": outputs,
+                "status": {
+                    "status_str": "error" if interrupted else "success",
+                    "completed": not interrupted,
+                    "messages": [],
+                },
+            }
+            if interrupted:
+                message = {
+                    "type": "execution_interrupted",
+                    "data": {"prompt_id": prompt_id},
+                }
+            else:
+                message = {
+                    "type": "executing",
+                    "data": {"node": None, "prompt_id": prompt_id},
+                }
+            await self.send(client_id, message)
+            await self.broadcast_status()
+
+    # -- HTTP handlers -------------------------------------------------------
+
+    async def root(self, request):
+        return self.web.Response(text="ok")
+
+    async def prompt(self, request):
+        body = await request.json()
+        prompt_id = body.get("prompt_id") or str(uuid.uuid4())
+        self.pending.append(prompt_id)
+        await self.queue.put((prompt_id, body["prompt"], body.get("client_id")))
+        return self.web.json_response(
+            {"prompt_id": prompt_id, "number": len(self.history), "node_errors": {}}
+        )
+
+    async def get_history(self, request):
+        prompt_id = request.match_info["prompt_id"]
+        entry = self.history.get(prompt_id)
+        return self.web.json_response({prompt_id: entry} if entry else {})
+
+    async def get_queue(self, request):
+        return self.web.json_response(
+            {
+                "queue_running": [[0, p] for p in self.running],
+                "queue_pending": [[0, p] for p in self.pending],
+            }
+        )
+
+    async def post_queue(self, request):
+        body = await request.json()
+        for prompt_id in body.get("delete", []):
+            if prompt_id in self.pending:
+                self.pending.remove(prompt_id)
+        return self.web.json_response({})
+
+    async def interrupt(self, request):
+        body = await request.json() if request.can_read_body else {}
+        # Like ComfyUI, only the running prompt is interrupted, and only if it
+        # is the one asked for
+        prompt_id = body.get("prompt_id")
+        for running_id in self.running:
+            if prompt_id in (None, running_id):
+                self.interrupted.add(running_id)
+        return self.web.Response(text="")
+
+    async def empty(self, request):
+        return self.web.Response(text="")
+
+    async def object_info(self, request):
+        # Any class_type is accepted; loaders report no model lists so that
+        # pre-flight validation only checks node types.
+        node_types = {
+            "SaveImage",
+            "LoadImage",
+            "KSampler",
+            "CheckpointLoaderSimple",
+            "PreviewAny",
+        }
+        return self.web.json_response(
+            {name: {"input": {"required": {}}} for name in node_types}
+        )
+
+    async def system_stats(self, request):
+        return self.web.json_response(
+            {
+                "system": {"ram_total": 64 << 30, "ram_free": 48 << 30},
+                "devices": [{"vram_total": 24 << 30, "vram_free": 20 << 30}],
+            }
+        )
+
+    async def upload(self, request):
+        reader = await request.multipart()
+        name = None
+        while True:
+            part = await reader.next()
+            if part is None:
+                break
+            if part.name == "image":
+                name = part.filename
+                while await part.read_chunk():
+                    pass
+            else:
+                await part.read()
+        self.inputs.add(name)
+        return self.web.json_response({"name": name, "subfolder": "", "type": "input"})
+
+    async def view(self, request):
+        filename = request.query.get("filename", "")
+        if request.query.get("type") == "input":
+            if filename not in self.inputs:
+                return self.web.Response(status=404)
+            return self.web.Response(body=b"")
+        size = self.outputs.get(filename)
+        if size is None:
+            return self.web.Response(status=404)
+        return self.web.Response(body=self._payload(size), content_type="image/png")
+
+    async def websocket(self, request):
+        ws = self.web.WebSocketResponse()
+        await ws.prepare(request)
+        client_id = request.query.get("clientId") or str(uuid.uuid4())
+        self.clients[client_id] = ws
+        await ws.send_str(
+            json.dumps(
+                {
+                    "type": "status",
+                    "data": {
+                        "status": {"exec_info": {"queue_remaining": 0}},
+                        "sid": client_id,
+                    },
+                }
+            )
+        )
+        async for _ in ws:
+            pass
+        self.clients.pop(client_id, None)
+        return ws
+
+    async def serve(self, port, ready):
+        from aiohttp import web
+
+        self.web = web
+        self.queue = asyncio.Queue()
+        app = web.Application(client_max_size=1 << 30)
+        app.router.add_get("/", self.root)
+        app.router.add_post("/prompt", self.prompt)
+        app.router.add_get("/history/{prompt_id}", self.get_history)
+        app.router.add_get("/queue", self.get_queue)
+        app.router.add_post("/queue", self.post_queue)
+        app.router.add_post("/interrupt", self.interrupt)
+        app.router.add_post("/free", self.empty)
+        app.router.add_get("/object_info", self.object_info)
+        app.router.add_get("/system_stats", self.system_stats)
+        app.router.add_post("/upload/image", self.upload)
+        app.router.add_get("/view", self.view)
+        app.router.add_get("/ws", self.websocket)
+
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", port).start()
+        asyncio.ensure_future(self.execute())
+        ready.set()
+        await asyncio.Event().wait()
+
+
+def _run_server(port, node_delay_ms, ready):
+    asyncio.run(FakeComfyUI(node_delay_ms).serve(port, ready))
+
+
+def start_server(node_delay_ms):
+    """
+    Start the fake ComfyUI server in a separate process.
+
+    Returns:
+        tuple: (process, "host:port")
+    """
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    ready = multiprocessing.Event()
+    process = multiprocessing.Process(
+        target=_run_server, args=(port, node_delay_ms, ready), daemon=True
+    )
+    process.start()
+    if not ready.wait(30):
+        process.terminate()
+        raise RuntimeError("Fake ComfyUI server did not start")
+    return process, f"127.0.0.1:{port}"
+
+
+# ---------------------------------------------------------------------------
+# Scenario runner (runs in its own process)
+# ---------------------------------------------------------------------------
+
+
+def build_job(scenario, index):
+    """Build one job for a scenario: a sampler node feeding a SaveImage batch."""
+    workflow = {
+        "1": {
+            "class_type": "KSampler",
+            "inputs": {"steps": scenario["steps"], "seed": index},
+        },
+        "2": {
+            "class_type": "SaveImage",
+            "inputs": {
+                "images": ["1", 0],
+                "batch_size": scenario["images"],
+                "size_kb": scenario["output_kb"],
+            },
+        },
+    }
+    images = []
+    for n in range(scenario["input_images"]):
+        name = f"input_{n}.png"
+        data = os.urandom(scenario["input_kb"] * 1024)
+        images.append({"name": name, "image": base64.b64encode(data).decode()})
+        workflow[f"load_{n}"] = {"class_type": "LoadImage", "inputs": {"image": name}}
+    job_input = {"workflow": workflow}
+    if images:
+        job_input["images"] = images
+    return {"id": f"bench-{index}", "input": job_input}
+
+
+def _percentile(values, percent):
+    """Nearest-rank percentile of a sorted list."""
+    if not values:
+        return None
+    rank = max(0, min(len(values) - 1, round(percent / 100 * len(values)) - 1))
+    return values[rank]
+
+
+def _peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def run_scenario(scenario):
+    """
+    Drive the handler through one scenario and measure it.
+
+    Must run in a process whose COMFY_HOST points at the fake server.
+
+    Returns:
+        dict: Latency percentiles in ms, throughput in jobs/s, peak RSS in MB
+        and the number of failed jobs.
+    """
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import handler
+
+    jobs = [build_job(scenario, index) for index in range(scenario["jobs"])]
+
+    def run(job):
+        started = time.perf_counter()
+        if scenario["stream"]:
+            results = list(handler.stream_handler(job))
+            failed = any("error" in result for result in results)
+        else:
+            failed = "error" in handler.handler(job)
+        return time.perf_counter() - started, failed
+
+    # One job first so connection setup is not part of the measurements
+    run(build_job(scenario, -1))
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=scenario["concurrency"]) as pool:
+        measurements = list(pool.map(run, jobs))
+    elapsed = time.perf_counter() - started
+
+    latencies = sorted(latency * 1000 for latency, _ in measurements)
+    return {
+        "name": scenario["name"],
+        "jobs": len(jobs),
+        "failed": sum(failed for _, failed in measurements),
+        "p50_ms": _percentile(latencies, 50),
+        "p90_ms": _percentile(latencies, 90),
+        "p99_ms": _percentile(latencies, 99),
+        "max_ms": latencies[-1],
+        "throughput_jobs_s": len(jobs) / elapsed,
+        "peak_rss_mb": _peak_rss_mb(),
+    }
+
+
+def run_in_subprocess(scenario, host, verbose=False):
+    """Run a scenario in a fresh interpreter and return its measurements."""
+    env = dict(
+        os.environ,
+        COMFY_HOST=host,
+        # Measure the full pipeline on every job
+        RESULT_CACHE="false",
+        TIMINGS_LOG="false",
+        COMFY_READY_FILE=os.devnull,
+        WARMUP_WORKFLOW="",
+        WARMUP_MODELS="",
+    )
+    process = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--run", json.dumps(scenario)],
+        env=env,
+        stdout=subprocess.PIPE,
+        stderr=None if verbose else subprocess.DEVNULL,
+        text=True,
+    )
+    for line in process.stdout.splitlines():
+        if line.startswith(RESULT_PREFIX):
+            return json.loads(line[len(RESULT_PREFIX) :])
+        if verbose:
+            print(line)
+    raise RuntimeError(
+        f"Scenario '{scenario['name']}' failed (exit code {process.returncode})"
+    )
+
+
+def print_report(results):
+    columns = [
+        ("scenario", "name", "{}"),
+        ("jobs", "jobs", "{}"),
+        ("failed", "failed", "{}"),
+        ("p50 ms", "p50_ms", "{:.1f}"),
+        ("p90 ms", "p90_ms", "{:.1f}"),
+        ("p99 ms", "p99_ms", "{:.1f}"),
+        ("max ms", "max_ms", "{:.1f}"),
+        ("jobs/s", "throughput_jobs_s", "{:.2f}"),
+        ("peak RSS MB", "peak_rss_mb", "{:.1f}"),
+    ]
+    rows = [[fmt.format(result[key]) for _, key, fmt in columns] for result in results]
+    widths = [
+        max(len(title), *(len(row[i]) for row in rows))
+        for i, (title, _, _) in enumerate(columns)
+    ]
+    print(
+        "  ".join(title.ljust(w) for (title, _, _), w in zip(columns, widths)).rstrip()
+    )
+    for row in rows:
+        print("  ".join(cell.ljust(w) for cell, w in zip(row, widths)).rstrip())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--images", type=int, help="output images per job")
+    parser.add_argument("--output-kb", type=int, help="size of each output in KB")
+    parser.add_argument("--input-images", type=int, help="input images per job")
+    parser.add_argument("--input-kb", type=int, help="size of each input in KB")
+    parser.add_argument("--concurrency", type=int, help="jobs run at the same time")
+    parser.add_argument("--jobs", type=int, help="jobs per scenario")
+    parser.add_argument("--steps", type=int, help="progress steps of the sampler")
+    parser.add_argument("--node-delay-ms", type=int, help="time each node takes")
+    parser.add_argument(
+        "--stream", action="store_true", help="use the streaming handler"
+    )
+    parser.add_argument("--json", action="store_true", help="print a JSON report")
+    parser.add_argument(
+        "--verbose", action="store_true", help="show the handler's log output"
+    )
+    parser.add_argument("--run", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        result = run_scenario(json.loads(args.run))
+        print(RESULT_PREFIX + json.dumps(result), flush=True)
+        return
+
+    options = {
+        key: value
+        for key, value in vars(args).items()
+        if key in SCENARIO_DEFAULTS and value not in (None, False)
+    }
+    shared = {"stream": args.stream}
+    if args.jobs:
+        shared["jobs"] = args.jobs
+    if args.node_delay_ms is not None:
+        shared["node_delay_ms"] = args.node_delay_ms
+    if set(options) - set(shared):
+        scenarios = [{**SCENARIO_DEFAULTS, **options}]
+    else:
+        scenarios = [
+            {**SCENARIO_DEFAULTS, **scenario, **shared}
+            for scenario in DEFAULT_SCENARIOS
+        ]
+
+    server, host = start_server(scenarios[0]["node_delay_ms"])
+    try:
+        results = []
+        for scenario in scenarios:
+            if not args.json:
+                print(f"Running '{scenario['name']}'...", file=sys.stderr)
+            results.append(run_in_subprocess(scenario, host, args.verbose))
+    finally:
+        server.terminate()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_report(results)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,47 @@
 import runpod
+import asyncio
+import collections
+import contextlib
+import queue
 from runpod.serverless.utils import rp_upload
+from boto3.s3.transfer import TransferConfig
 import json
 import urllib.request
 import urllib.parse
 import time
 import os
 import requests
+import urllib3
 import base64
-from io import BytesIO
+import gzip
+import io
+import hashlib
+import itertools
+import re
+from concurrent.futures import ThreadPoolExecutor
 import websocket
 import uuid
-import tempfile
+import mimetypes
+import shutil
+import threading
 import socket
 import traceback
 
+# zstd support is optional: the standard library ships it from Python 3.14 on,
+# older interpreters need the backports.zstd package.
+try:
+    from compression import zstd
+except ImportError:
+    try:
+        from backports import zstd
+    except ImportError:
+        zstd = None
+
+try:
+    from PIL import Image, features as pil_features
+except ImportError:
+    Image = None
+
 # Time to wait between API check attempts in milliseconds
 COMFY_API_AVAILABLE_INTERVAL_MS = 50
 # Maximum number of API check attempts
@@ -33,764 +61,4709 @@ if os.environ.get("WEBSOCKET_TRACE", "false").lower() == "true":
     # protocol errors but can be noisy in production – therefore gated behind an env-var.
     websocket.enableTrace(True)
 
-# Host where ComfyUI is running
-COMFY_HOST = "127.0.0.1:8188"
-# Enforce a clean state after each job is done
+# Host where ComfyUI is running (overridable, e.g. to point at a stand-in server)
+COMFY_HOST = os.environ.get("COMFY_HOST", "127.0.0.1:8188")
+# Marker written by start.sh once ComfyUI answered over HTTP (see _load_ready_marker)
+COMFY_READY_FILE = os.environ.get("COMFY_READY_FILE", "/tmp/comfyui.ready")
+# Enforce a clean state after each job is done; without it the memory policy
+# only refreshes the worker when freeing memory was not enough
 # see https://docs.runpod.io/docs/handler-additional-controls#refresh-worker
 REFRESH_WORKER = os.environ.get("REFRESH_WORKER", "false").lower() == "true"
+# Stream outputs node by node through a generator handler (see stream_handler)
+STREAM_OUTPUTS = os.environ.get("STREAM_OUTPUTS", "false").lower() == "true"
+# Number of jobs a worker runs at the same time (see concurrency_modifier)
+JOB_CONCURRENCY = int(os.environ.get("JOB_CONCURRENCY", 2))
+# Emit a structured JSON log line with the stage and node timings of every job
+TIMINGS_LOG = os.environ.get("TIMINGS_LOG", "true").lower() == "true"
+# Default job deadline in seconds, overridable per job with 'timeout_s' (0 = none).
+# An expired job is interrupted in ComfyUI and returns the outputs it has so far.
+JOB_TIMEOUT_S = float(os.environ.get("JOB_TIMEOUT_S", 0))
+# Seconds to wait for an interrupted prompt to stop before giving up on it
+JOB_CANCEL_GRACE_S = float(os.environ.get("JOB_CANCEL_GRACE_S", 10))
 
 # ---------------------------------------------------------------------------
-# Helper: quick reachability probe of ComfyUI HTTP endpoint (port 8188)
+# ComfyUI HTTP transport
 # ---------------------------------------------------------------------------
 
-
-def _comfy_server_status():
-    """Return a dictionary with basic reachability info for the ComfyUI HTTP server."""
-    try:
-        resp = requests.get(f"http://{COMFY_HOST}/", timeout=5)
-        return {
-            "reachable": resp.status_code == 200,
-            "status_code": resp.status_code,
-        }
-    except Exception as exc:
-        return {"reachable": False, "error": str(exc)}
+# Size of the keep-alive connection pool shared by every call into ComfyUI
+COMFY_HTTP_POOL_SIZE = int(os.environ.get("COMFY_HTTP_POOL_SIZE", 16))
+# Base delay in seconds for the exponential backoff between retries
+COMFY_HTTP_BACKOFF_S = float(os.environ.get("COMFY_HTTP_BACKOFF_S", 0.2))
+# Per-endpoint request policy:
+#   • timeout       – seconds before a single attempt is abandoned
+#   • retries       – additional attempts after a connection error, timeout or 5xx
+#   • connect_only  – only retry if the request never reached ComfyUI. Used for
+#                     non-idempotent calls where a retried POST could queue twice.
+COMFY_HTTP_POLICIES = {
+    "ping": {"timeout": 5, "retries": 0},
+    "upload": {"timeout": 30, "retries": 2},
+    "prompt": {"timeout": 30, "retries": 2, "connect_only": True},
+    "history": {"timeout": 30, "retries": 3},
+    "view": {"timeout": 60, "retries": 3},
+    "object_info": {"timeout": 10, "retries": 2},
+    "queue": {"timeout": 10, "retries": 2},
+    "interrupt": {"timeout": 10, "retries": 2},
+    "system": {"timeout": 10, "retries": 2},
+}
+# Status codes that indicate a transient server-side problem worth retrying
+COMFY_HTTP_RETRY_STATUSES = (502, 503, 504)
+# Number of input images uploaded to ComfyUI in parallel
+COMFY_UPLOAD_CONCURRENCY = int(os.environ.get("COMFY_UPLOAD_CONCURRENCY", 4))
+# Base64 characters decoded per slice while streaming an upload (multiple of 4)
+BASE64_DECODE_CHUNK_CHARS = 256 * 1024
+# Store input images under content-derived names and skip uploading images
+# ComfyUI already has (set INPUT_DEDUP=false to disable)
+INPUT_DEDUP = os.environ.get("INPUT_DEDUP", "true").lower() == "true"
 
 
-def _attempt_websocket_reconnect(ws_url, max_attempts, delay_s, initial_error):
-    """
-    Attempts to reconnect to the WebSocket server after a disconnect.
+def _request_never_sent(exc):
+    """Return True if ``exc`` was raised before the request reached the server."""
+    if isinstance(exc, requests.ConnectTimeout):
+        return True
+    reason = getattr(exc.args[0], "reason", None) if exc.args else None
+    return isinstance(reason, urllib3.exceptions.NewConnectionError)
 
-    Args:
-        ws_url (str): The WebSocket URL (including client_id).
-        max_attempts (int): Maximum number of reconnection attempts.
-        delay_s (int): Delay in seconds between attempts.
-        initial_error (Exception): The error that triggered the reconnect attempt.
 
-    Returns:
-        websocket.WebSocket: The newly connected WebSocket object.
+def _image_digest(payload):
+    """
+    Return the sha256 of an image's bytes, given as raw bytes or as base64
+    text (optionally with a data URI prefix), so that both forms of the same
+    image share a digest.
 
     Raises:
-        websocket.WebSocketConnectionClosedException: If reconnection fails after all attempts.
+        binascii.Error: If the base64 text has an invalid length.
     """
-    print(
-        f"worker-comfyui - Websocket connection closed unexpectedly: {initial_error}. Attempting to reconnect..."
-    )
-    last_reconnect_error = initial_error
-    for attempt in range(max_attempts):
-        # Log current server status before each reconnect attempt so that we can
-        # see whether ComfyUI is still alive (HTTP port 8188 responding) even if
-        # the websocket dropped. This is extremely useful to differentiate
-        # between a network glitch and an outright ComfyUI crash/OOM-kill.
-        srv_status = _comfy_server_status()
-        if not srv_status["reachable"]:
-            # If ComfyUI itself is down there is no point in retrying the websocket –
-            # bail out immediately so the caller gets a clear "ComfyUI crashed" error.
-            print(
-                f"worker-comfyui - ComfyUI HTTP unreachable – aborting websocket reconnect: {srv_status.get('error', 'status '+str(srv_status.get('status_code')))}"
-            )
-            raise websocket.WebSocketConnectionClosedException(
-                "ComfyUI HTTP unreachable during websocket reconnect"
-            )
+    if isinstance(payload, bytes):
+        return hashlib.sha256(payload).hexdigest()
+    digest = hashlib.sha256()
+    for chunk in _iter_base64_decoded(payload, payload.find(",") + 1):
+        digest.update(chunk)
+    return digest.hexdigest()
 
-        # Otherwise we proceed with reconnect attempts while server is up
-        print(
-            f"worker-comfyui - Reconnect attempt {attempt + 1}/{max_attempts}... (ComfyUI HTTP reachable, status {srv_status.get('status_code')})"
-        )
-        try:
-            # Need to create a new socket object for reconnect
-            new_ws = websocket.WebSocket()
-            new_ws.connect(ws_url, timeout=10)  # Use existing ws_url
-            print(f"worker-comfyui - Websocket reconnected successfully.")
-            return new_ws  # Return the new connected socket
-        except (
-            websocket.WebSocketException,
-            ConnectionRefusedError,
-            socket.timeout,
-            OSError,
-        ) as reconn_err:
-            last_reconnect_error = reconn_err
-            print(
-                f"worker-comfyui - Reconnect attempt {attempt + 1} failed: {reconn_err}"
-            )
-            if attempt < max_attempts - 1:
-                print(
-                    f"worker-comfyui - Waiting {delay_s} seconds before next attempt..."
-                )
-                time.sleep(delay_s)
-            else:
-                print(f"worker-comfyui - Max reconnection attempts reached.")
 
-    # If loop completes without returning, raise an exception
-    print("worker-comfyui - Failed to reconnect websocket after connection closed.")
-    raise websocket.WebSocketConnectionClosedException(
-        f"Connection closed and failed to reconnect. Last error: {last_reconnect_error}"
-    )
+def _dedup_name(name, digest):
+    """Return the content-derived name an input image is stored under."""
+    extension = os.path.splitext(name)[1].lower() or ".png"
+    return f"{digest[:32]}{extension}"
 
 
-def validate_input(job_input):
+def _rewrite_image_references(workflow, names):
     """
-    Validates the input for the handler function.
+    Point the workflow at the names the input images were stored under.
+
+    Every string node input equal to a requested image name is rewritten, so
+    that custom loader nodes are covered as well as LoadImage.
 
     Args:
-        job_input (dict): The input data to validate.
+        workflow (dict): The workflow in ComfyUI API format.
+        names (dict): Requested image name → stored name.
 
     Returns:
-        tuple: A tuple containing the validated data and an error message, if any.
-               The structure is (validated_data, error_message).
+        dict: The workflow, with rewritten nodes copied rather than modified.
     """
-    # Validate if job_input is provided
-    if job_input is None:
-        return None, "Please provide input"
-
-    # Check if input is a string and try to parse it as JSON
-    if isinstance(job_input, str):
-        try:
-            job_input = json.loads(job_input)
-        except json.JSONDecodeError:
-            return None, "Invalid JSON format in input"
+    renamed = {name: stored for name, stored in names.items() if name != stored}
+    if not renamed:
+        return workflow
+    workflow = dict(workflow)
+    for node_id, node in workflow.items():
+        inputs = node.get("inputs") if isinstance(node, dict) else None
+        if not isinstance(inputs, dict):
+            continue
+        changed = {
+            input_name: renamed[value]
+            for input_name, value in inputs.items()
+            if isinstance(value, str) and value in renamed
+        }
+        if changed:
+            workflow[node_id] = {**node, "inputs": {**inputs, **changed}}
+    return workflow
 
-    # Validate 'workflow' in input
-    workflow = job_input.get("workflow")
-    if workflow is None:
-        return None, "Missing 'workflow' parameter"
 
-    # Validate 'images' in input, if provided
-    images = job_input.get("images")
-    if images is not None:
-        if not isinstance(images, list) or not all(
-            "name" in image and "image" in image for image in images
-        ):
-            return (
-                None,
-                "'images' must be a list of objects with 'name' and 'image' keys",
-            )
+# Characters that are not part of the base64 alphabet (whitespace, line breaks...)
+_BASE64_JUNK_RE = re.compile(r"[^A-Za-z0-9+/=]")
 
-    # Return validated data and no error
-    return {"workflow": workflow, "images": images}, None
 
+def _iter_base64_decoded(payload, start=0):
+    """
+    Decode base64 text from ``start`` one slice at a time, skipping characters
+    outside the base64 alphabet.
 
-def check_server(url, retries=500, delay=50):
+    Raises:
+        binascii.Error: If the payload has an invalid base64 length.
     """
-    Check if a server is reachable via HTTP GET request
+    carry = ""
+    for offset in range(start, len(payload), BASE64_DECODE_CHUNK_CHARS):
+        chunk = carry + payload[offset : offset + BASE64_DECODE_CHUNK_CHARS]
+        if _BASE64_JUNK_RE.search(chunk):
+            chunk = _BASE64_JUNK_RE.sub("", chunk)
+        usable = len(chunk) - len(chunk) % 4
+        carry = chunk[usable:]
+        if usable:
+            yield base64.b64decode(chunk[:usable])
+    if carry:
+        raise base64.binascii.Error("Incorrect padding")
 
-    Args:
-    - url (str): The URL to check
-    - retries (int, optional): The number of times to attempt connecting to the server. Default is 50
-    - delay (int, optional): The time in milliseconds to wait between retries. Default is 500
 
-    Returns:
-    bool: True if the server is reachable within the given number of retries, otherwise False
+class _Base64UploadBody:
     """
+    Streaming multipart/form-data body for the ComfyUI /upload/image endpoint.
 
-    print(f"worker-comfyui - Checking API server at {url}...")
-    for i in range(retries):
-        try:
-            response = requests.get(url, timeout=5)
+    The image is decoded from its base64 payload one slice at a time while
+    requests reads the body. Only the original string and a single decoded
+    chunk are alive at any point, instead of the full decoded blob plus a
+    BytesIO copy of it. The body is seekable back to the start so that the
+    transport can replay it when a retry is needed.
+    """
 
-            # If the response status code is 200, the server is up and running
-            if response.status_code == 200:
-                print(f"worker-comfyui - API is reachable")
-                return True
-        except requests.Timeout:
-            pass
-        except requests.RequestException as e:
-            pass
+    def __init__(self, name, payload, content_type="image/png", fields=None):
+        """
+        Args:
+            name (str): Filename sent to ComfyUI.
+            payload (str): Base64 data, optionally prefixed with a data URI header.
+            content_type (str): Content type of the file part.
+            fields (dict, optional): Extra plain form fields, e.g. {"overwrite": "true"}.
 
-        # Wait for the specified delay before retrying
-        time.sleep(delay / 1000)
+        Raises:
+            binascii.Error: If the payload has an invalid base64 length.
+        """
+        self._payload = payload
+        # Skip a data URI prefix ("data:image/png;base64,") without copying the payload
+        self._start = payload.find(",") + 1
 
-    print(
-        f"worker-comfyui - Failed to connect to server at {url} after {retries} attempts."
-    )
-    return False
+        boundary = uuid.uuid4().hex
+        self.content_type = f"multipart/form-data; boundary={boundary}"
 
+        file_field = urllib3.fields.RequestField(name="image", data=b"", filename=name)
+        file_field.make_multipart(content_type=content_type)
+        self._head = f"--{boundary}\r\n{file_field.render_headers()}".encode("utf-8")
 
-def upload_images(images):
+        tail = ""
+        for field_name, value in (fields or {}).items():
+            tail += f'\r\n--{boundary}\r\nContent-Disposition: form-data; name="{field_name}"\r\n\r\n{value}'
+        self._tail = f"{tail}\r\n--{boundary}--\r\n".encode("utf-8")
+
+        self._length = len(self._head) + self._decoded_length() + len(self._tail)
+        self.seek(0)
+
+    def _decoded_length(self):
+        payload = self._payload
+        junk = sum(1 for _ in _BASE64_JUNK_RE.finditer(payload, self._start))
+        valid = len(payload) - self._start - junk
+        if valid % 4:
+            raise base64.binascii.Error("Incorrect padding")
+        end = len(payload)
+        while end > self._start and _BASE64_JUNK_RE.match(payload, end - 1):
+            end -= 1
+        padding = 0
+        while (
+            padding < 2
+            and end - padding > self._start
+            and payload[end - 1 - padding] == "="
+        ):
+            padding += 1
+        return valid // 4 * 3 - padding
+
+    def _iter_chunks(self):
+        yield self._head
+        yield from _iter_base64_decoded(self._payload, self._start)
+        yield self._tail
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        return self._iter_chunks()
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if offset != 0 or whence != os.SEEK_SET:
+            raise OSError("upload body can only be rewound to the start")
+        self._chunks = self._iter_chunks()
+        self._current = b""
+        self._offset = 0
+        self._position = 0
+        return 0
+
+    def read(self, size=-1):
+        parts = []
+        remaining = size
+        while remaining != 0:
+            if self._offset >= len(self._current):
+                self._current = next(self._chunks, b"")
+                self._offset = 0
+                if not self._current:
+                    break
+            end = len(self._current)
+            if remaining > 0:
+                end = min(end, self._offset + remaining)
+                remaining -= end - self._offset
+            parts.append(self._current[self._offset : end])
+            self._offset = end
+        data = b"".join(parts)
+        self._position += len(data)
+        return data
+
+
+class ComfyClient:
     """
-    Upload a list of base64 encoded images to the ComfyUI server using the /upload/image endpoint.
+    Pooled, keep-alive HTTP client for the ComfyUI API.
 
-    Args:
-        images (list): A list of dictionaries, each containing the 'name' of the image and the 'image' as a base64 encoded string.
+    A single instance is shared by every handler invocation so that jobs reuse
+    warm TCP connections instead of paying a fresh connect per request (a 40
+    image output used to open 40 sockets). Every call goes through
+    :meth:`request`, which applies the per-endpoint timeout and retry policy
+    from ``COMFY_HTTP_POLICIES``.
 
-    Returns:
-        dict: A dictionary indicating success or error.
+    Once ComfyUI has been confirmed healthy, :meth:`check_server` returns
+    immediately instead of polling. The flag is cleared as soon as a request
+    fails to connect, so the next job polls again after a crash.
+
+    With INPUT_DEDUP, input images are stored under names derived from their
+    content and the client remembers which of those ComfyUI already has, so
+    an image sent again by a later job is not uploaded a second time.
     """
-    if not images:
-        return {"status": "success", "message": "No images to upload", "details": []}
 
-    responses = []
-    upload_errors = []
+    def __init__(self, host, pool_size=COMFY_HTTP_POOL_SIZE):
+        self.host = host
+        self.base_url = f"http://{host}"
+        self.healthy = threading.Event()
+        # Content-derived input image names known to exist in ComfyUI's input directory
+        self._known_inputs = set()
+        self._known_inputs_lock = threading.Lock()
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=pool_size, max_retries=0
+        )
+        self.session.mount("http://", adapter)
 
-    print(f"worker-comfyui - Uploading {len(images)} image(s)...")
+    def request(self, endpoint, method, path, **kwargs):
+        """
+        Send a request to ComfyUI using the policy registered for ``endpoint``.
 
-    for image in images:
-        try:
-            name = image["name"]
-            image_data_uri = image["image"]  # Get the full string (might have prefix)
+        Args:
+            endpoint (str): Key into ``COMFY_HTTP_POLICIES``.
+            method (str): HTTP method.
+            path (str): Path relative to the ComfyUI root, starting with '/'.
+            **kwargs: Passed through to ``requests.Session.request``.
 
-            # --- Strip Data URI prefix if present ---
-            if "," in image_data_uri:
-                # Find the comma and take everything after it
-                base64_data = image_data_uri.split(",", 1)[1]
-            else:
-                # Assume it's already pure base64
-                base64_data = image_data_uri
-            # --- End strip ---
+        Returns:
+            requests.Response: The response of the last attempt.
+
+        Raises:
+            requests.RequestException: If every attempt failed.
+        """
+        policy = COMFY_HTTP_POLICIES[endpoint]
+        kwargs.setdefault("timeout", policy["timeout"])
+        retries = policy["retries"]
+        url = f"{self.base_url}{path}"
 
-            blob = base64.b64decode(base64_data)  # Decode the cleaned data
+        for attempt in range(retries + 1):
+            if attempt and hasattr(kwargs.get("data"), "seek"):
+                # Replay streamed request bodies from the start
+                kwargs["data"].seek(0)
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except requests.RequestException as e:
+                if isinstance(e, requests.ConnectionError) and not isinstance(
+                    e, requests.Timeout
+                ):
+                    self.healthy.clear()
+                if attempt >= retries or (
+                    policy.get("connect_only") and not _request_never_sent(e)
+                ):
+                    raise
+                print(
+                    f"worker-comfyui - {method} {path} failed ({e}), retrying ({attempt + 1}/{retries})..."
+                )
+            else:
+                if (
+                    response.status_code not in COMFY_HTTP_RETRY_STATUSES
+                    or policy.get("connect_only")
+                    or attempt >= retries
+                ):
+                    return response
+                print(
+                    f"worker-comfyui - {method} {path} returned {response.status_code}, retrying ({attempt + 1}/{retries})..."
+                )
+                response.close()
+            time.sleep(COMFY_HTTP_BACKOFF_S * (2**attempt))
 
-            # Prepare the form data
-            files = {
-                "image": (name, BytesIO(blob), "image/png"),
-                "overwrite": (None, "true"),
+    def server_status(self):
+        """Return a dictionary with basic reachability info for the ComfyUI HTTP server."""
+        try:
+            resp = self.request("ping", "GET", "/")
+            return {
+                "reachable": resp.status_code == 200,
+                "status_code": resp.status_code,
             }
+        except Exception as exc:
+            return {"reachable": False, "error": str(exc)}
+
+    def check_server(self, retries=500, delay=50):
+        """
+        Check if the ComfyUI server is reachable via HTTP GET request
+
+        Args:
+        - retries (int, optional): The number of times to attempt connecting to the server. Default is 500
+        - delay (int, optional): The time in milliseconds to wait between retries. Default is 50
+
+        Returns:
+        bool: True if the server is reachable within the given number of retries, otherwise False
+        """
+        if self.healthy.is_set():
+            return True
 
-            # POST request to upload the image
-            response = requests.post(
-                f"http://{COMFY_HOST}/upload/image", files=files, timeout=30
+        print(f"worker-comfyui - Checking API server at {self.base_url}/...")
+        for i in range(retries):
+            if self.server_status()["reachable"]:
+                print(f"worker-comfyui - API is reachable")
+                self.healthy.set()
+                return True
+
+            # Wait for the specified delay before retrying
+            time.sleep(delay / 1000)
+
+        print(
+            f"worker-comfyui - Failed to connect to server at {self.base_url}/ after {retries} attempts."
+        )
+        return False
+
+    def upload_image(self, name, payload):
+        """
+        Upload a single base64 encoded image to the ComfyUI /upload/image endpoint.
+
+        Args:
+            name (str): The filename the image is stored under.
+            payload (str | bytes): The base64 encoded image, optionally with a
+                data URI prefix, or the raw bytes of a prefetched image.
+
+        Returns:
+            dict: The JSON response from ComfyUI.
+
+        Raises:
+            binascii.Error: If the payload is not valid base64.
+            requests.RequestException: If the upload failed.
+        """
+        if isinstance(payload, bytes):
+            content_type = mimetypes.guess_type(name)[0] or "image/png"
+            response = self.request(
+                "upload",
+                "POST",
+                "/upload/image",
+                files={"image": (name, payload, content_type)},
+                data={"overwrite": "true"},
             )
             response.raise_for_status()
+            return response.json()
 
-            responses.append(f"Successfully uploaded {name}")
-            print(f"worker-comfyui - Successfully uploaded {name}")
+        body = _Base64UploadBody(name, payload, fields={"overwrite": "true"})
+        response = self.request(
+            "upload",
+            "POST",
+            "/upload/image",
+            data=body,
+            headers={"Content-Type": body.content_type},
+        )
+        response.raise_for_status()
+        return response.json()
+
+    def has_input(self, name):
+        """
+        Return True if ComfyUI's input directory holds ``name``.
+
+        Names seen before are answered from memory; others are looked up with a
+        HEAD request on /view and remembered when found.
+        """
+        with self._known_inputs_lock:
+            if name in self._known_inputs:
+                return True
+        query = urllib.parse.urlencode({"filename": name, "type": "input"})
+        try:
+            response = self.request("view", "HEAD", f"/view?{query}")
+        except requests.RequestException:
+            return False
+        if response.status_code != 200:
+            return False
+        with self._known_inputs_lock:
+            self._known_inputs.add(name)
+        return True
+
+    def forget_input(self, name):
+        """Drop ``name`` from the known inputs, e.g. after the file was deleted."""
+        with self._known_inputs_lock:
+            self._known_inputs.discard(name)
+
+    def known_inputs(self):
+        """Return a snapshot of the input names known to exist in ComfyUI."""
+        with self._known_inputs_lock:
+            return set(self._known_inputs)
+
+    def _upload_one(self, image):
+        """
+        Upload one entry of ``input.images``.
 
+        Returns:
+            tuple: (name the image is stored under, error message or None)
+        """
+        name = image.get("name", "unknown")
+        stored_name = name
+        try:
+            if INPUT_DEDUP:
+                stored_name = _dedup_name(name, _image_digest(image["image"]))
+                # Touched before the lookup so the disk governor cannot evict an
+                # existing copy between this decision and the prompt being queued
+                disk_governor.touch("input", [stored_name])
+                if self.has_input(stored_name):
+                    print(
+                        f"worker-comfyui - {name} already in ComfyUI as {stored_name}, skipping upload"
+                    )
+                    return stored_name, None
+            result = self.upload_image(stored_name, image["image"])
+            stored_name = result.get("name", stored_name)
+            if INPUT_DEDUP:
+                with self._known_inputs_lock:
+                    self._known_inputs.add(stored_name)
+            print(f"worker-comfyui - Successfully uploaded {name}")
+            return stored_name, None
         except base64.binascii.Error as e:
-            error_msg = f"Error decoding base64 for {image.get('name', 'unknown')}: {e}"
-            print(f"worker-comfyui - {error_msg}")
-            upload_errors.append(error_msg)
+            error_msg = f"Error decoding base64 for {name}: {e}"
         except requests.Timeout:
-            error_msg = f"Timeout uploading {image.get('name', 'unknown')}"
-            print(f"worker-comfyui - {error_msg}")
-            upload_errors.append(error_msg)
+            error_msg = f"Timeout uploading {name}"
         except requests.RequestException as e:
-            error_msg = f"Error uploading {image.get('name', 'unknown')}: {e}"
-            print(f"worker-comfyui - {error_msg}")
-            upload_errors.append(error_msg)
+            error_msg = f"Error uploading {name}: {e}"
         except Exception as e:
-            error_msg = (
-                f"Unexpected error uploading {image.get('name', 'unknown')}: {e}"
-            )
-            print(f"worker-comfyui - {error_msg}")
-            upload_errors.append(error_msg)
+            error_msg = f"Unexpected error uploading {name}: {e}"
+        print(f"worker-comfyui - {error_msg}")
+        return stored_name, error_msg
+
+    def upload_images(self, images, concurrency=COMFY_UPLOAD_CONCURRENCY):
+        """
+        Upload a list of base64 encoded images to the ComfyUI server using the /upload/image endpoint.
+
+        Images are uploaded in parallel on a bounded thread pool; a failing image
+        does not stop the others and every failure is reported individually.
+
+        Args:
+            images (list): A list of dictionaries, each containing the 'name' of the image and the 'image' as a base64 encoded string.
+            concurrency (int, optional): Maximum number of uploads in flight.
+
+        Returns:
+            dict: A dictionary indicating success or error. On success, "names"
+            maps every requested image name to the name it is stored under.
+        """
+        if not images:
+            return {
+                "status": "success",
+                "message": "No images to upload",
+                "details": [],
+                "names": {},
+            }
+
+        print(
+            f"worker-comfyui - Uploading {len(images)} image(s) (concurrency {concurrency})..."
+        )
+
+        workers = max(1, min(concurrency, len(images)))
+        with ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="comfy-upload"
+        ) as pool:
+            results = list(pool.map(self._upload_one, images))
+
+        upload_errors = [error for _, error in results if error]
+        if upload_errors:
+            print(f"worker-comfyui - image(s) upload finished with errors")
+            return {
+                "status": "error",
+                "message": "Some images failed to upload",
+                "details": upload_errors,
+            }
 
-    if upload_errors:
-        print(f"worker-comfyui - image(s) upload finished with errors")
+        print(f"worker-comfyui - image(s) upload complete")
         return {
-            "status": "error",
-            "message": "Some images failed to upload",
-            "details": upload_errors,
+            "status": "success",
+            "message": "All images uploaded successfully",
+            "details": [f"Successfully uploaded {image['name']}" for image in images],
+            "names": {
+                image["name"]: stored_name
+                for image, (stored_name, _) in zip(images, results)
+            },
         }
 
-    print(f"worker-comfyui - image(s) upload complete")
-    return {
-        "status": "success",
-        "message": "All images uploaded successfully",
-        "details": responses,
-    }
+    def get_object_info(self):
+        """
+        Retrieve the node definitions of every node type ComfyUI knows about.
 
+        Returns:
+            dict: The /object_info response, keyed by class_type.
+        """
+        response = self.request("object_info", "GET", "/object_info")
+        response.raise_for_status()
+        return response.json()
 
-def get_available_models():
-    """
-    Get list of available models from ComfyUI
+    def get_system_stats(self):
+        """
+        Retrieve ComfyUI's device and host memory statistics.
 
-    Returns:
-        dict: Dictionary containing available models by type
-    """
-    try:
-        response = requests.get(f"http://{COMFY_HOST}/object_info", timeout=10)
+        Returns:
+            dict: The /system_stats response with 'system' and 'devices'.
+        """
+        response = self.request("system", "GET", "/system_stats")
         response.raise_for_status()
-        object_info = response.json()
-
-        # Extract available checkpoints from CheckpointLoaderSimple
-        available_models = {}
-        if "CheckpointLoaderSimple" in object_info:
-            checkpoint_info = object_info["CheckpointLoaderSimple"]
-            if "input" in checkpoint_info and "required" in checkpoint_info["input"]:
-                ckpt_options = checkpoint_info["input"]["required"].get("ckpt_name")
-                if ckpt_options and len(ckpt_options) > 0:
-                    available_models["checkpoints"] = (
-                        ckpt_options[0] if isinstance(ckpt_options[0], list) else []
-                    )
+        return response.json()
 
-        return available_models
-    except Exception as e:
-        print(f"worker-comfyui - Warning: Could not fetch available models: {e}")
-        return {}
+    def free(self, unload_models=False, free_memory=False):
+        """
+        Ask ComfyUI to release memory once it is idle.
 
+        Args:
+            unload_models (bool): Unload every model from VRAM.
+            free_memory (bool): Drop cached node outputs and empty the device caches.
+        """
+        response = self.request(
+            "system",
+            "POST",
+            "/free",
+            json={"unload_models": unload_models, "free_memory": free_memory},
+        )
+        response.raise_for_status()
 
-def queue_workflow(workflow, client_id):
-    """
-    Queue a workflow to be processed by ComfyUI
+    def queue_workflow(self, workflow, client_id):
+        """
+        Queue a workflow to be processed by ComfyUI
 
-    Args:
-        workflow (dict): A dictionary containing the workflow to be processed
-        client_id (str): The client ID for the websocket connection
+        Args:
+            workflow (dict): A dictionary containing the workflow to be processed
+            client_id (str): The client ID for the websocket connection
 
-    Returns:
-        dict: The JSON response from ComfyUI after processing the workflow
+        Returns:
+            dict: The JSON response from ComfyUI after processing the workflow
 
-    Raises:
-        ValueError: If the workflow validation fails with detailed error information
-    """
-    # Include client_id in the prompt payload
-    payload = {"prompt": workflow, "client_id": client_id}
-    data = json.dumps(payload).encode("utf-8")
+        Raises:
+            ValueError: If the workflow validation fails with detailed error information
+        """
+        # Include client_id in the prompt payload
+        payload = {"prompt": workflow, "client_id": client_id}
+        data = json.dumps(payload).encode("utf-8")
 
-    # Use requests for consistency and timeout
-    headers = {"Content-Type": "application/json"}
-    response = requests.post(
-        f"http://{COMFY_HOST}/prompt", data=data, headers=headers, timeout=30
-    )
+        headers = {"Content-Type": "application/json"}
+        response = self.request("prompt", "POST", "/prompt", data=data, headers=headers)
 
-    # Handle validation errors with detailed information
-    if response.status_code == 400:
-        print(f"worker-comfyui - ComfyUI returned 400. Response body: {response.text}")
-        try:
-            error_data = response.json()
-            print(f"worker-comfyui - Parsed error data: {error_data}")
-
-            # Try to extract meaningful error information
-            error_message = "Workflow validation failed"
-            error_details = []
-
-            # ComfyUI seems to return different error formats, let's handle them all
-            if "error" in error_data:
-                error_info = error_data["error"]
-                if isinstance(error_info, dict):
-                    error_message = error_info.get("message", error_message)
-                    if error_info.get("type") == "prompt_outputs_failed_validation":
-                        error_message = "Workflow validation failed"
-                else:
-                    error_message = str(error_info)
-
-            # Check for node validation errors in the response
-            if "node_errors" in error_data:
-                for node_id, node_error in error_data["node_errors"].items():
-                    if isinstance(node_error, dict):
-                        for error_type, error_msg in node_error.items():
-                            error_details.append(
-                                f"Node {node_id} ({error_type}): {error_msg}"
-                            )
+        # Handle validation errors with detailed information
+        if response.status_code == 400:
+            print(
+                f"worker-comfyui - ComfyUI returned 400. Response body: {response.text}"
+            )
+            try:
+                error_data = response.json()
+                print(f"worker-comfyui - Parsed error data: {error_data}")
+
+                # Try to extract meaningful error information
+                error_message = "Workflow validation failed"
+                error_details = []
+
+                # ComfyUI seems to return different error formats, let's handle them all
+                if "error" in error_data:
+                    error_info = error_data["error"]
+                    if isinstance(error_info, dict):
+                        error_message = error_info.get("message", error_message)
+                        if error_info.get("type") == "prompt_outputs_failed_validation":
+                            error_message = "Workflow validation failed"
                     else:
-                        error_details.append(f"Node {node_id}: {node_error}")
-
-            # Check if the error data itself contains validation info
-            if error_data.get("type") == "prompt_outputs_failed_validation":
-                error_message = error_data.get("message", "Workflow validation failed")
-                # For this type of error, we need to parse the validation details from logs
-                # Since ComfyUI doesn't seem to include detailed validation errors in the response
-                # Let's provide a more helpful generic message
-                available_models = get_available_models()
-                if available_models.get("checkpoints"):
-                    error_message += f"\n\nThis usually means a required model or parameter is not available."
-                    error_message += f"\nAvailable checkpoint models: {', '.join(available_models['checkpoints'])}"
-                else:
-                    error_message += "\n\nThis usually means a required model or parameter is not available."
-                    error_message += "\nNo checkpoint models appear to be available. Please check your model installation."
+                        error_message = str(error_info)
 
-                raise ValueError(error_message)
+                # Check for node validation errors in the response
+                if "node_errors" in error_data:
+                    for node_id, node_error in error_data["node_errors"].items():
+                        if isinstance(node_error, dict):
+                            for error_type, error_msg in node_error.items():
+                                error_details.append(
+                                    f"Node {node_id} ({error_type}): {error_msg}"
+                                )
+                        else:
+                            error_details.append(f"Node {node_id}: {node_error}")
 
-            # If we have specific validation errors, format them nicely
-            if error_details:
-                detailed_message = f"{error_message}:\n" + "\n".join(
-                    f"• {detail}" for detail in error_details
-                )
+                # Check if the error data itself contains validation info
+                if error_data.get("type") == "prompt_outputs_failed_validation":
+                    error_message = error_data.get(
+                        "message", "Workflow validation failed"
+                    )
+                    # For this type of error, we need to parse the validation details from logs
+                    # Since ComfyUI doesn't seem to include detailed validation errors in the response
+                    # Let's provide a more helpful generic message
+                    error_message += "\n\nThis usually means a required model or parameter is not available."
+                    hint = _model_hint(
+                        workflow, error_data.get("node_errors") or workflow
+                    )
+                    if hint:
+                        error_message += f"\n{hint}"
 
-                # Try to provide helpful suggestions for common errors
-                if any(
-                    "not in list" in detail and "ckpt_name" in detail
-                    for detail in error_details
-                ):
-                    available_models = get_available_models()
-                    if available_models.get("checkpoints"):
-                        detailed_message += f"\n\nAvailable checkpoint models: {', '.join(available_models['checkpoints'])}"
-                    else:
-                        detailed_message += "\n\nNo checkpoint models appear to be available. Please check your model installation."
+                    raise ValueError(error_message)
 
-                raise ValueError(detailed_message)
-            else:
-                # Fallback to the raw response if we can't parse specific errors
-                raise ValueError(f"{error_message}. Raw response: {response.text}")
+                # If we have specific validation errors, format them nicely
+                if error_details:
+                    detailed_message = f"{error_message}:\n" + "\n".join(
+                        f"• {detail}" for detail in error_details
+                    )
 
-        except (json.JSONDecodeError, KeyError) as e:
-            # If we can't parse the error response, fall back to the raw text
-            raise ValueError(
-                f"ComfyUI validation failed (could not parse error response): {response.text}"
-            )
+                    # Values missing from a combo input usually are models or
+                    # files that are not installed
+                    not_in_list = [
+                        node_id
+                        for node_id, node_error in error_data.get(
+                            "node_errors", {}
+                        ).items()
+                        if "not in list" in str(node_error)
+                    ]
+                    if not_in_list:
+                        hint = _model_hint(workflow, not_in_list) or (
+                            "Check that the models and files named by these inputs are installed."
+                        )
+                        detailed_message += f"\n\n{hint}"
+
+                    raise ValueError(detailed_message)
+                else:
+                    # Fallback to the raw response if we can't parse specific errors
+                    raise ValueError(f"{error_message}. Raw response: {response.text}")
 
-    # For other HTTP errors, raise them normally
-    response.raise_for_status()
-    return response.json()
+            except (json.JSONDecodeError, KeyError) as e:
+                # If we can't parse the error response, fall back to the raw text
+                raise ValueError(
+                    f"ComfyUI validation failed (could not parse error response): {response.text}"
+                )
 
+        # For other HTTP errors, raise them normally
+        response.raise_for_status()
+        return response.json()
 
-def get_history(prompt_id):
-    """
-    Retrieve the history of a given prompt using its ID
+    def get_history(self, prompt_id):
+        """
+        Retrieve the history of a given prompt using its ID
 
-    Args:
-        prompt_id (str): The ID of the prompt whose history is to be retrieved
+        Args:
+            prompt_id (str): The ID of the prompt whose history is to be retrieved
 
-    Returns:
-        dict: The history of the prompt, containing all the processing steps and results
-    """
-    # Use requests for consistency and timeout
-    response = requests.get(f"http://{COMFY_HOST}/history/{prompt_id}", timeout=30)
-    response.raise_for_status()
-    return response.json()
+        Returns:
+            dict: The history of the prompt, containing all the processing steps and results
+        """
+        response = self.request("history", "GET", f"/history/{prompt_id}")
+        response.raise_for_status()
+        return response.json()
 
+    def get_queue(self):
+        """
+        Retrieve the running and pending prompts of the ComfyUI queue.
 
-def get_image_data(filename, subfolder, image_type):
-    """
-    Fetch image bytes from the ComfyUI /view endpoint.
+        Returns:
+            dict: The /queue response with 'queue_running' and 'queue_pending' lists.
+        """
+        response = self.request("queue", "GET", "/queue")
+        response.raise_for_status()
+        return response.json()
 
-    Args:
-        filename (str): The filename of the image.
-        subfolder (str): The subfolder where the image is stored.
-        image_type (str): The type of the image (e.g., 'output').
+    def delete_queued(self, prompt_ids):
+        """
+        Remove prompts from the pending part of the ComfyUI queue.
 
-    Returns:
-        bytes: The raw image data, or None if an error occurs.
-    """
-    print(
-        f"worker-comfyui - Fetching image data: type={image_type}, subfolder={subfolder}, filename={filename}"
-    )
-    data = {"filename": filename, "subfolder": subfolder, "type": image_type}
-    url_values = urllib.parse.urlencode(data)
-    try:
-        # Use requests for consistency and timeout
-        response = requests.get(f"http://{COMFY_HOST}/view?{url_values}", timeout=60)
+        Args:
+            prompt_ids (list): The prompts to remove. Running prompts are not affected.
+        """
+        response = self.request(
+            "queue", "POST", "/queue", json={"delete": list(prompt_ids)}
+        )
         response.raise_for_status()
-        print(f"worker-comfyui - Successfully fetched image data for {filename}")
-        return response.content
-    except requests.Timeout:
-        print(f"worker-comfyui - Timeout fetching image data for {filename}")
-        return None
-    except requests.RequestException as e:
-        print(f"worker-comfyui - Error fetching image data for {filename}: {e}")
-        return None
-    except Exception as e:
-        print(
-            f"worker-comfyui - Unexpected error fetching image data for {filename}: {e}"
+
+    def interrupt(self, prompt_id):
+        """
+        Interrupt a running prompt.
+
+        ComfyUI only interrupts the running prompt if its ID matches; versions
+        that ignore the body interrupt whatever is running, so callers must
+        check that ``prompt_id`` is the running prompt first.
+
+        Args:
+            prompt_id (str): The prompt to interrupt.
+        """
+        response = self.request(
+            "interrupt", "POST", "/interrupt", json={"prompt_id": prompt_id}
         )
-        return None
+        response.raise_for_status()
 
+    def open_view(self, filename, subfolder, image_type):
+        """
+        Open a streamed download of a file from the ComfyUI /view endpoint.
 
-def handler(job):
-    """
-    Handles a job using ComfyUI via websockets for status and image retrieval.
+        The body is not read; callers consume ``response.raw`` or
+        ``response.iter_content()`` and must close the response.
 
-    Args:
-        job (dict): A dictionary containing job details and input parameters.
+        Args:
+            filename (str): The filename of the image.
+            subfolder (str): The subfolder where the image is stored.
+            image_type (str): The type of the image (e.g., 'output').
+
+        Returns:
+            requests.Response: The open streaming response.
+
+        Raises:
+            requests.RequestException: If the file could not be fetched.
+        """
+        print(
+            f"worker-comfyui - Fetching image data: type={image_type}, subfolder={subfolder}, filename={filename}"
+        )
+        data = {"filename": filename, "subfolder": subfolder, "type": image_type}
+        url_values = urllib.parse.urlencode(data)
+        response = self.request("view", "GET", f"/view?{url_values}", stream=True)
+        try:
+            response.raise_for_status()
+        except requests.HTTPError:
+            response.close()
+            raise
+        # Let urllib3 undo any transfer encoding when callers read response.raw
+        response.raw.decode_content = True
+        return response
+
+
+# Shared transport used by every handler call
+comfy = ComfyClient(COMFY_HOST)
+
+# Wall clock time at which the handler module was loaded, for the cold-start timeline
+_HANDLER_LOADED_MS = time.time() * 1000
+
+
+def _load_ready_marker(path=COMFY_READY_FILE):
+    """
+    Read the ready marker written by start.sh.
+
+    The marker holds the ComfyUI PID and the boot timeline in epoch
+    milliseconds (boot_started_ms, comfy_spawned_ms, comfy_ready_ms). If the
+    process it names is still running, ComfyUI is marked healthy so the first
+    job does not poll for it again.
+
+    Returns:
+        dict: The marker contents, empty if there is no usable marker.
+    """
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            marker = json.load(f)
+        os.kill(int(marker["pid"]), 0)
+    except (OSError, ValueError, KeyError, TypeError):
+        return {}
+    comfy.healthy.set()
+    return marker
+
+
+def log_cold_start_timeline(marker, warmup_done_ms=None):
+    """
+    Print the cold-start timeline, relative to the moment start.sh booted.
+
+    Args:
+        marker (dict): The ready marker from :func:`_load_ready_marker`.
+        warmup_done_ms (float, optional): When the model warm-up finished.
+    """
+    boot = marker.get("boot_started_ms")
+    if boot is None:
+        return
+    timeline = {
+        "ComfyUI spawned": marker.get("comfy_spawned_ms"),
+        f"ComfyUI ready ({marker.get('probes', '?')} probes)": marker.get(
+            "comfy_ready_ms"
+        ),
+        "handler loaded": _HANDLER_LOADED_MS,
+        "warm-up done": warmup_done_ms,
+    }
+    print("worker-comfyui - Cold-start timeline:")
+    previous = boot
+    for stage, at in timeline.items():
+        if at is None:
+            continue
+        print(
+            f"worker-comfyui -   {stage:<32} +{(at - boot) / 1000:7.2f}s "
+            f"(+{(at - previous) / 1000:.2f}s)"
+        )
+        previous = at
+
+
+def _attempt_websocket_reconnect(ws_url, max_attempts, delay_s, initial_error):
+    """
+    Attempts to reconnect to the WebSocket server after a disconnect.
+
+    Args:
+        ws_url (str): The WebSocket URL (including client_id).
+        max_attempts (int): Maximum number of reconnection attempts.
+        delay_s (int): Delay in seconds between attempts.
+        initial_error (Exception): The error that triggered the reconnect attempt.
+
+    Returns:
+        websocket.WebSocket: The newly connected WebSocket object.
+
+    Raises:
+        websocket.WebSocketConnectionClosedException: If reconnection fails after all attempts.
+    """
+    print(
+        f"worker-comfyui - Websocket connection closed unexpectedly: {initial_error}. Attempting to reconnect..."
+    )
+    last_reconnect_error = initial_error
+    for attempt in range(max_attempts):
+        # Log current server status before each reconnect attempt so that we can
+        # see whether ComfyUI is still alive (HTTP port 8188 responding) even if
+        # the websocket dropped. This is extremely useful to differentiate
+        # between a network glitch and an outright ComfyUI crash/OOM-kill.
+        srv_status = comfy.server_status()
+        if not srv_status["reachable"]:
+            # If ComfyUI itself is down there is no point in retrying the websocket –
+            # bail out immediately so the caller gets a clear "ComfyUI crashed" error.
+            print(
+                f"worker-comfyui - ComfyUI HTTP unreachable – aborting websocket reconnect: {srv_status.get('error', 'status '+str(srv_status.get('status_code')))}"
+            )
+            raise websocket.WebSocketConnectionClosedException(
+                "ComfyUI HTTP unreachable during websocket reconnect"
+            )
+
+        # Otherwise we proceed with reconnect attempts while server is up
+        print(
+            f"worker-comfyui - Reconnect attempt {attempt + 1}/{max_attempts}... (ComfyUI HTTP reachable, status {srv_status.get('status_code')})"
+        )
+        try:
+            # Need to create a new socket object for reconnect
+            new_ws = websocket.WebSocket()
+            new_ws.connect(ws_url, timeout=10)  # Use existing ws_url
+            print(f"worker-comfyui - Websocket reconnected successfully.")
+            return new_ws  # Return the new connected socket
+        except (
+            websocket.WebSocketException,
+            ConnectionRefusedError,
+            socket.timeout,
+            OSError,
+        ) as reconn_err:
+            last_reconnect_error = reconn_err
+            print(
+                f"worker-comfyui - Reconnect attempt {attempt + 1} failed: {reconn_err}"
+            )
+            if attempt < max_attempts - 1:
+                print(
+                    f"worker-comfyui - Waiting {delay_s} seconds before next attempt..."
+                )
+                time.sleep(delay_s)
+            else:
+                print(f"worker-comfyui - Max reconnection attempts reached.")
+
+    # If loop completes without returning, raise an exception
+    print("worker-comfyui - Failed to reconnect websocket after connection closed.")
+    raise websocket.WebSocketConnectionClosedException(
+        f"Connection closed and failed to reconnect. Last error: {last_reconnect_error}"
+    )
+
+
+# ---------------------------------------------------------------------------
+# ComfyUI websocket dispatcher
+# ---------------------------------------------------------------------------
+
+# Seconds a job waits for a websocket message before re-checking its prompt
+# against /history and /queue (guards against messages lost on a dead socket)
+WEBSOCKET_RESYNC_INTERVAL_S = int(os.environ.get("WEBSOCKET_RESYNC_INTERVAL_S", 10))
+# Number of not-yet-subscribed prompts whose messages are buffered
+WEBSOCKET_UNCLAIMED_PROMPTS = 64
+
+
+class WebSocketDispatcher:
+    """
+    One long-lived ComfyUI websocket shared by every job of the worker.
+
+    A background thread receives all messages of our client id and routes the
+    ones that carry a ``prompt_id`` to the queue of the job that subscribed to
+    that prompt. Messages that arrive before the job subscribed (ComfyUI can
+    start executing before /prompt returned) are buffered and handed over on
+    :meth:`subscribe`.
+
+    Messages sent while the socket was down are lost, so after every reconnect
+    the subscribed prompts are reconciled with /history and /queue (see
+    :meth:`resync`); a prompt that finished in the meantime still completes.
+    If the connection cannot be re-established because ComfyUI is gone, every
+    subscriber receives a ``dispatcher_error`` message. The thread itself keeps
+    running across jobs and reconnects in the background.
+    """
+
+    def __init__(self, host):
+        self.client_id = str(uuid.uuid4())
+        self.ws_url = f"ws://{host}/ws?clientId={self.client_id}"
+        self._ws = None
+        self._thread = None
+        self._state = "connecting"
+        self._last_error = None
+        self._state_changed = threading.Condition()
+        self._lock = threading.Lock()
+        self._subscriptions = {}
+        self._unclaimed = collections.OrderedDict()
+
+    def ensure_connected(self):
+        """
+        Start the listener thread if needed and wait until the websocket is up.
+
+        Raises:
+            websocket.WebSocketException: If ComfyUI's websocket cannot be reached.
+        """
+        with self._state_changed:
+            if self._thread is None or not self._thread.is_alive():
+                self._state = "connecting"
+                self._thread = threading.Thread(
+                    target=self._run, name="comfy-websocket", daemon=True
+                )
+                self._thread.start()
+            self._state_changed.wait_for(lambda: self._state != "connecting")
+            if self._state == "failed":
+                raise websocket.WebSocketException(
+                    f"Websocket connection failed: {self._last_error}"
+                )
+
+    def subscribe(self, prompt_id):
+        """
+        Return a queue that receives every message of ``prompt_id`` in order.
+
+        Messages already received for the prompt are queued immediately.
+        """
+        messages = queue.Queue()
+        with self._lock:
+            for message in self._unclaimed.pop(prompt_id, []):
+                messages.put(message)
+            self._subscriptions[prompt_id] = messages
+        return messages
+
+    def unsubscribe(self, prompt_id):
+        with self._lock:
+            self._subscriptions.pop(prompt_id, None)
+
+    def resync(self, prompt_ids=None):
+        """
+        Reconcile subscribed prompts with ComfyUI's /queue and /history.
+
+        Prompts that are no longer queued get the message that would have ended
+        them on the websocket: ``executing`` with ``node=None`` on success or
+        the ``execution_error`` recorded in the history. A prompt that is
+        neither queued nor in the history was lost (e.g. ComfyUI restarted)
+        and gets a ``dispatcher_error``.
+
+        Args:
+            prompt_ids (list, optional): Prompts to check. Defaults to all subscribed prompts.
+        """
+        with self._lock:
+            if prompt_ids is None:
+                prompt_ids = list(self._subscriptions)
+            prompt_ids = [p for p in prompt_ids if p in self._subscriptions]
+        if not prompt_ids:
+            return
+
+        try:
+            queue_state = comfy.get_queue()
+            # The queue must be read before the history: a prompt leaves the
+            # queue and enters the history atomically.
+            active = {
+                item[1]
+                for key in ("queue_running", "queue_pending")
+                for item in queue_state.get(key, [])
+            }
+            for prompt_id in prompt_ids:
+                if prompt_id in active:
+                    continue
+                history = comfy.get_history(prompt_id)
+                if prompt_id in history:
+                    message = _completion_message(prompt_id, history[prompt_id])
+                    print(
+                        f"worker-comfyui - Resync: prompt {prompt_id} already finished ({message['type']})"
+                    )
+                else:
+                    message = {
+                        "type": "dispatcher_error",
+                        "data": {
+                            "message": f"Prompt {prompt_id} is neither queued nor in the ComfyUI history"
+                        },
+                    }
+                self._deliver(prompt_id, message)
+        except requests.RequestException as e:
+            print(f"worker-comfyui - Resync with /queue and /history failed: {e}")
+
+    def _deliver(self, prompt_id, message):
+        with self._lock:
+            messages = self._subscriptions.get(prompt_id)
+            if messages is not None:
+                messages.put(message)
+
+    def _set_state(self, state, error=None):
+        with self._state_changed:
+            self._state = state
+            self._last_error = error
+            self._state_changed.notify_all()
+
+    def _run(self):
+        error = None
+        while True:
+            try:
+                if self._ws is None:
+                    if error is None:
+                        print(
+                            f"worker-comfyui - Connecting to websocket: {self.ws_url}"
+                        )
+                        self._ws = websocket.WebSocket()
+                        self._ws.connect(self.ws_url, timeout=10)
+                        print(f"worker-comfyui - Websocket connected")
+                    else:
+                        # Raises WebSocketConnectionClosedException if reconnecting fails
+                        self._ws = _attempt_websocket_reconnect(
+                            self.ws_url,
+                            WEBSOCKET_RECONNECT_ATTEMPTS,
+                            WEBSOCKET_RECONNECT_DELAY_S,
+                            error,
+                        )
+                    self._set_state("connected")
+                    if error is not None:
+                        # Anything sent while we were disconnected is gone
+                        error = None
+                        self.resync()
+                out = self._ws.recv()
+            except websocket.WebSocketTimeoutException:
+                continue
+            except (websocket.WebSocketException, OSError) as e:
+                if self._ws is not None:
+                    self._ws.close()
+                    self._ws = None
+                    error = e
+                    continue
+                # Connecting failed as well: fail the waiting jobs, then keep trying
+                error = e
+                self._set_state("failed", e)
+                self._fail_subscribers(str(e))
+                time.sleep(WEBSOCKET_RECONNECT_DELAY_S)
+                continue
+
+            if isinstance(out, str):
+                self._dispatch(out)
+
+    def _dispatch(self, raw):
+        try:
+            message = json.loads(raw)
+        except json.JSONDecodeError:
+            print(f"worker-comfyui - Received invalid JSON message via websocket.")
+            return
+
+        data = message.get("data")
+        if not isinstance(data, dict):
+            return
+        if message.get("type") == "status":
+            status_data = data.get("status", {})
+            print(
+                f"worker-comfyui - Status update: {status_data.get('exec_info', {}).get('queue_remaining', 'N/A')} items remaining in queue"
+            )
+            return
+
+        prompt_id = data.get("prompt_id")
+        if not prompt_id:
+            return
+        # Subscribers may drain their queue late (e.g. batch prompts), so keep
+        # the arrival time for anything that measures durations
+        message["received_at"] = time.monotonic()
+        with self._lock:
+            messages = self._subscriptions.get(prompt_id)
+            if messages is not None:
+                messages.put(message)
+                return
+            self._unclaimed.setdefault(prompt_id, []).append(message)
+            while len(self._unclaimed) > WEBSOCKET_UNCLAIMED_PROMPTS:
+                self._unclaimed.popitem(last=False)
+
+    def _fail_subscribers(self, reason):
+        with self._lock:
+            for messages in self._subscriptions.values():
+                messages.put({"type": "dispatcher_error", "data": {"message": reason}})
+
+
+def _completion_message(prompt_id, history_entry):
+    """
+    Build the websocket message that ends a prompt from its /history entry.
+    """
+    status = history_entry.get("status") or {}
+    for message_type, data in status.get("messages", []):
+        if message_type == "execution_error":
+            return {"type": "execution_error", "data": data}
+        if message_type == "execution_interrupted":
+            return {
+                "type": "execution_error",
+                "data": {**data, "exception_message": "Execution was interrupted"},
+            }
+    if status.get("status_str") == "error":
+        return {
+            "type": "execution_error",
+            "data": {"prompt_id": prompt_id, "exception_message": "Execution failed"},
+        }
+    return {"type": "executing", "data": {"node": None, "prompt_id": prompt_id}}
+
+
+# Shared websocket used by every handler call
+dispatcher = WebSocketDispatcher(COMFY_HOST)
+
+
+# ---------------------------------------------------------------------------
+# Node definition index and pre-flight workflow validation
+# ---------------------------------------------------------------------------
+
+# Seconds before the cached /object_info index is refreshed in the background
+OBJECT_INFO_TTL_S = int(os.environ.get("OBJECT_INFO_TTL_S", 300))
+# Minimum seconds between forced refreshes triggered by an unknown model or node
+OBJECT_INFO_MIN_REFRESH_S = 30
+# Reject workflows with unknown node types or missing models before uploading
+# anything to ComfyUI (set PREFLIGHT_VALIDATION=false to disable)
+PREFLIGHT_VALIDATION = os.environ.get("PREFLIGHT_VALIDATION", "true").lower() == "true"
+# Model inputs checked by the pre-flight validation: class_type → input → model folder
+MODEL_LOADER_INPUTS = {
+    "CheckpointLoaderSimple": {"ckpt_name": "checkpoints"},
+    "UNETLoader": {"unet_name": "diffusion_models"},
+    "CLIPLoader": {"clip_name": "text_encoders"},
+    "VAELoader": {"vae_name": "vae"},
+    "LoraLoader": {"lora_name": "loras"},
+    "LoraLoaderModelOnly": {"lora_name": "loras"},
+}
+# rgthree's Power Lora Loader takes any number of "lora_N" inputs shaped like
+# {"on": bool, "lora": name, "strength": float}. It has no combo input listing
+# the loras, so they are checked against the "loras" folder of the loaders above.
+POWER_LORA_LOADER = "Power Lora Loader (rgthree)"
+
+
+def _model_hint(workflow, node_ids):
+    """
+    List the models available to the model loaders among ``node_ids``.
+
+    Used to make ComfyUI's validation errors for missing models actionable,
+    whatever kind of model the failing loader takes.
+
+    Returns:
+        str: One line per model folder the nodes load from, or "" if none of
+        them is a known model loader.
+    """
+    folders = set()
+    for node_id in node_ids:
+        node = workflow.get(str(node_id))
+        if not isinstance(node, dict):
+            continue
+        if node.get("class_type") == POWER_LORA_LOADER:
+            folders.add("loras")
+        folders.update(MODEL_LOADER_INPUTS.get(node.get("class_type"), {}).values())
+    if not folders:
+        return ""
+    available_models = object_info_index.available_models()
+    lines = []
+    for folder in sorted(folders):
+        if available_models.get(folder):
+            lines.append(
+                f"Available {folder} models: {', '.join(available_models[folder])}"
+            )
+        else:
+            lines.append(
+                f"No {folder} models appear to be available. Please check your model installation."
+            )
+    return "\n".join(lines)
+
+
+def _node_models(node):
+    """Return the names of the model files a node loads, if it is a model loader."""
+    inputs = node.get("inputs") or {}
+    if node.get("class_type") == POWER_LORA_LOADER:
+        return [
+            value["lora"]
+            for key, value in inputs.items()
+            if key.startswith("lora_") and isinstance(value, dict) and value.get("on")
+        ]
+    return [
+        inputs[input_name]
+        for input_name in MODEL_LOADER_INPUTS.get(node.get("class_type"), {})
+        if isinstance(inputs.get(input_name), str)
+    ]
+
+
+def _combo_options(node_info, input_name):
+    """
+    Return the choices of a combo input from a node definition, or None.
+
+    Handles both the legacy format ``[["a", "b"], {...}]`` and the newer
+    ``["COMBO", {"options": ["a", "b"]}]`` format.
+    """
+    inputs = node_info.get("input") or {}
+    spec = (inputs.get("required") or {}).get(input_name) or (
+        inputs.get("optional") or {}
+    ).get(input_name)
+    if not spec:
+        return None
+    if isinstance(spec[0], list):
+        return spec[0]
+    if spec[0] == "COMBO" and len(spec) > 1 and isinstance(spec[1], dict):
+        return spec[1].get("options")
+    return None
+
+
+class ObjectInfoIndex:
+    """
+    Cached index of the node types and model files available in ComfyUI.
+
+    /object_info is large and slow to build on big installs, so only the parts
+    needed for validation are kept: the set of known class_types and, per model
+    folder, the set of model names. The index is refreshed in the background
+    once it is older than ``ttl_s``; a workflow that references something
+    unknown forces a synchronous refresh (at most every
+    OBJECT_INFO_MIN_REFRESH_S seconds) so models added after the last refresh
+    are picked up.
+    """
+
+    def __init__(self, client, ttl_s=OBJECT_INFO_TTL_S):
+        self.client = client
+        self.ttl_s = ttl_s
+        self._lock = threading.Lock()
+        self._node_types = None
+        self._models = {}
+        self._fetched_at = 0.0
+        self._refreshing = False
+
+    def refresh(self):
+        """
+        Fetch /object_info and rebuild the index.
+
+        Returns:
+            bool: True if the index was rebuilt, False if ComfyUI could not be reached.
+        """
+        try:
+            object_info = self.client.get_object_info()
+        except (requests.RequestException, ValueError) as e:
+            print(f"worker-comfyui - Warning: Could not fetch object info: {e}")
+            return False
+
+        models = {}
+        for class_type, model_inputs in MODEL_LOADER_INPUTS.items():
+            node_info = object_info.get(class_type)
+            if not node_info:
+                continue
+            for input_name, folder in model_inputs.items():
+                options = _combo_options(node_info, input_name)
+                if options is not None:
+                    models.setdefault(folder, set()).update(options)
+
+        with self._lock:
+            self._node_types = frozenset(object_info)
+            self._models = models
+            self._fetched_at = time.monotonic()
+        print(
+            f"worker-comfyui - Indexed {len(object_info)} node types and "
+            f"{sum(len(names) for names in models.values())} models"
+        )
+        return True
+
+    def _refresh_in_background(self):
+        try:
+            self.refresh()
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    def _ensure_fresh(self):
+        """Load the index on first use and schedule a refresh once it is stale."""
+        with self._lock:
+            loaded = self._node_types is not None
+            stale = time.monotonic() - self._fetched_at > self.ttl_s
+            if loaded and stale and not self._refreshing:
+                self._refreshing = True
+                threading.Thread(
+                    target=self._refresh_in_background,
+                    name="object-info-refresh",
+                    daemon=True,
+                ).start()
+        if not loaded:
+            self.refresh()
+
+    def available_models(self):
+        """
+        Return the available model names per model folder.
+
+        Returns:
+            dict: Folder name (e.g. "checkpoints") → sorted list of model names.
+        """
+        self._ensure_fresh()
+        with self._lock:
+            return {folder: sorted(names) for folder, names in self._models.items()}
+
+    def _find_problems(self, workflow):
+        """Return (problems, missing_folders) for ``workflow`` against the current index."""
+        problems = []
+        missing_folders = set()
+        with self._lock:
+            node_types = self._node_types
+            models = self._models
+
+        def check_model(node_id, class_type, input_name, folder, name):
+            # Linked inputs ([node_id, slot]) are only known at execution time
+            if not isinstance(name, str) or folder not in models:
+                return
+            if name not in models[folder]:
+                problems.append(
+                    f"Node {node_id} ({class_type}): {input_name} '{name}' "
+                    f"not found in models/{folder}"
+                )
+                missing_folders.add(folder)
+
+        for node_id, node in workflow.items():
+            if not isinstance(node, dict) or "class_type" not in node:
+                problems.append(f"Node {node_id}: missing 'class_type'")
+                continue
+            class_type = node["class_type"]
+            inputs = node.get("inputs") or {}
+            if class_type not in node_types:
+                problems.append(
+                    f"Node {node_id}: unknown node type '{class_type}' "
+                    "(custom node not installed?)"
+                )
+                continue
+            for input_name, folder in MODEL_LOADER_INPUTS.get(class_type, {}).items():
+                check_model(
+                    node_id, class_type, input_name, folder, inputs.get(input_name)
+                )
+            if class_type == POWER_LORA_LOADER:
+                for input_name, value in inputs.items():
+                    if (
+                        input_name.startswith("lora_")
+                        and isinstance(value, dict)
+                        and value.get("on")
+                    ):
+                        check_model(
+                            node_id,
+                            class_type,
+                            input_name,
+                            "loras",
+                            value.get("lora"),
+                        )
+        return problems, missing_folders
+
+    def validate_workflow(self, workflow):
+        """
+        Check a workflow for unknown node types and missing model files.
+
+        Args:
+            workflow (dict): The workflow in ComfyUI API format.
+
+        Returns:
+            str | None: A description of every problem found, or None if the
+            workflow looks runnable. Also None if ComfyUI could not be reached,
+            in which case validation is left to ComfyUI itself.
+        """
+        self._ensure_fresh()
+        if self._node_types is None:
+            print(
+                "worker-comfyui - Object info unavailable, skipping pre-flight validation"
+            )
+            return None
+
+        problems, missing_folders = self._find_problems(workflow)
+        if problems:
+            with self._lock:
+                can_refresh = (
+                    time.monotonic() - self._fetched_at > OBJECT_INFO_MIN_REFRESH_S
+                )
+            # The model or custom node may have been added after the last refresh
+            if can_refresh and self.refresh():
+                problems, missing_folders = self._find_problems(workflow)
+        if not problems:
+            return None
+
+        message = "Workflow validation failed:\n" + "\n".join(
+            f"• {problem}" for problem in problems
+        )
+        available = self.available_models()
+        for folder in sorted(missing_folders):
+            names = available.get(folder)
+            if names:
+                message += f"\n\nAvailable models in {folder}: {', '.join(names)}"
+            else:
+                message += f"\n\nNo models appear to be available in {folder}."
+        return message
+
+
+object_info_index = ObjectInfoIndex(comfy)
+
+
+# ---------------------------------------------------------------------------
+# Job payload decoding: compressed envelopes and images by reference
+# ---------------------------------------------------------------------------
+
+# Input fields that may be sent as a compressed envelope:
+#   {"encoding": "gzip" | "zstd", "data": "<base64 of the compressed JSON>"}
+ENVELOPE_FIELDS = ("workflow", "workflows", "images")
+# Largest decompressed envelope in MB, guarding against decompression bombs
+ENVELOPE_MAX_MB = float(os.environ.get("ENVELOPE_MAX_MB", 256))
+# Keys an entry of 'images' can carry its image in: inline base64, an
+# http(s) URL, or a file on a mounted volume
+IMAGE_SOURCES = ("image", "url", "path")
+# Directories images given as a 'path' may be read from (comma separated)
+IMAGE_PATH_ROOTS = [
+    os.path.realpath(root.strip())
+    for root in os.environ.get("IMAGE_PATH_ROOTS", "/runpod-volume,/workspace").split(
+        ","
+    )
+    if root.strip()
+]
+# Number of 'url'/'path' images fetched in parallel
+IMAGE_FETCH_CONCURRENCY = int(os.environ.get("IMAGE_FETCH_CONCURRENCY", 4))
+# Timeout in seconds for fetching one image by URL
+IMAGE_FETCH_TIMEOUT_S = int(os.environ.get("IMAGE_FETCH_TIMEOUT_S", 30))
+# Largest image accepted from a URL or path, in MB
+IMAGE_FETCH_MAX_MB = float(os.environ.get("IMAGE_FETCH_MAX_MB", 64))
+
+
+def _decode_envelope(value, field):
+    """
+    Return the JSON value carried by a compressed envelope.
+
+    Values that are not an envelope are returned unchanged.
+
+    Raises:
+        ValueError: If the envelope is malformed, too large or uses an
+            unavailable encoding.
+    """
+    if not isinstance(value, dict) or set(value) != {"encoding", "data"}:
+        return value
+
+    encoding = value["encoding"]
+    if encoding not in ("gzip", "zstd"):
+        raise ValueError(f"'{field}' envelope encoding must be 'gzip' or 'zstd'")
+    if encoding == "zstd" and zstd is None:
+        raise ValueError(
+            f"'{field}' is zstd compressed but zstd is not available on this worker, use gzip"
+        )
+    try:
+        compressed = io.BytesIO(base64.b64decode(value["data"]))
+    except (base64.binascii.Error, TypeError) as e:
+        raise ValueError(f"'{field}' envelope data is not valid base64: {e}")
+
+    limit = int(ENVELOPE_MAX_MB * 1024 * 1024)
+    try:
+        if encoding == "gzip":
+            stream = gzip.GzipFile(fileobj=compressed)
+        else:
+            stream = zstd.ZstdFile(compressed)
+        with stream:
+            data = stream.read(limit + 1)
+    except Exception as e:
+        raise ValueError(f"Could not decompress '{field}': {e}")
+    if len(data) > limit:
+        raise ValueError(f"'{field}' decompresses to more than {ENVELOPE_MAX_MB:g} MB")
+
+    try:
+        return json.loads(data)
+    except ValueError as e:
+        raise ValueError(f"'{field}' envelope does not contain valid JSON: {e}")
+
+
+def _resolve_image_path(path):
+    """Return the real path of ``path`` if it lies under IMAGE_PATH_ROOTS, else None."""
+    real_path = os.path.realpath(path)
+    for root in IMAGE_PATH_ROOTS:
+        if os.path.commonpath([real_path, root]) == root:
+            return real_path
+    return None
+
+
+def _check_image_reference(image):
+    """Return an error message if an 'images' entry points somewhere it must not."""
+    name = image["name"]
+    if "url" in image:
+        scheme = urllib.parse.urlparse(str(image["url"])).scheme
+        if scheme not in ("http", "https"):
+            return f"Image '{name}': 'url' must be an http(s) URL"
+    elif "path" in image:
+        if not isinstance(image["path"], str) or not _resolve_image_path(image["path"]):
+            return (
+                f"Image '{name}': 'path' must be inside one of: "
+                f"{', '.join(IMAGE_PATH_ROOTS)}"
+            )
+    return None
+
+
+def _fetch_image(session, image):
+    """
+    Read an image given by 'url' or 'path'.
+
+    Returns:
+        bytes: The image.
+
+    Raises:
+        ValueError: If the image is larger than IMAGE_FETCH_MAX_MB.
+        OSError, requests.RequestException: If it could not be read.
+    """
+    limit = int(IMAGE_FETCH_MAX_MB * 1024 * 1024)
+    if "path" in image:
+        path = _resolve_image_path(image["path"])
+        if path is None:
+            raise ValueError(f"'{image['path']}' is outside of the allowed roots")
+        if os.path.getsize(path) > limit:
+            raise ValueError(f"larger than {IMAGE_FETCH_MAX_MB:g} MB")
+        with open(path, "rb") as f:
+            return f.read()
+
+    with session.get(
+        image["url"], stream=True, timeout=IMAGE_FETCH_TIMEOUT_S
+    ) as response:
+        response.raise_for_status()
+        content = bytearray()
+        for chunk in response.iter_content(chunk_size=1024 * 1024):
+            content += chunk
+            if len(content) > limit:
+                raise ValueError(f"larger than {IMAGE_FETCH_MAX_MB:g} MB")
+        return bytes(content)
+
+
+def prefetch_images(images, concurrency=IMAGE_FETCH_CONCURRENCY):
+    """
+    Fetch every 'url' and 'path' image of a job in parallel.
+
+    Args:
+        images (list): The validated 'images' entries.
+        concurrency (int, optional): Maximum number of fetches in flight.
+
+    Returns:
+        tuple: (images, errors). Referenced entries are replaced by
+        ``{"name": ..., "image": <bytes>}``; inline entries are kept as they are.
+    """
+    references = [image for image in images if "image" not in image]
+    if not references:
+        return images, []
+
+    print(
+        f"worker-comfyui - Fetching {len(references)} referenced image(s) (concurrency {concurrency})..."
+    )
+    fetched = {}
+    errors = []
+    with requests.Session() as session, ThreadPoolExecutor(
+        max_workers=max(1, min(concurrency, len(references))),
+        thread_name_prefix="image-fetch",
+    ) as pool:
+        futures = {
+            id(image): pool.submit(_fetch_image, session, image) for image in references
+        }
+        for image in references:
+            source = image.get("url") or image.get("path")
+            try:
+                fetched[id(image)] = futures[id(image)].result()
+            except (ValueError, OSError, requests.RequestException) as e:
+                error_msg = f"Error fetching image '{image['name']}' from {source}: {e}"
+                print(f"worker-comfyui - {error_msg}")
+                errors.append(error_msg)
+
+    return [
+        (
+            {"name": image["name"], "image": fetched[id(image)]}
+            if id(image) in fetched
+            else image
+        )
+        for image in images
+    ], errors
+
+
+def _connect_in_background():
+    """Open the shared websocket early; failures surface when the prompt is queued."""
+    try:
+        dispatcher.ensure_connected()
+    except Exception as e:
+        print(f"worker-comfyui - Early websocket connect failed: {e}")
+
+
+def validate_input(job_input):
+    """
+    Validates the input for the handler function.
+
+    Args:
+        job_input (dict): The input data to validate.
+
+    Returns:
+        tuple: A tuple containing the validated data and an error message, if any.
+               The structure is (validated_data, error_message).
+    """
+    # Validate if job_input is provided
+    if job_input is None:
+        return None, "Please provide input"
+
+    # Check if input is a string and try to parse it as JSON
+    if isinstance(job_input, str):
+        try:
+            job_input = json.loads(job_input)
+        except json.JSONDecodeError:
+            return None, "Invalid JSON format in input"
+
+    # Unpack compressed payload envelopes
+    job_input = dict(job_input)
+    for field in ENVELOPE_FIELDS:
+        if field in job_input:
+            try:
+                job_input[field] = _decode_envelope(job_input[field], field)
+            except ValueError as e:
+                return None, str(e)
+
+    # Validate 'workflow' or the 'workflows' of a batch in input
+    workflow = job_input.get("workflow")
+    workflows = job_input.get("workflows")
+    if workflow is not None and workflows is not None:
+        return None, "Provide either 'workflow' or 'workflows', not both"
+    if workflows is not None:
+        if (
+            not isinstance(workflows, list)
+            or not workflows
+            or not all(isinstance(w, dict) for w in workflows)
+        ):
+            return None, "'workflows' must be a non-empty list of workflow objects"
+        if len(workflows) > BATCH_MAX_WORKFLOWS:
+            return (
+                None,
+                f"'workflows' holds {len(workflows)} workflows, the maximum is {BATCH_MAX_WORKFLOWS}",
+            )
+    elif workflow is None:
+        return None, "Missing 'workflow' parameter"
+
+    # Expand a parameter sweep over the workflow template into a batch
+    sweep = job_input.get("sweep")
+    sweep_params = None
+    if sweep is not None:
+        if not isinstance(workflow, dict):
+            return None, "'sweep' requires a single 'workflow' template"
+        workflows, sweep_params, sweep_error = expand_sweep(workflow, sweep)
+        if sweep_error:
+            return None, sweep_error
+        workflow = None
+
+    # Validate 'images' in input, if provided
+    images = job_input.get("images")
+    if images is not None:
+        if not isinstance(images, list) or not all(
+            isinstance(image, dict)
+            and "name" in image
+            and sum(source in image for source in IMAGE_SOURCES) == 1
+            for image in images
+        ):
+            return (
+                None,
+                "'images' must be a list of objects with a 'name' and one of "
+                "'image' (base64), 'url' or 'path'",
+            )
+        for image in images:
+            reference_error = _check_image_reference(image)
+            if reference_error:
+                return None, reference_error
+
+    # Validate output options, if provided
+    output_mode = job_input.get("output_mode", "auto")
+    if output_mode not in OUTPUT_MODES:
+        return None, f"'output_mode' must be one of: {', '.join(OUTPUT_MODES)}"
+
+    output_budget_mb = job_input.get("output_budget_mb", OUTPUT_BUDGET_MB)
+    if (
+        not isinstance(output_budget_mb, (int, float))
+        or isinstance(output_budget_mb, bool)
+        or output_budget_mb < 0
+    ):
+        return None, "'output_budget_mb' must be a non-negative number"
+
+    output_format = job_input.get("output_format")
+    if output_format is not None:
+        output_format, format_error = _validate_output_format(output_format)
+        if format_error:
+            return None, format_error
+
+    use_cache = job_input.get("cache", True)
+    if not isinstance(use_cache, bool):
+        return None, "'cache' must be a boolean"
+
+    return_timings = job_input.get("timings", False)
+    if not isinstance(return_timings, bool):
+        return None, "'timings' must be a boolean"
+
+    timeout_s = job_input.get("timeout_s", JOB_TIMEOUT_S)
+    if (
+        not isinstance(timeout_s, (int, float))
+        or isinstance(timeout_s, bool)
+        or timeout_s < 0
+    ):
+        return None, "'timeout_s' must be a non-negative number"
+
+    # Check node types and models against ComfyUI before anything is uploaded
+    if PREFLIGHT_VALIDATION and workflows is not None:
+        for index, batch_workflow in enumerate(workflows):
+            validation_error = object_info_index.validate_workflow(batch_workflow)
+            if validation_error:
+                return None, f"Workflow {index}: {validation_error}"
+    elif PREFLIGHT_VALIDATION and isinstance(workflow, dict):
+        validation_error = object_info_index.validate_workflow(workflow)
+        if validation_error:
+            return None, validation_error
+
+    # Return validated data and no error
+    workflow_input = {"workflow": workflow}
+    if workflows is not None:
+        workflow_input = {"workflows": workflows}
+    if sweep_params is not None:
+        workflow_input["sweep_params"] = sweep_params
+    return {
+        **workflow_input,
+        "images": images,
+        "output_mode": output_mode,
+        "output_budget_mb": output_budget_mb,
+        "output_format": output_format,
+        "cache": use_cache,
+        "timings": return_timings,
+        "timeout_s": timeout_s,
+    }, None
+
+
+# ---------------------------------------------------------------------------
+# Job timing
+# ---------------------------------------------------------------------------
+
+
+class JobTimer:
+    """
+    Monotonic timing spans for the stages of one job.
+
+    Spans sharing a name are summed and counted, so stages that run once per
+    output on the output pool (e.g. "output_base64") report their total busy
+    time. Per-node execution times are taken from the prompt monitors.
+    """
+
+    def __init__(self, job_id):
+        self.job_id = job_id
+        # Set once the input asked for the timings to be returned
+        self.requested = False
+        self.nodes = []
+        self._started = time.monotonic()
+        self._spans = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds):
+        with self._lock:
+            span = self._spans.setdefault(name, [0.0, 0])
+            span[0] += seconds
+            span[1] += 1
+
+    @contextlib.contextmanager
+    def span(self, name):
+        """Time the body of a ``with`` block as the stage ``name``."""
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add(name, time.monotonic() - started)
+
+    def add_prompt(self, monitor, index=None):
+        """
+        Record the queue wait, execution time and node durations of a finished prompt.
+
+        Args:
+            monitor (_PromptMonitor): The monitor that followed the prompt.
+            index (int, optional): Position of the workflow in a batch job.
+        """
+        finished = monitor.finished_at or time.monotonic()
+        started = monitor.started_at or finished
+        self.add("queue_wait", started - monitor.queued_at)
+        self.add("execute", finished - started)
+        nodes = []
+        for node_id, seconds in monitor.node_timings.items():
+            node = monitor.workflow.get(node_id)
+            entry = {
+                "node_id": node_id,
+                "class_type": (
+                    node.get("class_type") if isinstance(node, dict) else None
+                ),
+                "seconds": round(seconds, 4),
+            }
+            if index is not None:
+                entry["index"] = index
+            nodes.append(entry)
+        with self._lock:
+            self.nodes.extend(nodes)
+
+    def summary(self):
+        """Return the recorded timings, as included in job results."""
+        with self._lock:
+            stages = {
+                name: {"seconds": round(seconds, 4), "count": count}
+                for name, (seconds, count) in self._spans.items()
+            }
+            nodes = list(self.nodes)
+        return {
+            "total_seconds": round(time.monotonic() - self._started, 4),
+            "stages": stages,
+            "nodes": nodes,
+        }
+
+    def log(self):
+        """Print the timings as one JSON line for log processing."""
+        if TIMINGS_LOG:
+            print(
+                json.dumps(
+                    {"event": "job_timings", "job_id": self.job_id, **self.summary()}
+                )
+            )
+
+
+# ---------------------------------------------------------------------------
+# Output stage: fetch → encode / upload, pipelined across outputs
+# ---------------------------------------------------------------------------
+
+# Number of outputs fetched, encoded and uploaded in parallel
+OUTPUT_CONCURRENCY = int(os.environ.get("OUTPUT_CONCURRENCY", 4))
+# Presigned bucket URLs stay valid for 7 days (same as rp_upload)
+BUCKET_URL_EXPIRY_S = 604800
+# Multipart upload tuning. Streams are uploaded in parts of this size, so a
+# single upload buffers at most chunk size × concurrency bytes no matter how
+# large the video is.
+BUCKET_MULTIPART_CHUNK_MB = int(os.environ.get("BUCKET_MULTIPART_CHUNK_MB", 16))
+BUCKET_MULTIPART_CONCURRENCY = int(os.environ.get("BUCKET_MULTIPART_CONCURRENCY", 4))
+# Per-job budget in MB for outputs returned inline as base64 (0 = unlimited).
+# Outputs that would exceed it are uploaded to the bucket when one is
+# configured, otherwise they are left out and reported in "errors".
+OUTPUT_BUDGET_MB = float(os.environ.get("OUTPUT_BUDGET_MB", 100))
+# Raw bytes base64 encoded per step (multiple of 3 so chunks concatenate cleanly)
+BASE64_ENCODE_CHUNK_BYTES = 3 * 1024 * 1024
+# How outputs are returned:
+#   • auto   – bucket upload when BUCKET_ENDPOINT_URL is set, base64 otherwise
+#   • base64 – inline base64, using the bucket only for outputs over the budget
+OUTPUT_MODES = ("auto", "base64")
+# Output keys that carry files, mapped to the result list they are returned in.
+# VHS_VideoCombine reports its videos/animations under "gifs".
+OUTPUT_FILE_KEYS = {"images": "images", "gifs": "videos", "videos": "videos"}
+# Output keys that only describe the files of another key
+OUTPUT_META_KEYS = ("animated",)
+# Formats images can be transcoded to with 'output_format' (requires Pillow):
+# name → (Pillow format, file extension, Pillow feature providing the encoder)
+OUTPUT_IMAGE_FORMATS = {
+    "webp": ("WEBP", ".webp", "webp"),
+    "jpeg": ("JPEG", ".jpg", "jpg"),
+    "avif": ("AVIF", ".avif", "avif"),
+}
+# Default encoder quality for transcoded images (1-100)
+OUTPUT_IMAGE_QUALITY = int(os.environ.get("OUTPUT_IMAGE_QUALITY", 85))
+# Image outputs that are transcoded; anything else is returned as written
+TRANSCODE_SOURCE_EXTENSIONS = (
+    ".png",
+    ".jpg",
+    ".jpeg",
+    ".webp",
+    ".bmp",
+    ".tif",
+    ".tiff",
+)
+# Threads encoding images. Pillow releases the GIL while coding, so this bounds
+# CPU use while the output pool keeps fetching and uploading.
+OUTPUT_TRANSCODE_WORKERS = int(
+    os.environ.get("OUTPUT_TRANSCODE_WORKERS", os.cpu_count() or 4)
+)
+
+# ComfyUI installation directory, exported by start.sh. Outputs are read from
+# its output/temp directories instead of being downloaded from /view.
+COMFYUI_DIR = os.environ.get("COMFYUI_DIR", "")
+# Read outputs straight from disk when ComfyUI shares the filesystem (set
+# LOCAL_OUTPUT_ACCESS=false to always go through /view)
+LOCAL_OUTPUT_ACCESS = os.environ.get("LOCAL_OUTPUT_ACCESS", "true").lower() == "true"
+# ComfyUI file types that can be read from disk: type → directory
+COMFY_FILE_DIRS = {
+    file_type: os.path.join(COMFYUI_DIR, file_type)
+    for file_type in ("output", "temp", "input")
+}
+
+_transcode_pool = ThreadPoolExecutor(
+    max_workers=OUTPUT_TRANSCODE_WORKERS, thread_name_prefix="comfy-transcode"
+)
+
+_bucket_client = None
+_bucket_client_lock = threading.Lock()
+
+
+def _get_bucket_client():
+    """
+    Return the (boto client, transfer config) pair for the configured bucket.
+
+    rp_upload builds a new boto session on every call; creating it once and
+    sharing it (boto clients are thread-safe) keeps that cost off every output.
+    The client is None when the bucket credentials are incomplete.
+    """
+    global _bucket_client
+    with _bucket_client_lock:
+        if _bucket_client is None:
+            boto_client, _ = rp_upload.get_boto_client()
+            transfer_config = TransferConfig(
+                multipart_threshold=BUCKET_MULTIPART_CHUNK_MB * 1024 * 1024,
+                multipart_chunksize=BUCKET_MULTIPART_CHUNK_MB * 1024 * 1024,
+                max_concurrency=BUCKET_MULTIPART_CONCURRENCY,
+                use_threads=True,
+            )
+            _bucket_client = (boto_client, transfer_config)
+        return _bucket_client
+
+
+class _OutputPolicy:
+    """
+    Per-job settings and state of the output stage.
+
+    Tracks how much of the inline (base64) output budget has been used. The
+    budget is shared by every output of the job, including outputs processed
+    by different pool workers or streamed in several batches. Time spent on
+    each output is recorded on the job's timer. ``output_format`` holds the
+    validated 'output_format' option, or None to return images as written.
+    """
+
+    def __init__(
+        self,
+        job_id,
+        output_mode="auto",
+        output_budget_mb=OUTPUT_BUDGET_MB,
+        timer=None,
+        output_format=None,
+    ):
+        self.job_id = job_id
+        self.timer = timer or JobTimer(job_id)
+        self.output_format = output_format
+        self.bucket_available = bool(os.environ.get("BUCKET_ENDPOINT_URL"))
+        self.use_bucket = output_mode == "auto" and self.bucket_available
+        self.budget_bytes = int(output_budget_mb * 1024 * 1024)
+        self.used_bytes = 0
+        self._lock = threading.Lock()
+
+    def reserve(self, size):
+        """Claim ``size`` bytes of the inline budget; return False if they do not fit."""
+        with self._lock:
+            if self.budget_bytes and self.used_bytes + size > self.budget_bytes:
+                return False
+            self.used_bytes += size
+            return True
+
+    def release(self, size):
+        """Give back budget claimed by :meth:`reserve`."""
+        with self._lock:
+            self.used_bytes -= size
+
+
+def _base64_length(size):
+    return (size + 2) // 3 * 4
+
+
+def _encode_base64_stream(chunks, policy, size=None):
+    """
+    Base64 encode an output chunk by chunk within the job budget.
+
+    Chunks are encoded into a single growing buffer instead of materialising
+    the raw bytes, their encoded copy and the final string all at once. Budget
+    claimed for the output is given back if it does not fit or reading fails.
+
+    Args:
+        chunks (iterable): The raw bytes, in pieces of any size.
+        policy (_OutputPolicy): The job's output policy.
+        size (int, optional): Total number of raw bytes, if known.
+
+    Returns:
+        str: The base64 string, or None if the output does not fit in the budget.
+    """
+    reserved = 0
+    if size is not None:
+        # Claim the whole output up front so nothing is read if it cannot fit
+        reserved = _base64_length(size)
+        if not policy.reserve(reserved):
+            return None
+
+    encoded = bytearray()
+
+    def claim(piece):
+        nonlocal reserved
+        needed = len(encoded) + len(piece)
+        if needed > reserved:
+            if not policy.reserve(needed - reserved):
+                return False
+            reserved = needed
+        return True
+
+    result = None
+    try:
+        carry = b""
+        for chunk in chunks:
+            if carry:
+                chunk = carry + chunk
+            usable = len(chunk) - len(chunk) % 3
+            carry = chunk[usable:]
+            if usable:
+                piece = base64.b64encode(memoryview(chunk)[:usable])
+                if not claim(piece):
+                    return None
+                encoded += piece
+        piece = base64.b64encode(carry)
+        if not claim(piece):
+            return None
+        encoded += piece
+        result = encoded.decode("ascii")
+        return result
+    finally:
+        policy.release(reserved - len(result) if result is not None else reserved)
+
+
+def _upload_stream_to_bucket(job_id, filename, stream):
+    """
+    Upload a readable stream or a local file to the bucket and return a presigned URL.
+
+    Objects are stored as ``<job_id>/<random>.<ext>`` in the ``%m-%y`` bucket,
+    the same layout rp_upload.upload_image produces, but the bytes go straight
+    from the stream into the upload instead of through a temporary file.
+    Anything above the multipart threshold is sent as a streamed multipart
+    upload, so large videos never have to fit in memory. Local files are
+    handed to boto's ``upload_file``, which reads the parts from disk in
+    parallel.
+
+    Args:
+        job_id (str): The job the output belongs to.
+        filename (str): Original output filename, used for extension and content type.
+        stream: A binary file-like object positioned at the start of the data,
+            or the path of a local file.
+
+    Returns:
+        str: The presigned URL (or local path when no bucket client is configured).
+    """
+    file_extension = os.path.splitext(filename)[1] or ".png"
+    object_name = f"{str(uuid.uuid4())[:8]}{file_extension}"
+    content_type = mimetypes.guess_type(filename)[
+        0
+    ] or "image/" + file_extension.lstrip(".")
+
+    boto_client, transfer_config = _get_bucket_client()
+    if boto_client is None:
+        # Mirror rp_upload's behaviour when the credentials are missing
+        print(
+            "worker-comfyui - Bucket credentials incomplete, saving output to 'simulated_uploaded'"
+        )
+        os.makedirs("simulated_uploaded", exist_ok=True)
+        location = os.path.join("simulated_uploaded", object_name)
+        if isinstance(stream, str):
+            shutil.copyfile(stream, location)
+            return location
+        with open(location, "wb") as file_output:
+            shutil.copyfileobj(stream, file_output)
+        return location
+
+    bucket = time.strftime("%m-%y")
+    key = f"{job_id}/{object_name}"
+    upload = (
+        boto_client.upload_file
+        if isinstance(stream, str)
+        else boto_client.upload_fileobj
+    )
+    upload(
+        stream,
+        bucket,
+        key,
+        ExtraArgs={"ContentType": content_type},
+        Config=transfer_config,
+    )
+    return boto_client.generate_presigned_url(
+        "get_object",
+        Params={"Bucket": bucket, "Key": key},
+        ExpiresIn=BUCKET_URL_EXPIRY_S,
+    )
+
+
+def _validate_output_format(output_format):
+    """
+    Normalise the 'output_format' job option.
+
+    Accepts a format name (e.g. ``"webp"``) or an object with "format" and the
+    optional "quality" (1-100), "max_dimension" and "thumbnail" (longest side
+    in pixels).
+
+    Returns:
+        tuple: (options dict or None, error message or None)
+    """
+    if isinstance(output_format, str):
+        output_format = {"format": output_format}
+    if not isinstance(output_format, dict):
+        return None, "'output_format' must be a format name or an object"
+    unknown = set(output_format) - {"format", "quality", "max_dimension", "thumbnail"}
+    if unknown:
+        return None, f"Unknown 'output_format' option(s): {', '.join(sorted(unknown))}"
+
+    name = output_format.get("format")
+    if name not in OUTPUT_IMAGE_FORMATS:
+        return (
+            None,
+            f"'output_format.format' must be one of: {', '.join(OUTPUT_IMAGE_FORMATS)}",
+        )
+    if Image is None:
+        return None, "'output_format' requires Pillow, which is not installed"
+    if not pil_features.check(OUTPUT_IMAGE_FORMATS[name][2]):
+        return None, f"This Pillow build cannot encode {name}"
+
+    options = {
+        "format": name,
+        "quality": output_format.get("quality", OUTPUT_IMAGE_QUALITY),
+        "max_dimension": output_format.get("max_dimension"),
+        "thumbnail": output_format.get("thumbnail"),
+    }
+    quality = options["quality"]
+    if not isinstance(quality, int) or isinstance(quality, bool):
+        return None, "'output_format.quality' must be an integer between 1 and 100"
+    if not 1 <= quality <= 100:
+        return None, "'output_format.quality' must be an integer between 1 and 100"
+    for key in ("max_dimension", "thumbnail"):
+        value = options[key]
+        if value is not None and (
+            not isinstance(value, int) or isinstance(value, bool) or value < 1
+        ):
+            return None, f"'output_format.{key}' must be a positive integer"
+    return options, None
+
+
+def _encode_image(image, options):
+    """Encode a Pillow image with the 'output_format' options and return the bytes."""
+    pil_format = OUTPUT_IMAGE_FORMATS[options["format"]][0]
+    has_alpha = "A" in image.getbands() or "transparency" in image.info
+    if pil_format == "JPEG" or not has_alpha:
+        image = image.convert("RGB") if image.mode != "RGB" else image
+    elif image.mode != "RGBA":
+        image = image.convert("RGBA")
+    buffer = io.BytesIO()
+    image.save(buffer, pil_format, quality=options["quality"])
+    return buffer.getvalue()
+
+
+def _transcode_image(data, options):
+    """
+    Transcode one image output; runs on the transcode pool.
+
+    Metadata embedded by ComfyUI (such as the workflow in PNG text chunks) is
+    not carried over.
+
+    Args:
+        data (bytes | str): The image as written by ComfyUI, or its local path.
+        options (dict): Validated 'output_format' options.
+
+    Returns:
+        tuple: (image bytes, thumbnail bytes or None)
+
+    Raises:
+        ValueError: If the image is animated.
+        OSError: If Pillow cannot read the image.
+    """
+    with Image.open(data if isinstance(data, str) else io.BytesIO(data)) as image:
+        if getattr(image, "n_frames", 1) > 1:
+            raise ValueError("animated images are not transcoded")
+        image.load()
+        max_dimension = options["max_dimension"]
+        if max_dimension and max(image.size) > max_dimension:
+            image.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+        thumbnail = None
+        if options["thumbnail"]:
+            small = image.copy()
+            small.thumbnail((options["thumbnail"], options["thumbnail"]), Image.LANCZOS)
+            thumbnail = _encode_image(small, options)
+        return _encode_image(image, options), thumbnail
+
+
+def _should_transcode(policy, file_info):
+    return (
+        policy.output_format is not None
+        and file_info["kind"] == "images"
+        and os.path.splitext(file_info["filename"])[1].lower()
+        in TRANSCODE_SOURCE_EXTENSIONS
+    )
+
+
+def _over_budget_error(policy, filename):
+    budget_mb = policy.budget_bytes / (1024 * 1024)
+    error_msg = f"Output {filename} omitted: it exceeds the remaining inline output budget of {budget_mb:g} MB. Configure a bucket or raise 'output_budget_mb'."
+    print(f"worker-comfyui - {error_msg}")
+    return error_msg
+
+
+def _local_output_path(file_info):
+    """
+    Resolve an output to its file in the local ComfyUI directories.
+
+    Mirrors the checks of ComfyUI's /view: the resolved path must stay inside
+    the directory of the file type, so a crafted filename or subfolder cannot
+    reach other files.
+
+    Args:
+        file_info (dict): An entry produced by _collect_output_files.
+
+    Returns:
+        str | None: The real path of the file, or None if it has to be fetched
+        over HTTP (no local directory, unknown type or missing file).
+    """
+    if not LOCAL_OUTPUT_ACCESS or not COMFYUI_DIR:
+        return None
+    base = COMFY_FILE_DIRS.get(file_info["type"] or "output")
+    if base is None:
+        return None
+    base = os.path.realpath(base)
+    path = os.path.realpath(
+        os.path.join(base, file_info["subfolder"] or "", file_info["filename"])
+    )
+    if os.path.commonpath([base, path]) != base:
+        print(
+            f"worker-comfyui - Refusing to read {file_info['filename']} outside {base}"
+        )
+        return None
+    return path if os.path.isfile(path) else None
+
+
+def _base64_encode_source(source, policy):
+    """
+    Base64 encode bytes or a local file within the job budget.
+
+    Returns:
+        str: The base64 string, or None if the output does not fit in the budget.
+
+    Raises:
+        OSError: If the local file cannot be read.
+    """
+    if isinstance(source, bytes):
+        return _encode_base64_stream([source], policy, len(source))
+    with open(source, "rb") as file:
+        size = os.fstat(file.fileno()).st_size
+        chunks = iter(lambda: file.read(BASE64_ENCODE_CHUNK_BYTES), b"")
+        return _encode_base64_stream(chunks, policy, size)
+
+
+def _deliver_output(policy, entry, source):
+    """
+    Return an output held in memory or on local disk as base64 or as a bucket URL.
+
+    Follows the same rules as streamed outputs: inline within the job's
+    budget unless the bucket is in use, the bucket for anything over it.
+
+    Args:
+        policy (_OutputPolicy): The job's output policy.
+        entry (dict): The output entry built so far.
+        source (bytes | str): The output data, or the path of a local file.
+
+    Returns:
+        tuple: (output entry or None, error message or None)
+
+    Raises:
+        OSError: If a local file cannot be read for base64 encoding.
+    """
+    filename = entry["filename"]
+    if not policy.use_bucket:
+        with policy.timer.span("output_base64"):
+            encoded = _base64_encode_source(source, policy)
+        if encoded is not None:
+            return {**entry, "type": "base64", "data": encoded}, None
+        if not policy.bucket_available:
+            return None, _over_budget_error(policy, filename)
+    try:
+        with policy.timer.span("output_bucket"):
+            s3_url = _upload_stream_to_bucket(
+                policy.job_id,
+                filename,
+                source if isinstance(source, str) else io.BytesIO(source),
+            )
+        return {**entry, "type": "s3_url", "data": s3_url}, None
+    except Exception as e:
+        error_msg = f"Error uploading {filename} to S3: {e}"
+        print(f"worker-comfyui - {error_msg}")
+        return None, error_msg
+
+
+def _process_transcoded_file(policy, entry, source):
+    """
+    Transcode an image output with the job's 'output_format' and deliver it.
+
+    The image is decoded and re-encoded on the transcode pool while this
+    output worker waits, so the other workers keep fetching. Images that
+    cannot be transcoded are returned as written.
+
+    Args:
+        policy (_OutputPolicy): The job's output policy.
+        entry (dict): The output entry built so far.
+        source (bytes | str): The image as fetched from /view, or its local path.
+
+    Returns:
+        tuple: (output entry or None, error message or None)
+    """
+    filename = entry["filename"]
+    options = policy.output_format
+    try:
+        with policy.timer.span("output_transcode"):
+            data, thumbnail = _transcode_pool.submit(
+                _transcode_image, source, options
+            ).result()
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        print(f"worker-comfyui - Returning {filename} as is, cannot transcode it: {e}")
+        return _deliver_output(policy, entry, source)
+
+    stem = os.path.splitext(filename)[0]
+    extension = OUTPUT_IMAGE_FORMATS[options["format"]][1]
+    source_size = len(source) if isinstance(source, bytes) else os.path.getsize(source)
+    print(
+        f"worker-comfyui - Transcoded {filename} to {options['format']} ({source_size} → {len(data)} bytes)"
+    )
+    result, error = _deliver_output(
+        policy, {**entry, "filename": stem + extension}, data
+    )
+    if result is not None and thumbnail is not None:
+        thumb, thumb_error = _deliver_output(
+            policy, {"filename": f"{stem}_thumb{extension}"}, thumbnail
+        )
+        if thumb is not None:
+            result["thumbnail"] = {"type": thumb["type"], "data": thumb["data"]}
+        else:
+            print(f"worker-comfyui - Thumbnail of {filename} omitted: {thumb_error}")
+    return result, error
+
+
+def _collect_output_files(node_id, node_output, errors):
+    """
+    List the files of one output node that should be returned to the caller.
+
+    Args:
+        node_id (str): The output node id.
+        node_output (dict): The node's entry in the prompt history outputs.
+        errors (list): Warnings about skipped files are appended here.
+
+    Returns:
+        list: One dict per file with 'node_id', 'kind', 'filename', 'subfolder',
+        'type' and, for videos, 'format'. 'kind' is the result list it belongs in.
+    """
+    files = []
+    for output_key, kind in OUTPUT_FILE_KEYS.items():
+        if output_key not in node_output:
+            continue
+        print(
+            f"worker-comfyui - Node {node_id} contains {len(node_output[output_key])} {output_key} file(s)"
+        )
+        for file_info in node_output[output_key]:
+            filename = file_info.get("filename")
+            file_type = file_info.get("type")
+
+            # skip temp images
+            if file_type == "temp":
+                print(
+                    f"worker-comfyui - Skipping file {filename} because type is 'temp'"
+                )
+                continue
+
+            if not filename:
+                warn_msg = f"Skipping file in node {node_id} due to missing filename: {file_info}"
+                print(f"worker-comfyui - {warn_msg}")
+                errors.append(warn_msg)
+                continue
+
+            entry = {
+                "node_id": node_id,
+                "kind": kind,
+                "filename": filename,
+                "subfolder": file_info.get("subfolder", ""),
+                "type": file_type,
+            }
+            if file_info.get("format"):
+                entry["format"] = file_info["format"]
+            files.append(entry)
+
+    # Check for other output types
+    other_keys = [
+        k
+        for k in node_output.keys()
+        if k not in OUTPUT_FILE_KEYS and k not in OUTPUT_META_KEYS
+    ]
+    if other_keys:
+        warn_msg = f"Node {node_id} produced unhandled output keys: {other_keys}."
+        print(f"worker-comfyui - WARNING: {warn_msg}")
+        print(
+            f"worker-comfyui - --> If this output is useful, please consider opening an issue on GitHub to discuss adding support."
+        )
+    return files
+
+
+def _process_output_file(policy, file_info):
+    """
+    Fetch one output from ComfyUI and turn it into a result entry.
+
+    When ComfyUI's output directory is on the local filesystem the file is
+    read from disk: base64 encoded in BASE64_ENCODE_CHUNK_BYTES reads, or
+    uploaded by path. Otherwise, or if reading it fails, it is fetched from
+    /view. Either way, budget claimed for an output that fails to encode is
+    given back. In bucket mode the /view
+    response is streamed straight into the bucket upload; otherwise it is
+    returned as a base64 string, as long as it fits in the job's inline
+    budget. Over-budget outputs go to the bucket when one is configured and
+    are reported as errors otherwise.
+
+    Args:
+        policy (_OutputPolicy): The job's output policy.
+        file_info (dict): An entry produced by _collect_output_files.
+
+    Returns:
+        tuple: (output entry or None, error message or None)
+    """
+    filename = file_info["filename"]
+    entry = {"filename": filename}
+    if "format" in file_info:
+        entry["format"] = file_info["format"]
+    use_bucket = policy.use_bucket
+
+    local_path = _local_output_path(file_info)
+    if local_path is not None:
+        try:
+            if _should_transcode(policy, file_info):
+                return _process_transcoded_file(policy, entry, local_path)
+            print(f"worker-comfyui - Reading {filename} from {local_path}")
+            return _deliver_output(policy, entry, local_path)
+        except OSError as e:
+            print(
+                f"worker-comfyui - Reading {local_path} failed ({e}), fetching it over HTTP"
+            )
+
+    while True:
+        try:
+            response = comfy.open_view(
+                filename, file_info["subfolder"], file_info["type"]
+            )
+        except requests.RequestException as e:
+            print(f"worker-comfyui - Error fetching image data for {filename}: {e}")
+            return (
+                None,
+                f"Failed to fetch image data for {filename} from /view endpoint.",
+            )
+
+        with response:
+            if _should_transcode(policy, file_info):
+                return _process_transcoded_file(policy, entry, response.content)
+            if use_bucket:
+                try:
+                    print(f"worker-comfyui - Uploading {filename} to S3...")
+                    with policy.timer.span("output_bucket"):
+                        s3_url = _upload_stream_to_bucket(
+                            policy.job_id, filename, response.raw
+                        )
+                    print(f"worker-comfyui - Uploaded {filename} to S3: {s3_url}")
+                    return {**entry, "type": "s3_url", "data": s3_url}, None
+                except Exception as e:
+                    error_msg = f"Error uploading {filename} to S3: {e}"
+                    print(f"worker-comfyui - {error_msg}")
+                    return None, error_msg
+
+            # Return as base64 string
+            try:
+                with policy.timer.span("output_base64"):
+                    content_length = response.headers.get("Content-Length")
+                    base64_image = _encode_base64_stream(
+                        response.iter_content(BASE64_ENCODE_CHUNK_BYTES),
+                        policy,
+                        int(content_length) if content_length is not None else None,
+                    )
+            except Exception as e:
+                error_msg = f"Error encoding {filename} to base64: {e}"
+                print(f"worker-comfyui - {error_msg}")
+                return None, error_msg
+
+        if base64_image is not None:
+            print(f"worker-comfyui - Encoded {filename} as base64")
+            return {**entry, "type": "base64", "data": base64_image}, None
+
+        budget_mb = policy.budget_bytes / (1024 * 1024)
+        if not policy.bucket_available:
+            return None, _over_budget_error(policy, filename)
+        # Fetch the file again and send it to the bucket instead
+        print(
+            f"worker-comfyui - {filename} exceeds the inline output budget of {budget_mb:g} MB, uploading to S3 instead"
+        )
+        use_bucket = True
+
+
+def process_outputs(policy, outputs, concurrency=OUTPUT_CONCURRENCY):
+    """
+    Turn the outputs of a finished prompt into result entries.
+
+    Files are processed on a worker pool so that fetching one output overlaps
+    with encoding or uploading the others. Entries keep the order in which the
+    outputs appear in the history.
+
+    Args:
+        policy (_OutputPolicy): The job's output policy.
+        outputs (dict): The 'outputs' mapping from the prompt history.
+        concurrency (int, optional): Maximum number of outputs in flight.
+
+    Returns:
+        tuple: (dict mapping result list name, e.g. "images" or "videos", to its
+        output entries, list of error messages)
+    """
+    errors = []
+    files = []
+    for node_id, node_output in outputs.items():
+        files.extend(_collect_output_files(node_id, node_output, errors))
+
+    if not files:
+        return {}, errors
+
+    workers = max(1, min(concurrency, len(files)))
+    with ThreadPoolExecutor(
+        max_workers=workers, thread_name_prefix="comfy-output"
+    ) as pool:
+        results = list(
+            pool.map(lambda file_info: _process_output_file(policy, file_info), files)
+        )
+
+    output_data = {}
+    for file_info, (entry, error) in zip(files, results):
+        if entry:
+            output_data.setdefault(file_info["kind"], []).append(entry)
+        if error:
+            errors.append(error)
+    return output_data, errors
+
+
+def _count_outputs(output_data):
+    """Return the number of output entries across all result lists."""
+    return sum(len(entries) for entries in output_data.values())
+
+
+# ---------------------------------------------------------------------------
+# Result cache
+# ---------------------------------------------------------------------------
+
+# Serve identical requests (same workflow, same input images) from a local
+# result cache instead of running them again (set RESULT_CACHE=false to disable)
+RESULT_CACHE = os.environ.get("RESULT_CACHE", "true").lower() == "true"
+RESULT_CACHE_DIR = os.environ.get(
+    "RESULT_CACHE_DIR", "/tmp/worker-comfyui/result-cache"
+)
+# Total size of the cached results in MB. Least recently used entries are
+# evicted once it is exceeded.
+RESULT_CACHE_MAX_MB = float(os.environ.get("RESULT_CACHE_MAX_MB", 512))
+# Seed inputs whose value asks for a new seed on every run: class_type →
+# (input name, values). Workflows using one of them are never cached.
+RANDOM_SEED_INPUTS = {
+    # -1 = random, -2 = increment, -3 = decrement the last seed
+    "Seed (rgthree)": ("seed", (-1, -2, -3)),
+}
+# Cached bucket URLs are dropped this many seconds before the presigned URL expires
+RESULT_CACHE_URL_MARGIN_S = 86400
+
+
+def _uses_random_seed(workflow):
+    """Return True if the workflow asks for a fresh seed on every run."""
+    for node in workflow.values():
+        if not isinstance(node, dict):
+            continue
+        seed_input = RANDOM_SEED_INPUTS.get(node.get("class_type"))
+        if (
+            seed_input
+            and (node.get("inputs") or {}).get(seed_input[0]) in seed_input[1]
+        ):
+            return True
+    return False
+
+
+def _canonical_workflow(workflow):
+    """Serialize a workflow deterministically, leaving out the UI-only ``_meta`` fields."""
+    stripped = {
+        node_id: (
+            {key: value for key, value in node.items() if key != "_meta"}
+            if isinstance(node, dict)
+            else node
+        )
+        for node_id, node in workflow.items()
+    }
+    return json.dumps(stripped, sort_keys=True, separators=(",", ":")).encode("utf-8")
+
+
+def _image_cache_token(image):
+    """
+    Return a string identifying the content of an 'images' entry, or None.
+
+    Inline images are identified by their digest and volume paths by their
+    size and modification time. Images behind a URL may change without the
+    URL changing, so jobs using them are not cached.
+    """
+    if "image" in image:
+        try:
+            return _image_digest(image["image"])
+        except base64.binascii.Error:
+            # Reported when the image is uploaded
+            return None
+    if "path" in image:
+        try:
+            stat = os.stat(_resolve_image_path(image["path"]))
+        except (OSError, TypeError):
+            return None
+        return f"{image['path']}:{stat.st_size}:{stat.st_mtime_ns}"
+    return None
+
+
+def _result_entries(result):
+    """Yield the output entries of a handler result or a list of streamed results."""
+    for item in result if isinstance(result, list) else [result]:
+        for key in set(OUTPUT_FILE_KEYS.values()):
+            yield from item.get(key, [])
+
+
+class ResultCache:
+    """
+    Content-addressed cache of job results on local disk.
+
+    Entries are keyed on a hash of the canonical workflow, the input image
+    digests and the options that change the shape of the result, and are
+    stored as one JSON file per key. Recency is tracked in memory (seeded from
+    the file modification times at startup) and the least recently used
+    entries are evicted once the cache grows beyond ``max_bytes``.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self._lock = threading.Lock()
+        # key → size in bytes, least recently used first
+        self._entries = collections.OrderedDict()
+        self._size = 0
+        self._load()
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def _load(self):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            files = []
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith(".json"):
+                    stat = entry.stat()
+                    files.append((stat.st_mtime, entry.name[:-5], stat.st_size))
+        except OSError as e:
+            print(f"worker-comfyui - Warning: Could not read result cache: {e}")
+            return
+        for _, key, size in sorted(files):
+            self._entries[key] = size
+            self._size += size
+
+    def _discard(self, key):
+        """Forget an entry and delete its file. Must be called with the lock held."""
+        self._size -= self._entries.pop(key, 0)
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def key_for(self, kind, validated_data):
+        """
+        Compute the cache key of a job.
+
+        Args:
+            kind (str): Which handler produces the result ("handler" or "stream").
+            validated_data (dict): The output of validate_input.
+
+        Returns:
+            str | None: The key, or None if the job must not be cached.
+        """
+        workflow = validated_data["workflow"]
+        if (
+            not validated_data["cache"]
+            or not isinstance(workflow, dict)
+            or _uses_random_seed(workflow)
+        ):
+            with self._lock:
+                self.bypassed += 1
+            return None
+
+        digest = hashlib.sha256(_canonical_workflow(workflow))
+        images = validated_data.get("images") or []
+        for image in sorted(images, key=lambda image: image["name"]):
+            token = _image_cache_token(image)
+            if token is None:
+                with self._lock:
+                    self.bypassed += 1
+                return None
+            digest.update(f"\0{image['name']}\0{token}".encode())
+        options = [
+            kind,
+            validated_data["output_mode"],
+            validated_data["output_budget_mb"],
+            validated_data["output_format"],
+            bool(os.environ.get("BUCKET_ENDPOINT_URL")),
+        ]
+        digest.update(json.dumps(options).encode("utf-8"))
+        return digest.hexdigest()
+
+    def get(self, key):
+        """Return the cached result for ``key`` or None, counting the hit or miss."""
+        entry = None
+        with self._lock:
+            if key in self._entries:
+                try:
+                    with open(self._path(key), "r", encoding="utf-8") as f:
+                        entry = json.load(f)
+                except (OSError, ValueError):
+                    entry = None
+                if entry is None or (entry["expires_at"] or float("inf")) < time.time():
+                    self._discard(key)
+                    entry = None
+                else:
+                    self._entries.move_to_end(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        try:
+            # Keep the recency across restarts
+            os.utime(self._path(key))
+        except OSError:
+            pass
+        return entry["result"]
+
+    def put(self, key, result):
+        """Store a successful result, evicting least recently used entries if needed."""
+        expires_at = None
+        if any(entry.get("type") == "s3_url" for entry in _result_entries(result)):
+            expires_at = time.time() + BUCKET_URL_EXPIRY_S - RESULT_CACHE_URL_MARGIN_S
+        data = json.dumps({"expires_at": expires_at, "result": result}).encode("utf-8")
+        if len(data) > self.max_bytes:
+            return
+
+        path = self._path(key)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"worker-comfyui - Warning: Could not write result cache entry: {e}")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return
+
+        with self._lock:
+            self._size += len(data) - self._entries.pop(key, 0)
+            self._entries[key] = len(data)
+            while self._size > self.max_bytes and len(self._entries) > 1:
+                oldest = next(iter(self._entries))
+                print(f"worker-comfyui - Evicting cached result {oldest[:16]}")
+                self._discard(oldest)
+
+    def stats(self):
+        """Return the cache counters since the worker started."""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "bypassed": self.bypassed,
+                "entries": len(self._entries),
+                "size_mb": round(self._size / (1024 * 1024), 2),
+            }
+
+
+result_cache = (
+    ResultCache(RESULT_CACHE_DIR, int(RESULT_CACHE_MAX_MB * 1024 * 1024))
+    if RESULT_CACHE
+    else None
+)
+
+
+def _cache_lookup(kind, validated_data):
+    """
+    Look a job up in the result cache.
+
+    Returns:
+        tuple: (cache key or None, cached result or None)
+    """
+    if result_cache is None:
+        return None, None
+    key = result_cache.key_for(kind, validated_data)
+    if key is None:
+        return None, None
+    cached = result_cache.get(key)
+    if cached is not None:
+        print(f"worker-comfyui - Serving result from cache ({key[:16]})")
+    return key, cached
+
+
+def _cache_report(key, hit):
+    """Build the "cache" field of a result, or None when the cache is disabled."""
+    if result_cache is None:
+        return None
+    status = "hit" if hit else ("miss" if key else "bypass")
+    return {"status": status, **result_cache.stats()}
+
+
+# ---------------------------------------------------------------------------
+# Memory management
+# ---------------------------------------------------------------------------
+
+# Check ComfyUI's memory use after every job and free it under pressure
+# (set MEMORY_POLICY=false to keep every model resident)
+MEMORY_POLICY = os.environ.get("MEMORY_POLICY", "true").lower() == "true"
+# Fraction of VRAM in use above which ComfyUI unloads its models after a job
+# (0 = never). Off by default: ComfyUI already evicts models when a prompt
+# needs the VRAM, and unloading undoes warm-up and model affinity.
+MEMORY_VRAM_HIGH = float(os.environ.get("MEMORY_VRAM_HIGH", 0))
+# Fraction of host RAM in use above which ComfyUI frees its caches after a job
+# (0 = never). This also drops cached loader outputs, so it is kept high.
+MEMORY_RAM_HIGH = float(os.environ.get("MEMORY_RAM_HIGH", 0.95))
+# Fraction of VRAM or RAM still in use after freeing above which the worker is
+# refreshed (only possible for non-streaming results)
+MEMORY_REFRESH_HIGH = float(os.environ.get("MEMORY_REFRESH_HIGH", 0.97))
+# Seconds to wait for ComfyUI to act on /free before giving up on it
+MEMORY_FREE_WAIT_S = float(os.environ.get("MEMORY_FREE_WAIT_S", 5))
+
+
+def _memory_usage(system_stats):
+    """
+    Return the used fraction of VRAM (busiest device) and host RAM.
+
+    Args:
+        system_stats (dict): The /system_stats response.
+
+    Returns:
+        tuple: (vram, ram), each a float in [0, 1] or None if not reported.
+    """
+    vram = None
+    for device in system_stats.get("devices") or []:
+        total = device.get("vram_total") or 0
+        if total > 0:
+            used = 1 - device.get("vram_free", total) / total
+            vram = used if vram is None else max(vram, used)
+    ram = None
+    system = system_stats.get("system") or {}
+    if system.get("ram_total"):
+        ram = 1 - system.get("ram_free", system["ram_total"]) / system["ram_total"]
+    return vram, ram
+
+
+class MemoryPolicy:
+    """
+    Keeps ComfyUI's memory use in check between jobs.
+
+    Once a job's result is handed back, /system_stats is sampled in the
+    background. Above ``MEMORY_VRAM_HIGH`` VRAM ComfyUI is asked to unload its
+    models, above ``MEMORY_RAM_HIGH`` host RAM to free its caches. Only if
+    memory is still above ``MEMORY_REFRESH_HIGH`` once ComfyUI acted on /free
+    is the worker refreshed, with the result of the next job that finishes
+    while no other job is in flight, so models stay resident across jobs as
+    long as they fit.
+
+    Nothing is freed while a job of the worker is active or ComfyUI still has
+    queued prompts, since that would unload models they are about to use. A job
+    starting while memory is being freed waits for ComfyUI to finish.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self._active_jobs = 0
+        self._freeing = False
+        self._refresh = False
+        self._cond = threading.Condition()
+
+    @contextlib.contextmanager
+    def job(self):
+        """Count the body of a ``with`` block as an active job."""
+        with self._cond:
+            self._cond.wait_for(
+                lambda: not self._freeing, timeout=MEMORY_FREE_WAIT_S + 1
+            )
+            self._active_jobs += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._active_jobs -= 1
+
+    def _sample(self):
+        return _memory_usage(self.client.get_system_stats())
+
+    @staticmethod
+    def _describe(vram, ram):
+        parts = [
+            f"{label} {used:.0%}"
+            for label, used in (("VRAM", vram), ("RAM", ram))
+            if used is not None
+        ]
+        return ", ".join(parts) or "unknown"
+
+    @staticmethod
+    def _pressure(vram, ram):
+        """Return (unload_models, free_memory) for the sampled usage."""
+        unload_models = bool(
+            MEMORY_VRAM_HIGH and vram is not None and vram >= MEMORY_VRAM_HIGH
+        )
+        free_memory = bool(
+            MEMORY_RAM_HIGH and ram is not None and ram >= MEMORY_RAM_HIGH
+        )
+        return unload_models, free_memory
+
+    def after_job(self):
+        """
+        Start checking ComfyUI's memory in the background.
+
+        Must be called after leaving :meth:`job`, right before the result is
+        handed back, so that the check never delays it.
+
+        Returns:
+            bool: True if an earlier check found that the worker should be
+            refreshed and no other job is in flight; otherwise the refresh is
+            left to the last job out, as it would stop the others mid-run.
+        """
+        if not MEMORY_POLICY:
+            return False
+        with self._cond:
+            refresh = self._refresh and not self._active_jobs
+            if refresh:
+                self._refresh = False
+        threading.Thread(target=self._check, name="memory-policy", daemon=True).start()
+        return refresh
+
+    def _check(self):
+        """Free ComfyUI memory if it crossed the thresholds and no job is active."""
+        try:
+            queue_state = self.client.get_queue()
+            if queue_state.get("queue_running") or queue_state.get("queue_pending"):
+                return
+            vram, ram = self._sample()
+            unload_models, free_memory = self._pressure(vram, ram)
+            if not unload_models and not free_memory:
+                return
+            with self._cond:
+                if self._active_jobs or self._freeing:
+                    return
+                self._freeing = True
+            try:
+                vram, ram = self._free(vram, ram, unload_models, free_memory)
+            finally:
+                with self._cond:
+                    self._freeing = False
+                    self._cond.notify_all()
+        except requests.RequestException as e:
+            print(f"worker-comfyui - Memory check failed: {e}")
+            return
+        if not any(self._pressure(vram, ram)):
+            return
+
+        if max(vram or 0, ram or 0) >= MEMORY_REFRESH_HIGH:
+            print(
+                f"worker-comfyui - Memory still at {self._describe(vram, ram)} after "
+                "freeing, the worker will be refreshed after its next job"
+            )
+            with self._cond:
+                self._refresh = True
+            return
+        print(
+            f"worker-comfyui - Memory still at {self._describe(vram, ram)} after freeing"
+        )
+
+    def _free(self, vram, ram, unload_models, free_memory):
+        """
+        Ask ComfyUI to free memory and wait until it did.
+
+        Returns:
+            tuple: The last sampled (vram, ram).
+        """
+        print(
+            f"worker-comfyui - Memory pressure ({self._describe(vram, ram)}), "
+            f"freeing ComfyUI memory (unload_models={unload_models}, "
+            f"free_memory={free_memory})"
+        )
+        self.client.free(unload_models=unload_models, free_memory=free_memory)
+        # ComfyUI applies /free from its prompt loop, so poll until it did
+        wait_until = time.monotonic() + MEMORY_FREE_WAIT_S
+        while True:
+            time.sleep(0.5)
+            vram, ram = self._sample()
+            if not any(self._pressure(vram, ram)):
+                print(f"worker-comfyui - Memory freed ({self._describe(vram, ram)})")
+                break
+            if time.monotonic() >= wait_until:
+                break
+        return vram, ram
+
+
+memory_policy = MemoryPolicy(comfy)
+
+
+# ---------------------------------------------------------------------------
+# Disk housekeeping
+# ---------------------------------------------------------------------------
+
+# Evict old files from ComfyUI's input, output and temp directories in the
+# background (needs COMFYUI_DIR). Only enable it when ComfyUI lives on the
+# container's own disk: on a network volume (e.g. /runpod-volume) the
+# directories are shared with other workers, whose in-flight inputs and
+# outputs this worker cannot see and would delete.
+DISK_GOVERNOR = os.environ.get("DISK_GOVERNOR", "false").lower() == "true"
+# Seconds between two sweeps of the directories
+DISK_GOVERNOR_INTERVAL_S = float(os.environ.get("DISK_GOVERNOR_INTERVAL_S", 300))
+# Per file type: (size limit in MB, maximum age in hours since last use); 0 = none
+DISK_LIMITS = {
+    "input": (
+        float(os.environ.get("DISK_INPUT_MAX_MB", 2048)),
+        float(os.environ.get("DISK_INPUT_MAX_AGE_H", 24)),
+    ),
+    "output": (
+        float(os.environ.get("DISK_OUTPUT_MAX_MB", 10240)),
+        float(os.environ.get("DISK_OUTPUT_MAX_AGE_H", 24)),
+    ),
+    "temp": (
+        float(os.environ.get("DISK_TEMP_MAX_MB", 2048)),
+        float(os.environ.get("DISK_TEMP_MAX_AGE_H", 1)),
+    ),
+}
+# A directory over its size limit is trimmed to this fraction of it, so that
+# not every sweep has to evict again
+DISK_EVICT_TARGET = 0.9
+# Files written or used less than this many seconds ago are never evicted
+DISK_MIN_AGE_S = 600
+# Annotation ComfyUI accepts after a file name in node inputs, e.g. "a.png [output]"
+_FILE_TYPE_ANNOTATION = re.compile(r" \[(input|output|temp)\]$")
+
+
+def _workflow_file_names(workflow):
+    """Return every string node input of a workflow that may name a file."""
+    names = set()
+    for node in workflow.values():
+        if not isinstance(node, dict):
+            continue
+        for value in (node.get("inputs") or {}).values():
+            if isinstance(value, str) and value:
+                names.add(_FILE_TYPE_ANNOTATION.sub("", value).replace("\\", "/"))
+    return names
+
+
+class DiskGovernor:
+    """
+    Keeps ComfyUI's input, output and temp directories within size and age limits.
+
+    A background thread sweeps the directories every
+    ``DISK_GOVERNOR_INTERVAL_S``. Files not used for longer than the age limit
+    of their type are deleted, then the least recently used ones until the
+    directory is back under its size limit. A file's last use is the latest
+    of its mtime, its atime and :meth:`touch`.
+
+    Files are never deleted while they may still be needed:
+      • files named by a node input of an in-flight prompt (see :meth:`pin`)
+      • files written since the oldest in-flight prompt was queued, which
+        covers outputs that are still being produced or delivered
+      • files written or touched within ``DISK_MIN_AGE_S``
+
+    Evicted inputs are dropped from the client's input dedup index so they are
+    uploaded again when a later job sends them.
+    """
+
+    def __init__(self, directories, client):
+        """
+        Args:
+            directories (dict): File type → directory to govern.
+            client (ComfyClient): Its dedup index is updated on input eviction.
+        """
+        self.directories = directories
+        self.client = client
+        self._pins = {}
+        self._touched = {}
+        self._lock = threading.Lock()
+        self._stats = {}
+        self._thread = None
+
+    def pin(self, workflow):
+        """
+        Protect the files an in-flight prompt may read or write.
+
+        Returns:
+            object: Token to pass to :meth:`unpin` once the prompt is done.
+        """
+        token = object()
+        with self._lock:
+            self._pins[token] = (time.time(), _workflow_file_names(workflow))
+        return token
+
+    def unpin(self, token):
+        with self._lock:
+            self._pins.pop(token, None)
+
+    def touch(self, file_type, names):
+        """
+        Record that a job used the files ``names`` (relative to the type's directory).
+
+        Nothing is recorded while the governor is not running, since only its
+        sweeps prune the record.
+        """
+        if self._thread is None:
+            return
+        now = time.time()
+        with self._lock:
+            for name in names:
+                self._touched[(file_type, name)] = now
+
+    def _is_protected(self, file_type, name, mtime, now):
+        # Must be called with the lock held
+        if now - max(mtime, self._touched.get((file_type, name), 0)) < DISK_MIN_AGE_S:
+            return True
+        return any(
+            name in names or mtime >= queued_at
+            for queued_at, names in self._pins.values()
+        )
+
+    def _scan(self, file_type, root, touched):
+        """List (name, path, size, mtime, last use) of every file below ``root``."""
+        files = []
+        for directory, _, filenames in os.walk(root):
+            for filename in filenames:
+                path = os.path.join(directory, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                name = os.path.relpath(path, root).replace(os.sep, "/")
+                last_used = max(
+                    stat.st_mtime, stat.st_atime, touched.get((file_type, name), 0)
+                )
+                files.append((name, path, stat.st_size, stat.st_mtime, last_used))
+        return files
+
+    def _sweep_directory(self, file_type, root):
+        max_mb, max_age_h = DISK_LIMITS.get(file_type, (0, 0))
+        started = time.monotonic()
+        now = time.time()
+        with self._lock:
+            touched = dict(self._touched)
+        files = self._scan(file_type, root, touched)
+
+        # Least recently used first: expired files, then enough to fit the limit
+        files.sort(key=lambda entry: entry[4])
+        max_age_s = max_age_h * 3600
+        expired = [entry for entry in files if max_age_s and now - entry[4] > max_age_s]
+        candidates = list(expired)
+        total = sum(size for _, _, size, _, _ in files[len(expired) :])
+        max_bytes = max_mb * 1024 * 1024
+        if max_bytes and total > max_bytes:
+            for entry in files[len(expired) :]:
+                if total <= max_bytes * DISK_EVICT_TARGET:
+                    break
+                candidates.append(entry)
+                total -= entry[2]
+
+        evicted_files = evicted_bytes = 0
+        for name, path, size, mtime, _ in candidates:
+            with self._lock:
+                # Checked at deletion time, a job may have started using it
+                if self._is_protected(file_type, name, mtime, time.time()):
+                    continue
+                try:
+                    os.remove(path)
+                except OSError as e:
+                    print(f"worker-comfyui - Disk governor: cannot delete {path}: {e}")
+                    continue
+                # Forgotten before the lock is released, so that a job touching
+                # the name (see ComfyClient._upload_one) either protects the file
+                # or finds it gone and uploads it again
+                if file_type == "input":
+                    self.client.forget_input(name)
+            evicted_files += 1
+            evicted_bytes += size
+
+        # Drop directories emptied by the eviction (e.g. dated output folders)
+        for directory, _, _ in os.walk(root, topdown=False):
+            if directory == root:
+                continue
+            try:
+                if now - os.path.getmtime(directory) >= DISK_MIN_AGE_S:
+                    os.rmdir(directory)
+            except OSError:
+                pass
+
+        stats = self._stats.setdefault(
+            file_type, {"evicted_files": 0, "evicted_bytes": 0}
+        )
+        stats.update(
+            files=len(files) - evicted_files,
+            bytes=sum(size for _, _, size, _, _ in files) - evicted_bytes,
+            evicted_files=stats["evicted_files"] + evicted_files,
+            evicted_bytes=stats["evicted_bytes"] + evicted_bytes,
+            sweep_seconds=round(time.monotonic() - started, 4),
+        )
+        if evicted_files:
+            print(
+                f"worker-comfyui - Disk governor: evicted {evicted_files} {file_type} "
+                f"file(s), {evicted_bytes / (1024 * 1024):.1f} MB"
+            )
+
+    def sweep(self):
+        """Run one eviction pass over every governed directory."""
+        for file_type, root in self.directories.items():
+            if os.path.isdir(root):
+                self._sweep_directory(file_type, os.path.realpath(root))
+        with self._lock:
+            # Touches older than the protection window no longer matter
+            cutoff = time.time() - DISK_MIN_AGE_S
+            self._touched = {
+                key: used for key, used in self._touched.items() if used >= cutoff
+            }
+        print(json.dumps({"event": "disk_usage", **self.stats()}))
+
+    def stats(self):
+        """Return usage and cumulative eviction counts per file type."""
+        return {file_type: dict(stats) for file_type, stats in self._stats.items()}
+
+    def _run(self):
+        while True:
+            try:
+                self.sweep()
+            except Exception as e:
+                print(f"worker-comfyui - Disk governor sweep failed: {e}")
+            time.sleep(DISK_GOVERNOR_INTERVAL_S)
+
+    def start(self):
+        """Start the background sweeps, if enabled and the directories are known."""
+        if not DISK_GOVERNOR or not self.directories or self._thread is not None:
+            return
+        self._thread = threading.Thread(
+            target=self._run, name="disk-governor", daemon=True
+        )
+        self._thread.start()
+
+
+disk_governor = DiskGovernor(COMFY_FILE_DIRS if COMFYUI_DIR else {}, comfy)
+
+
+# ---------------------------------------------------------------------------
+# Progress reporting
+# ---------------------------------------------------------------------------
+
+# Send progress updates (nodes, sampler steps, ETA) while a job executes
+PROGRESS_UPDATES = os.environ.get("PROGRESS_UPDATES", "true").lower() == "true"
+# Minimum number of seconds between two progress updates of a job
+PROGRESS_UPDATE_INTERVAL_S = float(os.environ.get("PROGRESS_UPDATE_INTERVAL_S", 2))
+# Number of recent sampler steps whose duration is averaged for the ETA
+PROGRESS_ETA_WINDOW = int(os.environ.get("PROGRESS_ETA_WINDOW", 20))
+
+
+def _node_steps(workflow, node):
+    """
+    Return the ``steps`` input of a sampler-like node.
+
+    A link to another node (e.g. a primitive feeding several samplers) is
+    followed one hop to that node's ``value`` input.
+
+    Returns:
+        int | None: The steps, 0 for nodes without a ``steps`` input, or None
+        if the input is linked to something that cannot be resolved.
+    """
+    if not isinstance(node, dict) or "steps" not in (node.get("inputs") or {}):
+        return 0
+    steps = node["inputs"]["steps"]
+    # Links are [source_node_id, output_index]
+    if isinstance(steps, list) and len(steps) == 2:
+        source = workflow.get(str(steps[0]))
+        if not isinstance(source, dict):
+            return None
+        steps = (source.get("inputs") or {}).get("value")
+    if isinstance(steps, bool) or not isinstance(steps, int):
+        return None
+    return max(steps, 0)
+
+
+class JobProgress:
+    """
+    Tracks the node and sampler-step progress of a job's prompts.
+
+    The prompt monitors feed every websocket message of their prompt to
+    :meth:`observe`. Progress is reported through
+    ``runpod.serverless.progress_update`` at most once every
+    ``PROGRESS_UPDATE_INTERVAL_S``. The ETA multiplies the mean duration of the
+    last ``PROGRESS_ETA_WINDOW`` sampler steps by the steps still ahead: the
+    rest of the running sampler plus the ``steps`` inputs of nodes that have
+    not run yet (see :func:`_node_steps`). Steps that cannot be read from the
+    workflow are taken from the ``max`` the same node reported in an earlier
+    prompt, else from the last sampler that ran. Other nodes are assumed to be
+    cheap next to sampling.
+    """
+
+    def __init__(self, job, send=None):
+        """
+        Args:
+            job (dict): The job the updates are sent for.
+            send (callable, optional): Called with ``(job, payload)``. Defaults to
+                ``runpod.serverless.progress_update``.
+        """
+        self.job = job
+        self._send = send or runpod.serverless.progress_update
+        self._prompts = {}
+        self._step_durations = collections.deque(maxlen=PROGRESS_ETA_WINDOW)
+        # Node id → "max" of its last progress event, and the latest "max"
+        self._reported_steps = {}
+        self._last_steps = 0
+        self._started = time.monotonic()
+        self._last_sent = None
+        self._lock = threading.Lock()
+
+    def add_prompt(self, prompt_id, workflow):
+        """Start tracking a queued prompt of the job."""
+        with self._lock:
+            self._prompts[prompt_id] = {
+                "workflow": workflow,
+                # Nodes that have not run yet → their sampler steps (None: unknown)
+                "pending": {
+                    node_id: _node_steps(workflow, node)
+                    for node_id, node in workflow.items()
+                },
+                "done": 0,
+                "started": False,
+                "finished": False,
+                "node": None,
+                "step": 0,
+                "steps": 0,
+                "last_step": None,
+            }
+
+    def observe(self, prompt_id, message):
+        """Update the progress of ``prompt_id`` from one websocket message."""
+        message_type = message.get("type")
+        data = message.get("data", {})
+        now = message.get("received_at") or time.monotonic()
+        with self._lock:
+            state = self._prompts.get(prompt_id)
+            if state is None or state["finished"]:
+                return
+            if message_type == "execution_start":
+                state["started"] = True
+            elif message_type == "execution_cached":
+                for node_id in data.get("nodes") or []:
+                    if state["pending"].pop(node_id, None) is not None:
+                        state["done"] += 1
+            elif message_type == "executing":
+                state["started"] = True
+                if state["node"] is not None:
+                    state["done"] += 1
+                node_id = data.get("node")
+                if node_id is None:
+                    self._finish(state)
+                else:
+                    steps = state["pending"].pop(node_id, 0)
+                    if steps is None:
+                        steps = self._guess_steps(node_id)
+                    state.update(node=node_id, step=0, steps=steps, last_step=None)
+            elif message_type == "progress":
+                value, steps = data.get("value"), data.get("max")
+                if not isinstance(value, int) or not isinstance(steps, int):
+                    return
+                last_step = state["last_step"]
+                # The first step also covers model loading, so it is not timed
+                if last_step is not None and value > last_step[0]:
+                    self._step_durations.append(
+                        (now - last_step[1]) / (value - last_step[0])
+                    )
+                state.update(step=value, steps=steps, last_step=(value, now))
+                if state["node"] is not None:
+                    self._reported_steps[state["node"]] = steps
+                self._last_steps = steps
+            elif message_type in ("execution_error", "execution_interrupted"):
+                self._finish(state)
+            else:
+                return
+            payload = self._payload()
+            force = self._last_sent is None or all(
+                p["finished"] for p in self._prompts.values()
+            )
+            if not force and now - self._last_sent < PROGRESS_UPDATE_INTERVAL_S:
+                return
+            self._last_sent = now
+        self._report(payload)
+
+    @staticmethod
+    def _finish(state):
+        # Nodes that never ran were not needed for the outputs
+        state["pending"].clear()
+        state.update(finished=True, done=len(state["workflow"]), node=None)
+
+    def _guess_steps(self, node_id):
+        return self._reported_steps.get(node_id, self._last_steps)
+
+    def _eta(self):
+        if not self._step_durations:
+            return None
+        step_s = sum(self._step_durations) / len(self._step_durations)
+        steps_left = 0
+        for state in self._prompts.values():
+            if not state["finished"]:
+                steps_left += max(state["steps"] - state["step"], 0)
+                steps_left += sum(
+                    self._guess_steps(node_id) if steps is None else steps
+                    for node_id, steps in state["pending"].items()
+                )
+        return round(steps_left * step_s, 1)
+
+    def _payload(self):
+        nodes_total = sum(len(state["workflow"]) for state in self._prompts.values())
+        nodes_done = sum(state["done"] for state in self._prompts.values())
+        running = [
+            state
+            for state in self._prompts.values()
+            if state["started"] and not state["finished"]
+        ]
+        current = running[0] if running else None
+        if current and current["steps"]:
+            # Count the running node's completed steps as a fraction of it
+            nodes_done += min(current["step"] / current["steps"], 1)
+
+        if running:
+            status = "executing"
+        elif all(state["finished"] for state in self._prompts.values()):
+            status = "finished"
+        else:
+            status = "queued"
+        payload = {
+            "status": status,
+            "nodes_done": int(nodes_done),
+            "nodes_total": nodes_total,
+            "percent": round(100 * nodes_done / nodes_total, 1) if nodes_total else 0,
+            "elapsed_seconds": round(time.monotonic() - self._started, 1),
+            "eta_seconds": self._eta(),
+        }
+        if current and current["node"] is not None:
+            node = current["workflow"].get(current["node"])
+            payload["node"] = {
+                "id": current["node"],
+                "class_type": (
+                    node.get("class_type") if isinstance(node, dict) else None
+                ),
+                "step": current["step"],
+                "steps": current["steps"],
+            }
+        if len(self._prompts) > 1:
+            payload["prompts_done"] = sum(
+                state["finished"] for state in self._prompts.values()
+            )
+            payload["prompts_total"] = len(self._prompts)
+        return payload
+
+    def _report(self, payload):
+        node = payload.get("node")
+        detail = f", node {node['id']} ({node['class_type']})" if node else ""
+        if node and node["steps"]:
+            detail += f" step {node['step']}/{node['steps']}"
+        eta = payload["eta_seconds"]
+        print(
+            f"worker-comfyui - Progress: {payload['percent']}%{detail}"
+            + (f", ETA {eta}s" if eta is not None else "")
+        )
+        try:
+            self._send(self.job, payload)
+        except Exception as e:
+            print(f"worker-comfyui - Could not send progress update: {e}")
+
+
+# ---------------------------------------------------------------------------
+# Prompt execution
+# ---------------------------------------------------------------------------
+
+
+def _cancel_prompts(prompt_ids):
+    """
+    Remove prompts from the ComfyUI queue and interrupt the one that is running.
+
+    Pending prompts are deleted first, in one request, so that ComfyUI does not
+    move on to one of them once the running prompt is interrupted.
+
+    Args:
+        prompt_ids (list): The prompts to cancel.
+
+    Returns:
+        tuple: (deleted, interrupted) sets of prompt IDs. ComfyUI acknowledges
+        the interrupted prompts with ``execution_interrupted``.
+
+    Raises:
+        requests.RequestException: If the queue could not be read or changed.
+    """
+    prompt_ids = set(prompt_ids)
+
+    def queued_ids(key):
+        return {item[1] for item in comfy.get_queue().get(key, [])} & prompt_ids
+
+    pending = queued_ids("queue_pending")
+    if pending:
+        comfy.delete_queued(sorted(pending))
+    # Re-read the queue: a prompt may have started in the meantime
+    running = queued_ids("queue_running")
+    for prompt_id in running:
+        comfy.interrupt(prompt_id)
+    return pending - running, running
+
+
+class _PromptMonitor:
+    """
+    Follows the execution of one queued prompt through the websocket dispatcher.
+
+    Iterating :meth:`executed_outputs` yields every ``executed`` message of the
+    prompt as it arrives and stops once ComfyUI reports the prompt finished
+    (``executing`` with ``node=None``) or failed (``execution_error``).
+
+    Along the way it records how long each node took in :attr:`node_timings`
+    (node_id → seconds), measured between consecutive ``executing`` messages.
+    Nodes served from ComfyUI's cache are recorded with 0. ``queued_at``,
+    ``started_at`` and ``finished_at`` hold the monotonic times at which the
+    prompt was queued, started executing and finished. With a
+    :class:`JobProgress`, every message is also fed to it.
+
+    If the job's ``deadline`` passes first, the prompt is removed from the
+    ComfyUI queue or interrupted (see :meth:`_cancel`), an error is recorded
+    and :attr:`timed_out` is set; outputs produced so far stay in the history.
+    The other prompts of a batch are cancelled along with it.
+    """
+
+    def __init__(
+        self,
+        prompt_id,
+        errors,
+        workflow=None,
+        progress=None,
+        deadline=None,
+        batch=None,
+    ):
+        """
+        Args:
+            prompt_id (str): The prompt to follow.
+            errors (list): Execution errors are appended here.
+            workflow (dict, optional): The queued workflow, used to name nodes in timings.
+            progress (JobProgress, optional): Progress tracker of the job.
+            deadline (float, optional): Monotonic time at which the job expires.
+            batch (list, optional): Monitors of the other prompts of the same
+                job; the monitor adds itself.
+        """
+        self.prompt_id = prompt_id
+        self.errors = errors
+        self.workflow = workflow or {}
+        self.progress = progress
+        if progress is not None:
+            progress.add_prompt(prompt_id, self.workflow)
+        self.deadline = deadline
+        self.timed_out = False
+        self.execution_done = False
+        self.queued_at = time.monotonic()
+        self.started_at = None
+        self.finished_at = None
+        self.node_timings = {}
+        self._current_node = None
+        self._node_started = None
+        self._messages = dispatcher.subscribe(prompt_id)
+        self._disk_pin = disk_governor.pin(self.workflow)
+        self.batch = batch if batch is not None else []
+        self.batch.append(self)
+
+    def _track_node(self, node_id, now=None):
+        """
+        Close the timing of the running node and start timing ``node_id``.
+
+        ``now`` is the monotonic time the message reporting the change arrived
+        at; messages can be drained long after that, e.g. while the previous
+        prompt of a batch is having its outputs processed.
+        """
+        if now is None:
+            now = time.monotonic()
+        if self.started_at is None and node_id is not None:
+            self.started_at = now
+        if node_id is None:
+            self.finished_at = now
+        if self._current_node is not None:
+            self.node_timings[self._current_node] = now - self._node_started
+        self._current_node = node_id
+        self._node_started = now
+
+    def _record_timeout(self):
+        self.timed_out = True
+        message = f"Job deadline exceeded, prompt {self.prompt_id} was cancelled"
+        print(f"worker-comfyui - {message}")
+        self.errors.append(message)
+
+    def _cancel(self):
+        """
+        Stop the prompt, and the unfinished prompts of its batch, after the job
+        deadline passed.
+
+        Pending prompts are deleted from the queue before the running one is
+        interrupted, so that ComfyUI does not start the next prompt of the
+        batch. The interrupt is acknowledged with ``execution_interrupted``.
+
+        Returns:
+            bool: True if no further messages should be waited for.
+        """
+        self._record_timeout()
+        others = {
+            monitor.prompt_id: monitor
+            for monitor in self.batch
+            if monitor is not self and not monitor.timed_out
+        }
+
+        try:
+            deleted, interrupted = _cancel_prompts([self.prompt_id, *others])
+        except requests.RequestException as e:
+            print(f"worker-comfyui - Could not cancel prompt {self.prompt_id}: {e}")
+            return True
+        for prompt_id in (deleted | interrupted) & others.keys():
+            others[prompt_id]._record_timeout()
+        return self.prompt_id not in interrupted
+
+    def executed_outputs(self):
+        """
+        Yield ``(node_id, output)`` for each output node as soon as it finishes.
+
+        Raises:
+            websocket.WebSocketConnectionClosedException: If the websocket dropped
+                and could not be reconnected.
+        """
+        prompt_id = self.prompt_id
+        print(f"worker-comfyui - Waiting for workflow execution ({prompt_id})...")
+        resync_at = time.monotonic() + WEBSOCKET_RESYNC_INTERVAL_S
+        while True:
+            wait_until = resync_at
+            if self.deadline is not None:
+                wait_until = min(wait_until, self.deadline)
+            try:
+                message = self._messages.get(
+                    timeout=max(wait_until - time.monotonic(), 0)
+                )
+            except queue.Empty:
+                now = time.monotonic()
+                if self.deadline is not None and now >= self.deadline:
+                    if self.timed_out:
+                        # Cancelled along with another prompt of the batch, or
+                        # interrupted and not stopped within the grace period
+                        self._track_node(None)
+                        return
+                    if self._cancel():
+                        self._track_node(None)
+                        return
+                    # Give the interrupted prompt a moment to stop
+                    self.deadline = now + JOB_CANCEL_GRACE_S
+                elif now >= resync_at:
+                    print(
+                        f"worker-comfyui - Websocket receive timed out. Still waiting..."
+                    )
+                    dispatcher.resync([prompt_id])
+                    resync_at = now + WEBSOCKET_RESYNC_INTERVAL_S
+                continue
+            resync_at = time.monotonic() + WEBSOCKET_RESYNC_INTERVAL_S
+
+            if self.progress is not None:
+                self.progress.observe(prompt_id, message)
+            data = message.get("data", {})
+            received_at = message.get("received_at") or time.monotonic()
+            if message.get("type") == "executing":
+                self._track_node(data.get("node"), received_at)
+                if data.get("node") is None:
+                    print(f"worker-comfyui - Execution finished for prompt {prompt_id}")
+                    self.execution_done = True
+                    return
+            elif message.get("type") == "executed":
+                if data.get("output"):
+                    yield data.get("node"), data["output"]
+            elif message.get("type") == "execution_start":
+                self.started_at = received_at
+            elif message.get("type") == "execution_cached":
+                for node_id in data.get("nodes") or []:
+                    self.node_timings[node_id] = 0.0
+            elif message.get("type") == "execution_interrupted":
+                self._track_node(None, received_at)
+                if not self.timed_out:
+                    print(f"worker-comfyui - Execution interrupted ({prompt_id})")
+                    self.errors.append("Workflow execution was interrupted")
+                return
+            elif message.get("type") == "execution_error":
+                self._track_node(None, received_at)
+                error_details = f"Node Type: {data.get('node_type')}, Node ID: {data.get('node_id')}, Message: {data.get('exception_message')}"
+                print(f"worker-comfyui - Execution error received: {error_details}")
+                self.errors.append(f"Workflow execution error: {error_details}")
+                return
+            elif message.get("type") == "dispatcher_error":
+                raise websocket.WebSocketConnectionClosedException(
+                    f"Connection closed and failed to reconnect. Last error: {data.get('message')}"
+                )
+
+    def wait(self):
+        """Block until the prompt finished or failed, discarding intermediate outputs."""
+        for _ in self.executed_outputs():
+            pass
+
+    def close(self):
+        dispatcher.unsubscribe(self.prompt_id)
+        disk_governor.unpin(self._disk_pin)
+
+
+def _close_monitors(monitors):
+    """
+    Close prompt monitors, cancelling the prompts that have not finished.
+
+    Prompts left unfinished because the consumer of a stream stopped early or
+    collecting failed would otherwise keep ComfyUI busy for nothing.
+    """
+    unfinished = [m.prompt_id for m in monitors if m.finished_at is None]
+    if unfinished:
+        try:
+            _cancel_prompts(unfinished)
+        except requests.RequestException as e:
+            print(f"worker-comfyui - Could not cancel prompts {unfinished}: {e}")
+    for monitor in monitors:
+        monitor.close()
+
+
+def _prepare_comfyui(validated_data, timer):
+    """
+    Make sure ComfyUI is up and upload the input images of a validated job.
+
+    Args:
+        validated_data (dict): The output of validate_input.
+        timer (JobTimer): Records the server check, prefetch and upload stages.
+
+    Returns:
+        dict | None: An error result, or None on success.
+    """
+    # Make sure that the ComfyUI HTTP API is available before proceeding
+    with timer.span("server_check"):
+        server_ready = comfy.check_server(
+            COMFY_API_AVAILABLE_MAX_RETRIES,
+            COMFY_API_AVAILABLE_INTERVAL_MS,
+        )
+    if not server_ready:
+        return {
+            "error": f"ComfyUI server ({COMFY_HOST}) not reachable after multiple retries."
+        }
+
+    # Upload input images if they exist
+    input_images = validated_data.get("images")
+    if input_images and any("image" not in image for image in input_images):
+        # Connect the websocket while the referenced images are being fetched
+        threading.Thread(
+            target=_connect_in_background, name="ws-connect", daemon=True
+        ).start()
+        with timer.span("prefetch"):
+            input_images, fetch_errors = prefetch_images(input_images)
+        if fetch_errors:
+            return {
+                "error": "Failed to fetch one or more input images",
+                "details": fetch_errors,
+            }
+        validated_data["images"] = input_images
+    if input_images:
+        with timer.span("upload"):
+            upload_result = comfy.upload_images(input_images)
+        if upload_result["status"] == "error":
+            # Return upload errors
+            return {
+                "error": "Failed to upload one or more input images",
+                "details": upload_result["details"],
+            }
+        if "workflows" in validated_data:
+            validated_data["workflows"] = [
+                _rewrite_image_references(workflow, upload_result["names"])
+                for workflow in validated_data["workflows"]
+            ]
+        else:
+            validated_data["workflow"] = _rewrite_image_references(
+                validated_data["workflow"], upload_result["names"]
+            )
+
+    return None
+
+
+def _job_state(job, validated_data, timer):
+    """
+    Create the output policy and progress tracker of a validated job.
+
+    Returns:
+        tuple: (_OutputPolicy, JobProgress or None if PROGRESS_UPDATES is off)
+    """
+    policy = _OutputPolicy(
+        job["id"],
+        validated_data["output_mode"],
+        validated_data["output_budget_mb"],
+        timer,
+        validated_data["output_format"],
+    )
+    progress = JobProgress(job) if PROGRESS_UPDATES else None
+    return policy, progress
+
+
+def _job_deadline(validated_data):
+    """Return the monotonic time at which a job expires, or None without a timeout."""
+    timeout_s = validated_data.get("timeout_s")
+    return time.monotonic() + timeout_s if timeout_s else None
+
+
+def _start_prompt(workflow, errors, progress=None, deadline=None, batch=None):
+    """
+    Make sure the shared websocket is connected and queue the workflow.
+
+    Args:
+        workflow (dict): The workflow to queue.
+        errors (list): Passed on to the returned monitor.
+        progress (JobProgress, optional): Passed on to the returned monitor.
+        deadline (float, optional): Passed on to the returned monitor. The
+            workflow is not queued once it has passed.
+        batch (list, optional): Passed on to the returned monitor.
+
+    Returns:
+        _PromptMonitor: Monitor for the queued prompt. The caller must close it.
+
+    Raises:
+        ValueError: If the workflow could not be queued.
+        websocket.WebSocketException: If the websocket could not be connected.
+    """
+    if deadline is not None and time.monotonic() >= deadline:
+        raise ValueError("Job deadline exceeded before the workflow was queued")
+    dispatcher.ensure_connected()
+
+    # Queue the workflow
+    try:
+        queued_workflow = comfy.queue_workflow(workflow, dispatcher.client_id)
+        prompt_id = queued_workflow.get("prompt_id")
+        if not prompt_id:
+            raise ValueError(
+                f"Missing 'prompt_id' in queue response: {queued_workflow}"
+            )
+        print(f"worker-comfyui - Queued workflow with ID: {prompt_id}")
+    except requests.RequestException as e:
+        print(f"worker-comfyui - Error queuing workflow: {e}")
+        raise ValueError(f"Error queuing workflow: {e}")
+    except Exception as e:
+        print(f"worker-comfyui - Unexpected error queuing workflow: {e}")
+        # For ValueError exceptions from queue_workflow, pass through the original message
+        if isinstance(e, ValueError):
+            raise e
+        else:
+            raise ValueError(f"Unexpected error queuing workflow: {e}")
+
+    return _PromptMonitor(prompt_id, errors, workflow, progress, deadline, batch)
+
+
+def _fetch_prompt_outputs(prompt_id, errors):
+    """
+    Fetch the outputs of a finished prompt from /history.
+
+    Returns:
+        dict: The outputs mapping, or None if the prompt is missing from the history.
+    """
+    # Fetch history even if there were execution errors, some outputs might exist
+    print(f"worker-comfyui - Fetching history for prompt {prompt_id}...")
+    history = comfy.get_history(prompt_id)
+
+    if prompt_id not in history:
+        error_msg = f"Prompt ID {prompt_id} not found in history after execution."
+        print(f"worker-comfyui - {error_msg}")
+        errors.append(error_msg)
+        return None
+
+    outputs = history.get(prompt_id, {}).get("outputs", {})
+    if not outputs:
+        warning_msg = f"No outputs found in history for prompt {prompt_id}."
+        print(f"worker-comfyui - {warning_msg}")
+        if not errors:
+            errors.append(warning_msg)
+    return outputs
+
+
+def _collect_prompt_outputs(monitor, policy, errors, index=None):
+    """
+    Wait for a queued prompt to finish, then fetch and process its outputs.
+
+    Args:
+        monitor (_PromptMonitor): Monitor of the queued prompt.
+        policy (_OutputPolicy): The job's output policy.
+        errors (list): Execution and output errors are appended here.
+        index (int, optional): Position of the workflow in a batch job.
+
+    Returns:
+        dict: The processed outputs, or None if the prompt is missing from the history.
+    """
+    monitor.wait()
+    policy.timer.add_prompt(monitor, index)
+
+    if not monitor.execution_done and not errors:
+        raise ValueError(
+            "Workflow monitoring loop exited without confirmation of completion or error."
+        )
+    if monitor.timed_out and monitor.started_at is None:
+        # Removed from the queue before it ran, so it has no history
+        return None
+
+    with policy.timer.span("history"):
+        outputs = _fetch_prompt_outputs(monitor.prompt_id, errors)
+    if outputs is None:
+        return None
+
+    print(f"worker-comfyui - Processing {len(outputs)} output nodes...")
+    with policy.timer.span("outputs"):
+        output_data, output_errors = process_outputs(policy, outputs)
+    errors.extend(output_errors)
+    return output_data
+
+
+def _build_result(output_data, errors):
+    """
+    Turn the processed outputs and errors of a prompt into its result.
+
+    Args:
+        output_data (dict | None): As returned by _collect_prompt_outputs.
+        errors (list): Errors collected while running the prompt.
+
+    Returns:
+        dict: The outputs, with "errors" if there were any, or an error result
+        if nothing was produced.
+    """
+    if output_data is None:
+        if len(errors) == 1:
+            return {"error": errors[0]}
+        return {
+            "error": "Job processing failed, prompt ID not found in history.",
+            "details": errors,
+        }
+
+    final_result = dict(output_data)
+    output_count = _count_outputs(output_data)
+
+    if errors:
+        final_result["errors"] = errors
+        print(f"worker-comfyui - Job completed with errors/warnings: {errors}")
+
+    if not output_count and errors:
+        print(f"worker-comfyui - Job failed with no output images.")
+        return {
+            "error": "Job processing failed",
+            "details": errors,
+        }
+    elif not output_count and not errors:
+        print(
+            f"worker-comfyui - Job completed successfully, but the workflow produced no images."
+        )
+        final_result["status"] = "success_no_images"
+        final_result["images"] = []
+
+    return final_result
+
+
+def _error_result(e):
+    """Log an exception raised while running a job and map it to an error result."""
+    if isinstance(e, websocket.WebSocketException):
+        print(f"worker-comfyui - WebSocket Error: {e}")
+        result = {"error": f"WebSocket communication error: {e}"}
+    elif isinstance(e, requests.RequestException):
+        print(f"worker-comfyui - HTTP Request Error: {e}")
+        result = {"error": f"HTTP communication error with ComfyUI: {e}"}
+    elif isinstance(e, ValueError):
+        print(f"worker-comfyui - Value Error: {e}")
+        result = {"error": str(e)}
+    else:
+        print(f"worker-comfyui - Unexpected Handler Error: {e}")
+        result = {"error": f"An unexpected error occurred: {e}"}
+    print(traceback.format_exc())
+    return result
+
+
+def handler(job):
+    """
+    Handles a job using ComfyUI via websockets for status and image retrieval.
+
+    The stage and node timings of the job are logged as a JSON line and, if
+    the input sets ``"timings": true``, returned in a "timings" field. After
+    the job, the memory policy checks ComfyUI memory in the background and, as a
+    last resort, sets "refresh_worker" on a later result (see :class:`MemoryPolicy`).
+
+    A job running past its deadline ('timeout_s' or JOB_TIMEOUT_S) is cancelled
+    in ComfyUI and returns the outputs produced so far with ``"timed_out": true``.
+
+    Args:
+        job (dict): A dictionary containing job details and input parameters.
 
     Returns:
         dict: A dictionary containing either an error message or a success status with generated images.
     """
-    job_input = job["input"]
-    job_id = job["id"]
+    timer = JobTimer(job["id"])
+    with memory_policy.job():
+        result = _run_job(job, timer)
+        timer.log()
+        if timer.requested:
+            result["timings"] = timer.summary()
+    if not REFRESH_WORKER and memory_policy.after_job():
+        result["refresh_worker"] = True
+    return result
+
 
+def _run_job(job, timer):
+    """Body of :func:`handler`, recording its stages on ``timer``."""
     # Make sure that the input is valid
-    validated_data, error_message = validate_input(job_input)
+    with timer.span("validate"):
+        validated_data, error_message = validate_input(job["input"])
     if error_message:
         return {"error": error_message}
+    timer.requested = validated_data["timings"]
+    deadline = _job_deadline(validated_data)
 
-    # Extract validated data
-    workflow = validated_data["workflow"]
-    input_images = validated_data.get("images")
+    if "workflows" in validated_data:
+        results = sorted(
+            run_batch(job, validated_data, timer, deadline),
+            key=lambda result: result["index"],
+        )
+        batch_result = {"results": results}
+        if result_cache is not None:
+            batch_result["cache"] = result_cache.stats()
+        return batch_result
 
-    # Make sure that the ComfyUI HTTP API is available before proceeding
-    if not check_server(
-        f"http://{COMFY_HOST}/",
-        COMFY_API_AVAILABLE_MAX_RETRIES,
-        COMFY_API_AVAILABLE_INTERVAL_MS,
-    ):
-        return {
-            "error": f"ComfyUI server ({COMFY_HOST}) not reachable after multiple retries."
-        }
+    with timer.span("cache_lookup"):
+        cache_key, cached_result = _cache_lookup("handler", validated_data)
+    if cached_result is not None:
+        return {**cached_result, "cache": _cache_report(cache_key, hit=True)}
 
-    # Upload input images if they exist
-    if input_images:
-        upload_result = upload_images(input_images)
-        if upload_result["status"] == "error":
-            # Return upload errors
-            return {
-                "error": "Failed to upload one or more input images",
-                "details": upload_result["details"],
-            }
+    error_result = _prepare_comfyui(validated_data, timer)
+    if error_result:
+        return error_result
+
+    policy, progress = _job_state(job, validated_data, timer)
 
-    ws = None
-    client_id = str(uuid.uuid4())
-    prompt_id = None
-    output_data = []
+    monitor = None
     errors = []
 
     try:
-        # Establish WebSocket connection
-        ws_url = f"ws://{COMFY_HOST}/ws?clientId={client_id}"
-        print(f"worker-comfyui - Connecting to websocket: {ws_url}")
-        ws = websocket.WebSocket()
-        ws.connect(ws_url, timeout=10)
-        print(f"worker-comfyui - Websocket connected")
-
-        # Queue the workflow
-        try:
-            queued_workflow = queue_workflow(workflow, client_id)
-            prompt_id = queued_workflow.get("prompt_id")
-            if not prompt_id:
-                raise ValueError(
-                    f"Missing 'prompt_id' in queue response: {queued_workflow}"
-                )
-            print(f"worker-comfyui - Queued workflow with ID: {prompt_id}")
-        except requests.RequestException as e:
-            print(f"worker-comfyui - Error queuing workflow: {e}")
-            raise ValueError(f"Error queuing workflow: {e}")
-        except Exception as e:
-            print(f"worker-comfyui - Unexpected error queuing workflow: {e}")
-            # For ValueError exceptions from queue_workflow, pass through the original message
-            if isinstance(e, ValueError):
-                raise e
-            else:
-                raise ValueError(f"Unexpected error queuing workflow: {e}")
+        with timer.span("queue_prompt"):
+            monitor = _start_prompt(
+                validated_data["workflow"], errors, progress, deadline
+            )
+        output_data = _collect_prompt_outputs(monitor, policy, errors)
+    except Exception as e:
+        return _error_result(e)
+    finally:
+        if monitor:
+            _close_monitors([monitor])
 
-        # Wait for execution completion via WebSocket
-        print(f"worker-comfyui - Waiting for workflow execution ({prompt_id})...")
-        execution_done = False
-        while True:
-            try:
-                out = ws.recv()
-                if isinstance(out, str):
-                    message = json.loads(out)
-                    if message.get("type") == "status":
-                        status_data = message.get("data", {}).get("status", {})
-                        print(
-                            f"worker-comfyui - Status update: {status_data.get('exec_info', {}).get('queue_remaining', 'N/A')} items remaining in queue"
-                        )
-                    elif message.get("type") == "executing":
-                        data = message.get("data", {})
-                        if (
-                            data.get("node") is None
-                            and data.get("prompt_id") == prompt_id
-                        ):
-                            print(
-                                f"worker-comfyui - Execution finished for prompt {prompt_id}"
-                            )
-                            execution_done = True
-                            break
-                    elif message.get("type") == "execution_error":
-                        data = message.get("data", {})
-                        if data.get("prompt_id") == prompt_id:
-                            error_details = f"Node Type: {data.get('node_type')}, Node ID: {data.get('node_id')}, Message: {data.get('exception_message')}"
-                            print(
-                                f"worker-comfyui - Execution error received: {error_details}"
-                            )
-                            errors.append(f"Workflow execution error: {error_details}")
-                            break
-                else:
-                    continue
-            except websocket.WebSocketTimeoutException:
-                print(f"worker-comfyui - Websocket receive timed out. Still waiting...")
-                continue
-            except websocket.WebSocketConnectionClosedException as closed_err:
-                try:
-                    # Attempt to reconnect
-                    ws = _attempt_websocket_reconnect(
-                        ws_url,
-                        WEBSOCKET_RECONNECT_ATTEMPTS,
-                        WEBSOCKET_RECONNECT_DELAY_S,
-                        closed_err,
-                    )
+    final_result = _build_result(output_data, errors)
+    if monitor.timed_out:
+        final_result["timed_out"] = True
+    if "error" in final_result:
+        return final_result
 
-                    print(
-                        "worker-comfyui - Resuming message listening after successful reconnect."
-                    )
-                    continue
-                except (
-                    websocket.WebSocketConnectionClosedException
-                ) as reconn_failed_err:
-                    # If _attempt_websocket_reconnect fails, it raises this exception
-                    # Let this exception propagate to the outer handler's except block
-                    raise reconn_failed_err
+    output_count = _count_outputs(output_data)
+    if cache_key and output_count and not errors:
+        result_cache.put(cache_key, final_result)
+    cache_report = _cache_report(cache_key, hit=False)
+    if cache_report:
+        final_result["cache"] = cache_report
 
-            except json.JSONDecodeError:
-                print(f"worker-comfyui - Received invalid JSON message via websocket.")
+    print(f"worker-comfyui - Job completed. Returning {output_count} output(s).")
+    return final_result
 
-        if not execution_done and not errors:
-            raise ValueError(
-                "Workflow monitoring loop exited without confirmation of completion or error."
-            )
 
-        # Fetch history even if there were execution errors, some outputs might exist
-        print(f"worker-comfyui - Fetching history for prompt {prompt_id}...")
-        history = get_history(prompt_id)
+def _node_result(node_id, output_data, output_errors):
+    """Build the streamed result entry for one output node."""
+    result = {"node_id": node_id, **output_data}
+    if output_errors:
+        result["errors"] = output_errors
+    return result
 
-        if prompt_id not in history:
-            error_msg = f"Prompt ID {prompt_id} not found in history after execution."
-            print(f"worker-comfyui - {error_msg}")
-            if not errors:
-                return {"error": error_msg}
-            else:
-                errors.append(error_msg)
-                return {
-                    "error": "Job processing failed, prompt ID not found in history.",
-                    "details": errors,
-                }
-
-        prompt_history = history.get(prompt_id, {})
-        outputs = prompt_history.get("outputs", {})
-
-        if not outputs:
-            warning_msg = f"No outputs found in history for prompt {prompt_id}."
-            print(f"worker-comfyui - {warning_msg}")
-            if not errors:
-                errors.append(warning_msg)
-
-        print(f"worker-comfyui - Processing {len(outputs)} output nodes...")
-        for node_id, node_output in outputs.items():
-            if "images" in node_output:
+
+def stream_handler(job):
+    """
+    Generator variant of :func:`handler` that streams outputs as nodes finish.
+
+    Each output node is fetched and yielded as soon as ComfyUI reports it
+    ``executed`` instead of after the whole prompt completed. Outputs that never
+    produced an ``executed`` message (e.g. cached nodes) are picked up from the
+    history once the prompt is done.
+
+    Args:
+        job (dict): A dictionary containing job details and input parameters.
+
+    Yields:
+        dict: ``{"node_id": ..., "images": [...], "videos": [...]}`` per output node,
+        optionally with "errors"; a final ``{"error": ...}`` entry if the job failed
+        or ``{"errors": [...]}`` if it completed with errors, both carrying
+        ``"timed_out": true`` if the job deadline cancelled the prompt.
+        Batch jobs yield one ``{"index": i, ...}`` entry per workflow instead; a
+        failed workflow's error result is nested under "result".
+        When the result cache is enabled, a last ``{"cache": {...}}`` entry
+        reports whether the results were served from it, and with
+        ``"timings": true`` a final ``{"timings": {...}}`` entry follows.
+    """
+    timer = JobTimer(job["id"])
+    with memory_policy.job():
+        yield from _stream_job(job, timer)
+        timer.log()
+        if timer.requested:
+            yield {"timings": timer.summary()}
+    if not REFRESH_WORKER and memory_policy.after_job():
+        # Generator results cannot ask RunPod for a refresh
+        print(
+            "worker-comfyui - Worker refresh needed but not possible for "
+            "streamed jobs; set REFRESH_WORKER=true to refresh after every job"
+        )
+
+
+def _stream_job(job, timer):
+    """Body of :func:`stream_handler`, recording its stages on ``timer``."""
+    # Make sure that the input is valid
+    with timer.span("validate"):
+        validated_data, error_message = validate_input(job["input"])
+    if error_message:
+        yield {"error": error_message}
+        return
+    timer.requested = validated_data["timings"]
+    deadline = _job_deadline(validated_data)
+
+    if "workflows" in validated_data:
+        # Each workflow's result is streamed as soon as it is ready
+        for result in run_batch(job, validated_data, timer, deadline):
+            if "error" in result:
+                # A top-level "error" ends the stream; keep the other workflows going
+                head = {k: result.pop(k) for k in ("index", "params") if k in result}
+                result = {**head, "result": result}
+            yield result
+        if result_cache is not None:
+            yield {"cache": result_cache.stats()}
+        return
+
+    with timer.span("cache_lookup"):
+        cache_key, cached_results = _cache_lookup("stream", validated_data)
+    if cached_results is not None:
+        yield from cached_results
+        yield {"cache": _cache_report(cache_key, hit=True)}
+        return
+
+    error_result = _prepare_comfyui(validated_data, timer)
+    if error_result:
+        yield error_result
+        return
+
+    policy, progress = _job_state(job, validated_data, timer)
+
+    monitor = None
+    errors = []
+    streamed_nodes = set()
+    streamed_results = []
+    output_count = 0
+
+    try:
+        with timer.span("queue_prompt"):
+            monitor = _start_prompt(
+                validated_data["workflow"], errors, progress, deadline
+            )
+
+        for node_id, node_output in monitor.executed_outputs():
+            streamed_nodes.add(node_id)
+            with timer.span("outputs"):
+                output_data, output_errors = process_outputs(
+                    policy, {node_id: node_output}
+                )
+            if output_data or output_errors:
+                output_count += _count_outputs(output_data)
                 print(
-                    f"worker-comfyui - Node {node_id} contains {len(node_output['images'])} image(s)"
+                    f"worker-comfyui - Streaming {_count_outputs(output_data)} output(s) of node {node_id}"
                 )
-                for image_info in node_output["images"]:
-                    filename = image_info.get("filename")
-                    subfolder = image_info.get("subfolder", "")
-                    img_type = image_info.get("type")
+                streamed_results.append(
+                    _node_result(node_id, output_data, output_errors)
+                )
+                yield streamed_results[-1]
 
-                    # skip temp images
-                    if img_type == "temp":
-                        print(
-                            f"worker-comfyui - Skipping image {filename} because type is 'temp'"
-                        )
-                        continue
-
-                    if not filename:
-                        warn_msg = f"Skipping image in node {node_id} due to missing filename: {image_info}"
-                        print(f"worker-comfyui - {warn_msg}")
-                        errors.append(warn_msg)
-                        continue
-
-                    image_bytes = get_image_data(filename, subfolder, img_type)
-
-                    if image_bytes:
-                        file_extension = os.path.splitext(filename)[1] or ".png"
-
-                        if os.environ.get("BUCKET_ENDPOINT_URL"):
-                            try:
-                                with tempfile.NamedTemporaryFile(
-                                    suffix=file_extension, delete=False
-                                ) as temp_file:
-                                    temp_file.write(image_bytes)
-                                    temp_file_path = temp_file.name
-                                print(
-                                    f"worker-comfyui - Wrote image bytes to temporary file: {temp_file_path}"
-                                )
+        timer.add_prompt(monitor)
+        if not monitor.execution_done and not errors:
+            raise ValueError(
+                "Workflow monitoring loop exited without confirmation of completion or error."
+            )
 
-                                print(f"worker-comfyui - Uploading {filename} to S3...")
-                                s3_url = rp_upload.upload_image(job_id, temp_file_path)
-                                os.remove(temp_file_path)  # Clean up temp file
-                                print(
-                                    f"worker-comfyui - Uploaded {filename} to S3: {s3_url}"
-                                )
-                                # Append dictionary with filename and URL
-                                output_data.append(
-                                    {
-                                        "filename": filename,
-                                        "type": "s3_url",
-                                        "data": s3_url,
-                                    }
-                                )
-                            except Exception as e:
-                                error_msg = f"Error uploading {filename} to S3: {e}"
-                                print(f"worker-comfyui - {error_msg}")
-                                errors.append(error_msg)
-                                if "temp_file_path" in locals() and os.path.exists(
-                                    temp_file_path
-                                ):
-                                    try:
-                                        os.remove(temp_file_path)
-                                    except OSError as rm_err:
-                                        print(
-                                            f"worker-comfyui - Error removing temp file {temp_file_path}: {rm_err}"
-                                        )
-                        else:
-                            # Return as base64 string
-                            try:
-                                base64_image = base64.b64encode(image_bytes).decode(
-                                    "utf-8"
-                                )
-                                # Append dictionary with filename and base64 data
-                                output_data.append(
-                                    {
-                                        "filename": filename,
-                                        "type": "base64",
-                                        "data": base64_image,
-                                    }
-                                )
-                                print(f"worker-comfyui - Encoded {filename} as base64")
-                            except Exception as e:
-                                error_msg = f"Error encoding {filename} to base64: {e}"
-                                print(f"worker-comfyui - {error_msg}")
-                                errors.append(error_msg)
-                    else:
-                        error_msg = f"Failed to fetch image data for {filename} from /view endpoint."
-                        errors.append(error_msg)
-
-            # Check for other output types
-            other_keys = [k for k in node_output.keys() if k != "images"]
-            if other_keys:
-                warn_msg = (
-                    f"Node {node_id} produced unhandled output keys: {other_keys}."
+        outputs = None
+        if not monitor.timed_out or monitor.started_at is not None:
+            with timer.span("history"):
+                outputs = _fetch_prompt_outputs(monitor.prompt_id, errors)
+        for node_id, node_output in (outputs or {}).items():
+            if node_id in streamed_nodes:
+                continue
+            with timer.span("outputs"):
+                output_data, output_errors = process_outputs(
+                    policy, {node_id: node_output}
                 )
-                print(f"worker-comfyui - WARNING: {warn_msg}")
-                print(
-                    f"worker-comfyui - --> If this output is useful, please consider opening an issue on GitHub to discuss adding support."
+            if output_data or output_errors:
+                output_count += _count_outputs(output_data)
+                streamed_results.append(
+                    _node_result(node_id, output_data, output_errors)
                 )
+                yield streamed_results[-1]
 
-    except websocket.WebSocketException as e:
-        print(f"worker-comfyui - WebSocket Error: {e}")
-        print(traceback.format_exc())
-        return {"error": f"WebSocket communication error: {e}"}
-    except requests.RequestException as e:
-        print(f"worker-comfyui - HTTP Request Error: {e}")
-        print(traceback.format_exc())
-        return {"error": f"HTTP communication error with ComfyUI: {e}"}
-    except ValueError as e:
-        print(f"worker-comfyui - Value Error: {e}")
-        print(traceback.format_exc())
-        return {"error": str(e)}
     except Exception as e:
-        print(f"worker-comfyui - Unexpected Handler Error: {e}")
-        print(traceback.format_exc())
-        return {"error": f"An unexpected error occurred: {e}"}
+        yield _error_result(e)
+        return
     finally:
-        if ws and ws.connected:
-            print(f"worker-comfyui - Closing websocket connection.")
-            ws.close()
-
-    final_result = {}
-
-    if output_data:
-        final_result["images"] = output_data
+        if monitor:
+            _close_monitors([monitor])
 
     if errors:
-        final_result["errors"] = errors
         print(f"worker-comfyui - Job completed with errors/warnings: {errors}")
+        final_entry = {"errors": errors}
+        if not output_count:
+            final_entry = {"error": "Job processing failed", "details": errors}
+        if monitor.timed_out:
+            final_entry["timed_out"] = True
+        yield final_entry
+        if not output_count:
+            return
 
-    if not output_data and errors:
-        print(f"worker-comfyui - Job failed with no output images.")
-        return {
-            "error": "Job processing failed",
-            "details": errors,
-        }
-    elif not output_data and not errors:
-        print(
-            f"worker-comfyui - Job completed successfully, but the workflow produced no images."
+    partial = errors or any("errors" in result for result in streamed_results)
+    if cache_key and output_count and not partial:
+        result_cache.put(cache_key, streamed_results)
+    cache_report = _cache_report(cache_key, hit=False)
+    if cache_report:
+        yield {"cache": cache_report}
+
+    print(f"worker-comfyui - Job completed. Streamed {output_count} output(s).")
+
+
+# ---------------------------------------------------------------------------
+# Batch jobs
+# ---------------------------------------------------------------------------
+
+# Maximum number of workflows accepted in one batch job
+BATCH_MAX_WORKFLOWS = int(os.environ.get("BATCH_MAX_WORKFLOWS", 32))
+
+
+def _workflow_models(workflow):
+    """Return the set of model files loaded by a workflow."""
+    return {
+        name
+        for node in workflow.values()
+        if isinstance(node, dict)
+        for name in _node_models(node)
+    }
+
+
+def order_by_model_affinity(workflows):
+    """
+    Order workflows so that the ones sharing models run back to back.
+
+    ComfyUI keeps the models of the previous prompt loaded, so running
+    workflows that use the same checkpoints, UNETs and LoRAs next to each
+    other avoids swapping models in and out. Starting from the first workflow,
+    the remaining workflow sharing the most models with the previous one is
+    picked next; ties keep the submitted order.
+
+    Args:
+        workflows (list): The workflows of the batch.
+
+    Returns:
+        list: Indices into ``workflows`` in execution order.
+    """
+    models = [_workflow_models(workflow) for workflow in workflows]
+    remaining = list(range(len(workflows)))
+    order = [remaining.pop(0)]
+    while remaining:
+        previous = models[order[-1]]
+        best = max(remaining, key=lambda index: (len(models[index] & previous), -index))
+        remaining.remove(best)
+        order.append(best)
+    return order
+
+
+def expand_sweep(workflow, sweep):
+    """
+    Expand a workflow template and a parameter grid into one workflow per combination.
+
+    Args:
+        workflow (dict): The workflow template.
+        sweep (dict): ``"<node_id>.<input>"`` → list of values, e.g.
+            ``{"470.seed": [1, 2], "452.text": ["a cat", "a dog"]}``.
+
+    Returns:
+        tuple: (workflows, params, error). ``params[i]`` holds the values used
+        for ``workflows[i]``; error is a message if the sweep is invalid.
+    """
+    if not isinstance(sweep, dict) or not sweep:
+        return (
+            None,
+            None,
+            "'sweep' must be a non-empty object of '<node_id>.<input>': [values]",
         )
-        final_result["status"] = "success_no_images"
-        final_result["images"] = []
 
-    print(f"worker-comfyui - Job completed. Returning {len(output_data)} image(s).")
-    return final_result
+    targets = []
+    for key, values in sweep.items():
+        node_id, _, input_name = key.partition(".")
+        node = workflow.get(node_id)
+        if not isinstance(node, dict) or input_name not in (node.get("inputs") or {}):
+            return (
+                None,
+                None,
+                f"'sweep' key '{key}' does not match a node input of the workflow",
+            )
+        if not isinstance(values, list) or not values:
+            return None, None, f"'sweep' values for '{key}' must be a non-empty list"
+        targets.append((key, node_id, input_name))
+
+    combinations = 1
+    for values in sweep.values():
+        combinations *= len(values)
+    if combinations > BATCH_MAX_WORKFLOWS:
+        return (
+            None,
+            None,
+            f"'sweep' expands to {combinations} workflows, the maximum is {BATCH_MAX_WORKFLOWS}",
+        )
+
+    workflows = []
+    params = []
+    for combination in itertools.product(*sweep.values()):
+        variant = dict(workflow)
+        for (key, node_id, input_name), value in zip(targets, combination):
+            node = variant[node_id]
+            variant[node_id] = {**node, "inputs": {**node["inputs"], input_name: value}}
+        workflows.append(variant)
+        params.append(dict(zip(sweep, combination)))
+    return workflows, params, None
+
+
+def run_batch(job, validated_data, timer, deadline=None):
+    """
+    Run every workflow of a batch job, yielding one result per workflow.
+
+    All workflows are queued to ComfyUI up front, in model-affinity order, so
+    the GPU moves straight on to the next prompt while the outputs of the
+    previous one are being fetched and encoded. Workflows already in the
+    result cache are answered without being queued.
+
+    Args:
+        job (dict): The job.
+        validated_data (dict): The output of validate_input, with "workflows".
+        timer (JobTimer): Records the stages of the job.
+        deadline (float, optional): Monotonic time at which the job expires.
+            Workflows still running or queued then are cancelled.
+
+    Yields:
+        dict: ``{"index": i, ...}`` per workflow, in completion order, holding
+        either its outputs (and "errors", if any) or an error result. Results
+        of a parameter sweep also carry the "params" they were run with.
+        Prompts still unfinished when the generator is closed are cancelled.
+    """
+    workflows = validated_data["workflows"]
+    sweep_params = validated_data.get("sweep_params")
+
+    def entry(index):
+        if sweep_params:
+            return {"index": index, "params": sweep_params[index]}
+        return {"index": index}
+
+    cache_keys = {}
+    for index, workflow in enumerate(workflows):
+        with timer.span("cache_lookup"):
+            cache_key, cached_result = _cache_lookup(
+                "handler", {**validated_data, "workflow": workflow}
+            )
+        if cached_result is not None:
+            yield {**entry(index), **cached_result, "cached": True}
+        else:
+            cache_keys[index] = cache_key
+    if not cache_keys:
+        return
+
+    error_result = _prepare_comfyui(validated_data, timer)
+    if error_result:
+        for index in cache_keys:
+            yield {**entry(index), **error_result}
+        return
+    workflows = validated_data["workflows"]
+
+    policy, progress = _job_state(job, validated_data, timer)
+    pending = list(cache_keys)
+    order = [
+        pending[i] for i in order_by_model_affinity([workflows[i] for i in pending])
+    ]
+    print(
+        f"worker-comfyui - Queueing batch of {len(order)} workflow(s) in order {order}"
+    )
+
+    queued = []
+    monitors = []
+    try:
+        for index in order:
+            errors = []
+            try:
+                with timer.span("queue_prompt"):
+                    monitor = _start_prompt(
+                        workflows[index], errors, progress, deadline, monitors
+                    )
+                queued.append((index, monitor, errors))
+            except Exception as e:
+                yield {**entry(index), **_error_result(e)}
+
+        for index, monitor, errors in queued:
+            try:
+                output_data = _collect_prompt_outputs(monitor, policy, errors, index)
+            except Exception as e:
+                yield {**entry(index), **_error_result(e)}
+                continue
+
+            result = _build_result(output_data, errors)
+            if monitor.timed_out:
+                result["timed_out"] = True
+            if (
+                cache_keys[index]
+                and "error" not in result
+                and _count_outputs(output_data)
+                and not errors
+            ):
+                result_cache.put(cache_keys[index], result)
+            yield {**entry(index), **result}
+    finally:
+        _close_monitors([monitor for _, monitor, _ in queued])
+
+
+# ---------------------------------------------------------------------------
+# Worker warm-up
+# ---------------------------------------------------------------------------
+
+# Workflow run once at boot to load its models before the first job. Either a
+# path to a JSON file holding an API-format workflow, or a job file such as
+# test_input.json ({"input": {"workflow": ...}}).
+WARMUP_WORKFLOW = os.environ.get("WARMUP_WORKFLOW", "")
+# Comma separated models to load at boot, as "<folder>/<file>". Supported
+# folders are checkpoints, diffusion_models, vae and text_encoders; a text
+# encoder takes its CLIPLoader type as a suffix, e.g.
+# "text_encoders/umt5_xxl_fp8_e4m3fn_scaled.safetensors@wan".
+WARMUP_MODELS = os.environ.get("WARMUP_MODELS", "")
+# How WARMUP_WORKFLOW is run:
+#   • loaders – only the model loader nodes (and what they depend on)
+#   • full    – the whole workflow, which also warms the sampler and VRAM
+WARMUP_MODE = os.environ.get("WARMUP_MODE", "loaders").lower()
+# Loader node and model input used for each WARMUP_MODELS folder
+WARMUP_MODEL_LOADERS = {
+    "checkpoints": ("CheckpointLoaderSimple", "ckpt_name", {}),
+    "diffusion_models": ("UNETLoader", "unet_name", {"weight_dtype": "default"}),
+    "vae": ("VAELoader", "vae_name", {}),
+    "text_encoders": ("CLIPLoader", "clip_name", {"type": "stable_diffusion"}),
+}
+# Output node that accepts any input, used to make ComfyUI execute loader nodes
+WARMUP_SINK_NODE = "PreviewAny"
+
+
+def _load_warmup_workflow(path):
+    """Read WARMUP_WORKFLOW, unwrapping a job file ({"input": {"workflow": ...}})."""
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    if "input" in data and isinstance(data["input"], dict):
+        data = data["input"]
+    return data.get("workflow", data)
+
+
+def _is_loader(node):
+    return (
+        node.get("class_type") in MODEL_LOADER_INPUTS
+        or node.get("class_type") == POWER_LORA_LOADER
+    )
+
+
+def _prune_to_loaders(workflow):
+    """
+    Reduce a workflow to its model loader nodes and the nodes they depend on.
+
+    Node ids are kept as they are so that ComfyUI can reuse the cached loader
+    outputs when a job later runs the same nodes. Loaders whose outputs are not
+    consumed by another kept node get a WARMUP_SINK_NODE attached, since
+    ComfyUI only executes nodes that lead to an output node.
+
+    Returns:
+        dict: The pruned workflow, empty if it contains no loaders.
+    """
+    keep = set()
+    pending = [node_id for node_id, node in workflow.items() if _is_loader(node)]
+    while pending:
+        node_id = pending.pop()
+        if node_id in keep or node_id not in workflow:
+            continue
+        keep.add(node_id)
+        for value in workflow[node_id].get("inputs", {}).values():
+            # Links are [source_node_id, output_index]
+            if isinstance(value, list) and len(value) == 2:
+                pending.append(str(value[0]))
+
+    pruned = {node_id: workflow[node_id] for node_id in keep}
+    consumed = {
+        str(value[0])
+        for node in pruned.values()
+        for value in node.get("inputs", {}).values()
+        if isinstance(value, list) and len(value) == 2
+    }
+    for node_id, node in list(pruned.items()):
+        if _is_loader(node) and node_id not in consumed:
+            pruned[f"warmup_{node_id}"] = {
+                "class_type": WARMUP_SINK_NODE,
+                "inputs": {"source": [node_id, 0]},
+            }
+    return pruned
+
+
+def _models_workflow(models):
+    """
+    Build a workflow that loads every model of a WARMUP_MODELS list.
+
+    Returns:
+        dict: A workflow with one loader and one sink node per model.
+    """
+    workflow = {}
+    for index, entry in enumerate(m.strip() for m in models.split(",")):
+        if not entry:
+            continue
+        folder, _, name = entry.partition("/")
+        if folder not in WARMUP_MODEL_LOADERS or not name:
+            print(
+                f"worker-comfyui - Warm-up: skipping '{entry}', expected "
+                f"<folder>/<file> with folder one of: {', '.join(WARMUP_MODEL_LOADERS)}"
+            )
+            continue
+        class_type, input_name, extra_inputs = WARMUP_MODEL_LOADERS[folder]
+        inputs = dict(extra_inputs)
+        if folder == "text_encoders" and "@" in name:
+            name, inputs["type"] = name.rsplit("@", 1)
+        inputs[input_name] = name
+        workflow[f"warmup_loader_{index}"] = {
+            "class_type": class_type,
+            "inputs": inputs,
+        }
+        workflow[f"warmup_sink_{index}"] = {
+            "class_type": WARMUP_SINK_NODE,
+            "inputs": {"source": [f"warmup_loader_{index}", 0]},
+        }
+    return workflow
+
+
+def _describe_node(node):
+    """Return a short label for a node, naming the models it loads."""
+    names = _node_models(node)
+    label = node.get("class_type", "?")
+    return f"{label} ({', '.join(names)})" if names else label
+
+
+def warm_up():
+    """
+    Load the configured models into ComfyUI before the worker accepts jobs.
+
+    Runs WARMUP_WORKFLOW (pruned to its loaders unless WARMUP_MODE=full) or a
+    workflow built from WARMUP_MODELS, and logs how long each loader took.
+    Failures are logged and never prevent the worker from starting.
+
+    Returns:
+        dict: Node label → seconds, empty if nothing was warmed up.
+    """
+    try:
+        if WARMUP_WORKFLOW:
+            workflow = _load_warmup_workflow(WARMUP_WORKFLOW)
+            if WARMUP_MODE != "full":
+                workflow = _prune_to_loaders(workflow)
+        elif WARMUP_MODELS:
+            workflow = _models_workflow(WARMUP_MODELS)
+        else:
+            return {}
+    except (OSError, ValueError, AttributeError) as e:
+        print(f"worker-comfyui - Warm-up: could not read the warm-up workflow: {e}")
+        return {}
+    if not workflow:
+        print("worker-comfyui - Warm-up: no model loaders found, skipping")
+        return {}
+
+    if not comfy.check_server(
+        COMFY_API_AVAILABLE_MAX_RETRIES, COMFY_API_AVAILABLE_INTERVAL_MS
+    ):
+        print("worker-comfyui - Warm-up: ComfyUI not reachable, skipping")
+        return {}
+    validation_error = object_info_index.validate_workflow(workflow)
+    if validation_error:
+        print(f"worker-comfyui - Warm-up: skipping, {validation_error}")
+        return {}
+
+    print(f"worker-comfyui - Warm-up: loading models ({len(workflow)} nodes)...")
+    started = time.monotonic()
+    errors = []
+    monitor = None
+    try:
+        monitor = _start_prompt(workflow, errors)
+        monitor.wait()
+    except (ValueError, websocket.WebSocketException, requests.RequestException) as e:
+        errors.append(str(e))
+    finally:
+        if monitor is not None:
+            monitor.close()
+
+    timings = {}
+    for node_id, seconds in (monitor.node_timings if monitor else {}).items():
+        node = workflow.get(node_id, {})
+        if node.get("class_type") == WARMUP_SINK_NODE:
+            continue
+        label = f"{node_id}: {_describe_node(node)}"
+        timings[label] = round(seconds, 3)
+        print(f"worker-comfyui - Warm-up: {label} took {seconds:.2f}s")
+    for error in errors:
+        print(f"worker-comfyui - Warm-up: {error}")
+    print(f"worker-comfyui - Warm-up finished in {time.monotonic() - started:.2f}s")
+    return timings
+
+
+# ---------------------------------------------------------------------------
+# Concurrent job mode
+# ---------------------------------------------------------------------------
+
+
+def concurrency_modifier(current_concurrency):
+    """
+    Tell RunPod how many jobs this worker may run at the same time.
+
+    Every job shares the ComfyUI queue, so extra jobs do not compete for the
+    GPU: they validate and upload their inputs, and fetch and encode their
+    outputs, while another job's prompt is executing.
+    """
+    return JOB_CONCURRENCY
+
+
+async def async_handler(job):
+    """Run :func:`handler` in a thread so that several jobs can be in flight."""
+    return await asyncio.to_thread(handler, job)
+
+
+async def async_stream_handler(job):
+    """
+    Async generator wrapper around :func:`stream_handler`.
+
+    The generator is advanced and closed on executor threads. Closing it when
+    the wrapper stops early (e.g. the job was cancelled) runs its cleanup,
+    which cancels its unfinished prompts in ComfyUI (see :func:`_close_monitors`).
+    """
+    results = stream_handler(job)
+    done = object()
+    # A generator cannot be closed while a next() is running on another thread
+    lock = threading.Lock()
+
+    def advance():
+        with lock:
+            return next(results, done)
+
+    def close():
+        with lock:
+            results.close()
+
+    try:
+        while True:
+            result = await asyncio.to_thread(advance)
+            if result is done:
+                return
+            yield result
+    finally:
+        await asyncio.to_thread(close)
 
 
 if __name__ == "__main__":
     print("worker-comfyui - Starting handler...")
-    runpod.serverless.start({"handler": handler})
\ No newline at end of file
+    ready_marker = _load_ready_marker()
+    warm_up()
+    log_cold_start_timeline(ready_marker, warmup_done_ms=time.time() * 1000)
+    disk_governor.start()
+    config = {
+        "concurrency_modifier": concurrency_modifier,
+        "refresh_worker": REFRESH_WORKER,
+    }
+    if STREAM_OUTPUTS:
+        # Generator handlers are streamed by RunPod; the aggregate keeps /run results complete
+        config["handler"] = async_stream_handler
+        config["return_aggregate_stream"] = True
+    else:
+        config["handler"] = async_handler
+    runpod.serverless.start(config)
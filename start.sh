@@ -1,5 +1,7 @@
 #!/bin/bash
 echo "### SMART START SCRIPT BOOTED ###"
+# 콜드 스타트 타임라인 기록용 (epoch ms)
+BOOT_STARTED_MS=$(date +%s%3N)
 
 # 1. ComfyUI가 있을만한 경로 후보 리스트
 CANDIDATES=(
@@ -43,6 +45,8 @@ if [ -z "$COMFYUI_DIR" ]; then
 fi
 
 cd "$COMFYUI_DIR"
+# handler가 출력 파일을 /view HTTP 대신 디스크에서 직접 읽을 수 있도록 경로를 넘긴다
+export COMFYUI_DIR
 
 # 4. 가상환경(VENV) 활성화 시도
 # 보통 같은 폴더 안에 .venv 또는 .venv-cu128 등으로 존재
@@ -52,6 +56,7 @@ for venv_name in ".venv-cu128" ".venv" "venv"; do
         echo "✅ Activating VENV: $venv_name"
         source "$COMFYUI_DIR/$venv_name/bin/activate"
         VENV_FOUND=true
+        VENV_DIR="$COMFYUI_DIR/$venv_name"
         break
     fi
 done
@@ -67,7 +72,33 @@ else
     # ComfyUI may hard-import optional deps at startup; missing them will crash early.
     # - torchsde: required by k-diffusion samplers
     # - av (PyAV): required by comfy_api video input types in some ComfyUI versions
-    python -c "import torch, einops, torchsde, av; from PIL import Image; print('venv packages OK')" 2>/dev/null && VENV_PACKAGES_OK="yes"
+    VENV_PROBE="import torch, einops, torchsde, av; from PIL import Image"
+
+    # torch import만으로도 네트워크 볼륨에서는 수 초가 걸리므로, 검증 결과를 venv 안에 캐시한다.
+    # 지문(fingerprint) = venv 경로 + Python 버전(pyvenv.cfg) + 설치된 패키지 목록(*.dist-info 이름) + 검사 구문.
+    # venv가 바뀌지 않았다면 import 검사를 건너뛴다.
+    VENV_VERIFY_CACHE="$VENV_DIR/.worker-venv-verified"
+    venv_fingerprint() {
+        {
+            echo "$VENV_DIR"
+            grep -i '^version' "$VENV_DIR/pyvenv.cfg" 2>/dev/null
+            ls -d "$VENV_DIR"/lib/python*/site-packages/*-info 2>/dev/null
+            echo "$VENV_PROBE"
+        } | sha256sum | cut -d' ' -f1
+    }
+    save_venv_fingerprint() {
+        venv_fingerprint > "$VENV_VERIFY_CACHE" 2>/dev/null \
+            || echo "⚠️  Could not write venv verification cache ($VENV_VERIFY_CACHE)"
+    }
+
+    VENV_FINGERPRINT="$(venv_fingerprint)"
+    if [ -f "$VENV_VERIFY_CACHE" ] && [ "$(cat "$VENV_VERIFY_CACHE")" = "$VENV_FINGERPRINT" ]; then
+        echo "⚡ venv unchanged since last verification (${VENV_FINGERPRINT:0:12}) - skipping import probe"
+        VENV_PACKAGES_OK="yes"
+    elif python -c "$VENV_PROBE; print('venv packages OK')" 2>/dev/null; then
+        VENV_PACKAGES_OK="yes"
+        save_venv_fingerprint
+    fi
 
     if [ -n "$VENV_PACKAGES_OK" ]; then
         echo "✅ .venv-cu128 is ready - using venv packages"
@@ -113,46 +144,59 @@ print('🎉 .venv-cu128 ready!')
             echo "❌ Installation failed"
             exit 1
         }
+        save_venv_fingerprint
     fi
 fi
 
 # 5. ComfyUI 백그라운드 실행
+COMFY_PORT=8188
+# ComfyUI가 준비되었음을 handler에 알리는 마커 파일 (handler.py의 COMFY_READY_FILE)
+export COMFY_READY_FILE="${COMFY_READY_FILE:-/tmp/comfyui.ready}"
+# ComfyUI 부팅 대기 최대 시간 (초)
+COMFY_BOOT_TIMEOUT_S="${COMFY_BOOT_TIMEOUT_S:-300}"
+rm -f "$COMFY_READY_FILE"
+
 echo "🚀 Starting ComfyUI Server...."
-python main.py --listen 0.0.0.0 --port 8188 --disable-auto-launch &
+python main.py --listen 0.0.0.0 --port "$COMFY_PORT" --disable-auto-launch &
 COMFYUI_PID=$!
+COMFY_SPAWNED_MS=$(date +%s%3N)
 echo "📊 ComfyUI PID: $COMFYUI_PID"
 
-# 잠시 기다렸다가 상태 확인
-sleep 3
-if kill -0 $COMFYUI_PID 2>/dev/null; then
-    echo "✅ ComfyUI started successfully (PID: $COMFYUI_PID)"
-else
-    echo "❌ ComfyUI failed to start"
-    exit 1
-fi
-
-# 6. 부팅 대기 (10초)
-echo "⏳ Waiting 10s for boot..."
-sleep 10
-
-# 6.1 ComfyUI 실제 HTTP 응답 확인 (프로세스는 살아있어도 import 에러로 곧 죽을 수 있음)
-echo "🔍 Verifying ComfyUI HTTP endpoint (http://127.0.0.1:8188/)..."
+# 6. 준비 상태 확인
+# 고정 sleep 대신, 하나의 루프에서 프로세스 생존 여부와 HTTP 응답을 함께 확인한다.
+# bash의 /dev/tcp를 사용하므로 시도마다 새 인터프리터를 띄우지 않는다.
+# 대기 간격은 50ms부터 시작해 최대 1초까지 두 배씩 늘린다 (adaptive backoff).
+comfy_http_ok() {
+    local status
+    { exec 3<>"/dev/tcp/127.0.0.1/$COMFY_PORT"; } 2>/dev/null || return 1
+    printf 'GET / HTTP/1.0\r\nHost: 127.0.0.1\r\n\r\n' >&3
+    IFS= read -r -t 2 status <&3
+    exec 3<&- 3>&-
+    [[ "$status" == HTTP/*" 200"* ]]
+}
+
+echo "🔍 Waiting for ComfyUI HTTP endpoint (http://127.0.0.1:$COMFY_PORT/)..."
+PROBE_DELAY_MS=50
+PROBE_ATTEMPTS=0
 COMFY_HTTP_OK=""
-for i in $(seq 1 30); do
-    # Use stdlib only (urllib) so it works even if requests isn't installed in venv.
-    python - <<'PY' 2>/dev/null && COMFY_HTTP_OK="yes" && break
-import urllib.request
-urllib.request.urlopen("http://127.0.0.1:8188/", timeout=2).read()
-print("ok")
-PY
-
-    # Also bail early if the process already died
+while true; do
+    PROBE_ATTEMPTS=$((PROBE_ATTEMPTS + 1))
+    if comfy_http_ok; then
+        COMFY_HTTP_OK="yes"
+        break
+    fi
+    # 프로세스가 import 에러 등으로 죽었으면 바로 중단
     if ! kill -0 "$COMFYUI_PID" 2>/dev/null; then
-        echo "❌ ComfyUI process exited during boot wait."
+        echo "❌ ComfyUI process exited during boot."
         break
     fi
-    echo "…not ready yet ($i/30)"
-    sleep 1
+    if [ $(( $(date +%s%3N) - COMFY_SPAWNED_MS )) -ge $((COMFY_BOOT_TIMEOUT_S * 1000)) ]; then
+        echo "❌ ComfyUI did not answer within ${COMFY_BOOT_TIMEOUT_S}s."
+        break
+    fi
+    sleep "$(printf '0.%03d' "$PROBE_DELAY_MS")"
+    PROBE_DELAY_MS=$((PROBE_DELAY_MS * 2))
+    [ "$PROBE_DELAY_MS" -gt 999 ] && PROBE_DELAY_MS=999
 done
 
 if [ -z "$COMFY_HTTP_OK" ]; then
@@ -160,7 +204,13 @@ if [ -z "$COMFY_HTTP_OK" ]; then
     echo "🔎 Showing last 200 lines from ComfyUI stdout (if available in container logs)."
     exit 1
 fi
-echo "✅ ComfyUI HTTP is reachable."
+COMFY_READY_MS=$(date +%s%3N)
+echo "✅ ComfyUI HTTP is reachable after $(( COMFY_READY_MS - COMFY_SPAWNED_MS ))ms ($PROBE_ATTEMPTS probes)."
+
+# handler가 서버 확인 폴링을 건너뛸 수 있도록 준비 마커와 타임라인을 남긴다
+cat > "$COMFY_READY_FILE" <<EOF_READY
+{"pid": $COMFYUI_PID, "boot_started_ms": $BOOT_STARTED_MS, "comfy_spawned_ms": $COMFY_SPAWNED_MS, "comfy_ready_ms": $COMFY_READY_MS, "probes": $PROBE_ATTEMPTS}
+EOF_READY
 
 # 7. 핸들러 실행
 echo "🚀 Starting RunPod Handler..."
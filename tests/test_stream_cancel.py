@@ -0,0 +1,65 @@
+"""
+Closing a streamed job early must cancel its prompt in ComfyUI.
+
+Runs the handler against the fake ComfyUI server of benchmark.py.
+"""
+
+import os
+import sys
+import time
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import benchmark  # noqa: E402
+
+
+@pytest.fixture(scope="module")
+def handler():
+    process, host = benchmark.start_server(node_delay_ms=20)
+    os.environ.update(
+        COMFY_HOST=host,
+        RESULT_CACHE="false",
+        TIMINGS_LOG="false",
+        PROGRESS_UPDATES="false",
+        COMFY_READY_FILE=os.devnull,
+        WARMUP_WORKFLOW="",
+        WARMUP_MODELS="",
+    )
+    import handler
+
+    yield handler
+    process.terminate()
+
+
+def _wait_for_empty_queue(handler, timeout_s=5):
+    deadline = time.monotonic() + timeout_s
+    while True:
+        queue_state = handler.comfy.get_queue()
+        if not queue_state["queue_running"] and not queue_state["queue_pending"]:
+            return queue_state
+        if time.monotonic() >= deadline:
+            return queue_state
+        time.sleep(0.1)
+
+
+def _slow_workflow():
+    # SaveImage runs first and is streamed, then the sampler keeps ComfyUI busy
+    return {
+        "1": {"class_type": "SaveImage", "inputs": {"size_kb": 1}},
+        "2": {"class_type": "KSampler", "inputs": {"steps": 50, "delay_ms": 10000}},
+    }
+
+
+def test_closing_stream_cancels_running_prompt(handler):
+    stream = handler.stream_handler(
+        {"id": "stream-close", "input": {"workflow": _slow_workflow()}}
+    )
+    assert next(stream)["node_id"] == "1"
+    stream.close()
+
+    queue_state = _wait_for_empty_queue(handler)
+    assert queue_state["queue_running"] == []
+    assert queue_state["queue_pending"] == []